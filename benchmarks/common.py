@@ -0,0 +1,45 @@
+"""Helpers shared by the benchmarks: serving a single file from a host's
+HTTP server in a child process
+"""
+from vycodi.httpserver import Server
+from vycodi.bucket import FileSystemBackend, FileSystemFile
+import multiprocessing
+
+
+class Bucket(dict):
+	def __init__(self):
+		super(Bucket, self).__init__()
+		self.backend = FileSystemBackend()
+
+	def __getitem__(self, key):
+		return super(Bucket, self).__getitem__(int(key))
+
+
+def serve(path, conn, setup, options):
+	if setup is not None:
+		setup()
+	bucket = Bucket()
+	fileObj = FileSystemFile(1, 'bench', path, 'r')
+	fileObj.bucket = bucket
+	bucket[1] = fileObj
+	server = Server(('127.0.0.1', 0), bucket, **options)
+	conn.send(server._server.server_address[1])
+	server.run()
+
+
+def startServer(path, setup=None, **options):
+	"""Serves the file path as /file/1 with vycodi.httpserver.Server(**options)
+	in a forked child process, setup is called in the child beforehand
+	Returns (process, port)
+	"""
+	ctx = multiprocessing.get_context('fork')
+	parentConn, childConn = ctx.Pipe()
+	process = ctx.Process(target=serve, args=(path, childConn, setup, options))
+	process.daemon = True
+	process.start()
+	return process, parentConn.recv()
+
+
+def stopServer(process):
+	process.kill()
+	process.join()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Compares the throughput and CPU usage of the host's HTTP server when
+serving files with sendfile and with the buffered copy
+
+Usage: python benchmarks/sendfile.py [--size MiB] [--rounds N] [--streams N]
+
+The server runs in a child process, its CPU time is read from /proc (Linux
+only).
+"""
+from vycodi.httpserver import HTTPRequestHandler
+from common import startServer, stopServer
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tempfile import mkstemp
+import http.client
+import argparse
+import time
+import os
+
+
+def cpuSeconds(pid):
+	with open('/proc/%s/stat' % pid, 'r') as f:
+		fields = f.read().rsplit(')', 1)[1].split()
+	# utime and stime are fields 14 and 15 of stat
+	return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def download(port):
+	conn = http.client.HTTPConnection('127.0.0.1', port)
+	conn.request('GET', '/file/1')
+	r = conn.getresponse()
+	size = 0
+	while True:
+		data = r.read(1 << 20)
+		if not data:
+			break
+		size += len(data)
+	conn.close()
+	return size
+
+
+def run(path, useSendfile, rounds, streams):
+	process, port = startServer(
+		path, setup=partial(setattr, HTTPRequestHandler, 'use_sendfile', useSendfile))
+	download(port)
+
+	cpuStart = cpuSeconds(process.pid)
+	start = time.perf_counter()
+	with ThreadPoolExecutor(streams) as pool:
+		total = sum(pool.map(download, [port] * (rounds * streams)))
+	elapsed = time.perf_counter() - start
+	cpu = cpuSeconds(process.pid) - cpuStart
+
+	stopServer(process)
+	gib = total / float(1 << 30)
+	print("%-9s %8.2f GiB/s %8.3f CPU s/GiB" % (
+		"sendfile" if useSendfile else "buffered", gib / elapsed, cpu / gib))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--size', type=int, default=512, help="File size in MiB")
+	parser.add_argument('--rounds', type=int, default=4)
+	parser.add_argument('--streams', type=int, default=2, help="Parallel downloads")
+	args = parser.parse_args()
+
+	fd, path = mkstemp()
+	try:
+		block = os.urandom(1 << 20)
+		with os.fdopen(fd, 'wb') as f:
+			for _ in range(args.size):
+				f.write(block)
+		for useSendfile in (False, True):
+			run(path, useSendfile, args.rounds, args.streams)
+	finally:
+		os.unlink(path)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Measures the request rate of the host's HTTP server for small files,
+with a new connection per request and with persistent connections
+
+Usage: python benchmarks/smallfiles.py [--size KiB] [--requests N] [--streams N]
+
+The server runs in a child process.
+"""
+from common import startServer, stopServer
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import mkstemp
+import http.client
+import argparse
+import time
+import os
+
+
+def download(port, requests, keepAlive):
+	conn = None
+	for _ in range(requests):
+		if conn is None:
+			conn = http.client.HTTPConnection('127.0.0.1', port)
+		conn.request('GET', '/file/1')
+		r = conn.getresponse()
+		r.read()
+		if r.status != 200:
+			raise RuntimeError("Unexpected status %s" % r.status)
+		if not keepAlive:
+			conn.close()
+			conn = None
+	if conn is not None:
+		conn.close()
+
+
+def run(port, requests, streams, keepAlive):
+	start = time.perf_counter()
+	with ThreadPoolExecutor(streams) as pool:
+		list(pool.map(
+			lambda _: download(port, requests // streams, keepAlive), range(streams)))
+	elapsed = time.perf_counter() - start
+	print("%-10s %8.0f requests/s" % (
+		"keep-alive" if keepAlive else "close", requests / elapsed))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--size', type=int, default=4, help="File size in KiB")
+	parser.add_argument('--requests', type=int, default=20000)
+	parser.add_argument('--streams', type=int, default=8, help="Parallel clients")
+	args = parser.parse_args()
+
+	fd, path = mkstemp()
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(os.urandom(args.size * 1024))
+		process, port = startServer(path, maxConcurrency=args.streams)
+		try:
+			for keepAlive in (False, True):
+				run(port, args.requests, args.streams, keepAlive)
+		finally:
+			stopServer(process)
+	finally:
+		os.unlink(path)
+
+
+if __name__ == '__main__':
+	main()
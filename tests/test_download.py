@@ -0,0 +1,73 @@
+from vycodi import httpserver, asynchttpserver
+from vycodi.bucket import FileSystemFile
+from test_upload import Bucket
+from tempfile import mkdtemp
+from os.path import join
+import unittest
+import shutil
+import os
+
+try:
+	import requests
+except ImportError:
+	requests = None
+
+
+@unittest.skipIf(requests is None, "requests is not installed")
+class FailedDownloadTest(object):
+	"""A failed download must keep the previous content of the target path
+	"""
+	engine = None
+
+	def setUp(self):
+		self.dir = mkdtemp()
+		path = join(self.dir, 'file')
+		with open(path, 'wb') as f:
+			f.write(b'abcdef')
+		bucket = Bucket()
+		fileObj = FileSystemFile(1, 'file', path, 'r')
+		fileObj.bucket = bucket
+		bucket[1] = fileObj
+		self.server = self.engine.Server(('127.0.0.1', 0), bucket)
+		self.server.daemon = True
+		self.server.start()
+		if hasattr(self.server, 'address'):
+			port = self.server.address[1]
+		else:
+			port = self.server._server.server_address[1]
+		from vycodi.httpclient import Client
+		self.client = Client(('127.0.0.1', port))
+		self.out = join(self.dir, 'out')
+		with open(self.out, 'wb') as f:
+			f.write(b'precious')
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.join()
+		shutil.rmtree(self.dir)
+
+	def testNotFound(self):
+		from vycodi.httpclient import HTTPClientException
+		with self.assertRaises(HTTPClientException):
+			self.client.download(99, self.out)
+		with open(self.out, 'rb') as f:
+			self.assertEqual(f.read(), b'precious')
+		self.assertEqual(sorted(os.listdir(self.dir)), ['file', 'out'])
+
+	def testReplaced(self):
+		self.client.download(1, self.out)
+		with open(self.out, 'rb') as f:
+			self.assertEqual(f.read(), b'abcdef')
+		self.assertEqual(sorted(os.listdir(self.dir)), ['file', 'out'])
+
+
+class ThreadedFailedDownloadTest(FailedDownloadTest, unittest.TestCase):
+	engine = httpserver
+
+
+class AsyncFailedDownloadTest(FailedDownloadTest, unittest.TestCase):
+	engine = asynchttpserver
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,68 @@
+from vycodi import httpserver, asynchttpserver
+from vycodi.bucket import FileSystemFile
+from test_upload import Bucket
+from tempfile import mkdtemp
+from os.path import join
+import http.client
+import unittest
+import shutil
+import time
+
+
+class IdleConnectionTest(object):
+	"""Idle keep-alive connections must not hold up requests on further
+	connections
+	"""
+	engine = None
+
+	def setUp(self):
+		self.dir = mkdtemp()
+		path = join(self.dir, 'file')
+		with open(path, 'wb') as f:
+			f.write(b'abcdef')
+		bucket = Bucket()
+		fileObj = FileSystemFile(1, 'file', path, 'r')
+		fileObj.bucket = bucket
+		bucket[1] = fileObj
+		self.server = self.engine.Server(('127.0.0.1', 0), bucket, maxConcurrency=2, backlog=1)
+		self.server.daemon = True
+		self.server.start()
+		if hasattr(self.server, 'address'):
+			self.port = self.server.address[1]
+		else:
+			self.port = self.server._server.server_address[1]
+		self.connections = []
+
+	def tearDown(self):
+		for conn in self.connections:
+			conn.close()
+		self.server.shutdown()
+		self.server.join()
+		shutil.rmtree(self.dir)
+
+	def get(self):
+		conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+		self.connections.append(conn)
+		conn.request('GET', '/file/1')
+		r = conn.getresponse()
+		self.assertEqual(r.status, 200)
+		self.assertEqual(r.read(), b'abcdef')
+
+	def testIdleConnections(self):
+		self.get()
+		self.get()
+		start = time.perf_counter()
+		self.get()
+		self.assertLess(time.perf_counter() - start, 1.0)
+
+
+class ThreadedIdleConnectionTest(IdleConnectionTest, unittest.TestCase):
+	engine = httpserver
+
+
+class AsyncIdleConnectionTest(IdleConnectionTest, unittest.TestCase):
+	engine = asynchttpserver
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,108 @@
+from vycodi import httpserver, asynchttpserver
+from vycodi.bucket import FileSystemBackend, FileSystemFile
+from tempfile import mkdtemp
+from os.path import join
+import unittest
+import shutil
+import socket
+import time
+import os
+
+try:
+	import requests
+except ImportError:
+	requests = None
+
+
+class Bucket(dict):
+	def __init__(self):
+		super(Bucket, self).__init__()
+		self.backend = FileSystemBackend()
+
+	def __getitem__(self, key):
+		return super(Bucket, self).__getitem__(int(key))
+
+	def updateFile(self, file, *args):
+		pass
+
+
+class AbortedUploadTest(object):
+	"""An aborted upload must keep the previous content of the file
+	"""
+	engine = None
+
+	def setUp(self):
+		self.dir = mkdtemp()
+		self.path = join(self.dir, 'file')
+		with open(self.path, 'wb') as f:
+			f.write(b'abcdef')
+		bucket = Bucket()
+		fileObj = FileSystemFile(1, 'file', self.path, 'w')
+		fileObj.bucket = bucket
+		bucket[1] = fileObj
+		self.server = self.engine.Server(('127.0.0.1', 0), bucket)
+		self.server.daemon = True
+		self.server.start()
+		if hasattr(self.server, 'address'):
+			self.port = self.server.address[1]
+		else:
+			self.port = self.server._server.server_address[1]
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.join()
+		shutil.rmtree(self.dir)
+
+	def assertUnchanged(self):
+		# The host handles the aborted request asynchronously
+		time.sleep(0.3)
+		with open(self.path, 'rb') as f:
+			self.assertEqual(f.read(), b'abcdef')
+		self.assertEqual(os.listdir(self.dir), ['file'])
+
+	def testTruncatedChunkedBody(self):
+		s = socket.create_connection(('127.0.0.1', self.port))
+		s.sendall(b'POST /file/1 HTTP/1.1\r\nHost: test\r\n'
+			b'Transfer-Encoding: chunked\r\n\r\n3\r\nXYZ\r\n')
+		time.sleep(0.1)
+		s.close()
+		self.assertUnchanged()
+
+	def testTruncatedBody(self):
+		s = socket.create_connection(('127.0.0.1', self.port))
+		s.sendall(b'POST /file/1 HTTP/1.1\r\nHost: test\r\nContent-Length: 10\r\n\r\nXYZ')
+		s.shutdown(socket.SHUT_WR)
+		self.assertTrue(s.recv(1024).startswith(b'HTTP/1.1 400'))
+		s.close()
+		self.assertUnchanged()
+
+	@unittest.skipIf(requests is None, "requests is not installed")
+	def testUploadStreamAbort(self):
+		from vycodi.httpclient import Client
+		stream = Client(('127.0.0.1', self.port)).openUpload(1)
+		stream.write(b'XYZ')
+		stream.flush()
+		time.sleep(0.1)
+		stream.raw.abort()
+		self.assertUnchanged()
+
+	@unittest.skipIf(requests is None, "requests is not installed")
+	def testUploadStreamClose(self):
+		from vycodi.httpclient import Client
+		stream = Client(('127.0.0.1', self.port)).openUpload(1)
+		stream.write(b'XYZ')
+		stream.close()
+		with open(self.path, 'rb') as f:
+			self.assertEqual(f.read(), b'XYZ')
+
+
+class ThreadedAbortedUploadTest(AbortedUploadTest, unittest.TestCase):
+	engine = httpserver
+
+
+class AsyncAbortedUploadTest(AbortedUploadTest, unittest.TestCase):
+	engine = asynchttpserver
+
+
+if __name__ == '__main__':
+	unittest.main()
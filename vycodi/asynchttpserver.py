@@ -0,0 +1,546 @@
+from vycodi.httpserver import __version__, UnknownPathException, RangeReader, MultiRangeReader, \
+	PartsReader, ChunkedReader, TarArchive, PooledServer, notModified, ifRangeMatches, \
+	parseRange, archiveMembers, parseIdList, localCommitFileId
+from vycodi.compression import encodedETag, decoder
+from vycodi.bucket import BackendError
+from vycodi import metrics
+from http.client import parse_headers, HTTPException
+from http.server import BaseHTTPRequestHandler
+from email.utils import formatdate
+from threading import Thread
+from io import BytesIO
+import asyncio
+import hashlib
+import logging
+
+
+class Server(Thread):
+	"""Serves the files of bucket from an asyncio event loop
+	Same URLs and semantics as vycodi.httpserver.Server, but connections are
+	handled by coroutines instead of one thread per connection. Connections
+	are kept alive for keepAliveTimeout seconds between requests, backlog is
+	the listen backlog of the socket. If maxConcurrency is set, at most
+	maxConcurrency requests are handled at once, at most backlog more wait
+	and further requests are answered with a 503 response right away (see
+	Slots). Idle keep-alive connections don't count. Bodies of files with a
+	file descriptor are sent with loop.sendfile, all other blocking backend
+	calls are run in the loop's default executor. If compression
+	(vycodi.compression.CompressionRules) is set, responses are compressed
+	according to it.
+	"""
+	def __init__(self, address, bucket, keepAliveTimeout=5.0, backlog=128, compression=None,
+			maxConcurrency=None):
+		super(Server, self).__init__()
+		self._bucket = bucket
+		self._compression = compression
+		self._keepAliveTimeout = keepAliveTimeout
+		self._maxConcurrency = maxConcurrency
+		self._backlog = backlog
+		self._slots = None
+		self._connections = set()
+		self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+		self._loop = asyncio.new_event_loop()
+		self._stopFuture = self._loop.create_future()
+		self._server = self._loop.run_until_complete(
+			asyncio.start_server(self._handle, address[0], address[1], backlog=backlog))
+		self.address = self._server.sockets[0].getsockname()
+
+	def run(self):
+		self._logger.info("Starting...")
+		try:
+			self._loop.run_until_complete(self._serve())
+		finally:
+			self._loop.close()
+
+	def shutdown(self):
+		self._logger.info("Shutting down...")
+		self._loop.call_soon_threadsafe(self._signalStop)
+
+	def _signalStop(self):
+		if not self._stopFuture.done():
+			self._stopFuture.set_result(None)
+
+	async def _serve(self):
+		await self._stopFuture
+		self._server.close()
+		await asyncio.sleep(0)
+		for task in list(self._connections):
+			task.cancel()
+		await asyncio.gather(*self._connections, return_exceptions=True)
+
+	async def _handle(self, reader, writer):
+		if self._maxConcurrency is not None and self._slots is None:
+			# Created in the loop, it's bound to the running loop
+			self._slots = Slots(self._maxConcurrency, self._backlog)
+		task = asyncio.current_task()
+		self._connections.add(task)
+		metrics.httpActiveConnections.inc()
+		connection = Connection(self._bucket, reader, writer, self._logger, self._compression,
+			slots=self._slots)
+		try:
+			await connection.serve(self._keepAliveTimeout)
+		except (ConnectionError, asyncio.CancelledError):
+			pass
+		except Exception:
+			self._logger.error("Error handling connection", exc_info=True)
+		finally:
+			writer.close()
+			metrics.httpActiveConnections.dec()
+			self._connections.discard(task)
+
+
+class Slots(object):
+	"""Limits the requests handled at once to maxConcurrency, at most
+	backlog more requests wait for a slot
+	"""
+	def __init__(self, maxConcurrency, backlog):
+		self._semaphore = asyncio.Semaphore(maxConcurrency)
+		self._backlog = backlog
+		self._waiting = 0
+
+	def full(self):
+		"""Returns whether a further request would exceed the backlog
+		"""
+		return self._semaphore.locked() and self._waiting >= self._backlog
+
+	async def __aenter__(self):
+		self._waiting += 1
+		try:
+			await self._semaphore.acquire()
+		finally:
+			self._waiting -= 1
+
+	async def __aexit__(self, *excInfo):
+		self._semaphore.release()
+
+
+class Request(object):
+	def __init__(self, method, path, version, headers):
+		self.method = method
+		self.path = path
+		self.version = version
+		self.headers = headers
+
+	def keepAlive(self):
+		connection = self.headers.get('Connection', '').lower()
+		if self.version == 'HTTP/1.1':
+			return 'close' not in connection
+		return 'keep-alive' in connection
+
+	@classmethod
+	def parse(cls, head):
+		"""Parses the request line and headers, returns None if malformed
+		"""
+		requestLine, _, rest = head.partition(b'\r\n')
+		try:
+			method, path, version = requestLine.decode('latin-1').split()
+			headers = parse_headers(BytesIO(rest))
+		except (ValueError, HTTPException):
+			return None
+		if not version.startswith('HTTP/'):
+			return None
+		return cls(method, path, version, headers)
+
+
+class Connection(object):
+	"""Serves the requests of one client connection
+	"""
+	server_version = "vycodiHTTP/" + str(__version__)
+	buffer_size = 1024 * 1024
+	maxRanges = 100
+	maxArchiveRequest = 1 << 20
+	responses = BaseHTTPRequestHandler.responses
+
+	def __init__(self, bucket, reader, writer, logger, compression=None, slots=None):
+		self._bucket = bucket
+		self._compression = compression
+		self._slots = slots
+		self._reader = reader
+		self._writer = writer
+		self._logger = logger
+		self._loop = asyncio.get_event_loop()
+		self._peer = writer.get_extra_info('peername')
+
+	async def serve(self, keepAliveTimeout):
+		while True:
+			try:
+				head = await asyncio.wait_for(
+					self._reader.readuntil(b'\r\n\r\n'), keepAliveTimeout)
+			except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+					asyncio.LimitOverrunError):
+				return
+			request = Request.parse(head)
+			if request is None:
+				await self._sendError(400, "Malformed request", False)
+				return
+			if self._slots is None:
+				keepAlive = await self._handleRequest(request)
+			elif self._slots.full():
+				metrics.httpRejectedConnections.inc()
+				self._writer.write(PooledServer.rejectResponse)
+				await self._writer.drain()
+				return
+			else:
+				# Slots are only held while handling a request, not while
+				# the connection is idle
+				async with self._slots:
+					keepAlive = await self._handleRequest(request)
+			if not keepAlive:
+				return
+
+	async def _handleRequest(self, request):
+		"""Handles the request, returns whether the connection is kept alive
+		"""
+		keepAlive = request.keepAlive()
+		if request.method in ('GET', 'HEAD'):
+			return await self._sendFile(request, keepAlive)
+		elif request.method == 'POST' and request.path.split('?', 1)[0].rstrip('/') == '/files':
+			return await self._sendArchive(request, keepAlive)
+		elif request.method == 'POST' and localCommitFileId(request.path) is not None:
+			return await self._commitLocal(request, keepAlive)
+		elif request.method == 'POST':
+			return await self._receiveFile(request, keepAlive)
+		await self._sendError(501, "Unsupported method", False)
+		return False
+
+	def _run(self, fn, *args):
+		return self._loop.run_in_executor(None, fn, *args)
+
+	def _fileObj(self, request):
+		"""Returns the file of the request's path
+		Raises KeyError, ValueError or UnknownPathException if there is none
+		"""
+		path = request.path.lstrip('/')
+		if not path.startswith("file/"):
+			raise UnknownPathException()
+		return self._bucket[path[5:]]
+
+	def _writeHead(self, code, headers, keepAlive):
+		lines = [
+			"HTTP/1.1 %d %s" % (code, self.responses[code][0]),
+			"Server: %s" % self.server_version,
+			"Date: %s" % formatdate(usegmt=True)
+		]
+		for name, value in headers:
+			lines.append("%s: %s" % (name, value))
+		lines.append("Connection: %s" % ("keep-alive" if keepAlive else "close"))
+		self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+	async def _sendError(self, code, explain, keepAlive):
+		self.log_error("code %d, message %s", code, self.responses[code][0])
+		body = ("[%d] %s - %s" % (code, self.responses[code][0], explain)).encode('utf-8')
+		self._writeHead(code, [
+			("Content-Type", "text/plain"),
+			("Content-Length", len(body))
+		], keepAlive)
+		self._writer.write(body)
+		await self._writer.drain()
+		return keepAlive
+
+	async def _sendFile(self, request, keepAlive):
+		try:
+			fileObj = self._fileObj(request)
+			if not fileObj.readable():
+				return await self._sendError(403, "File not readable", keepAlive)
+		except (KeyError, ValueError, UnknownPathException):
+			return await self._sendError(404, "Nothing matches the given URI", keepAlive)
+		try:
+			url = await self._run(fileObj.genReadURL)
+			if url is not None:
+				self._writeHead(302, [("Location", url), ("Content-Length", 0)], keepAlive)
+				await self._writer.drain()
+				return keepAlive
+			size, modified, etag, checksum, contentType = await self._run(self._metadata, fileObj)
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			return await self._sendError(500, "Backend error", keepAlive)
+		lastModified = formatdate(modified, usegmt=True)
+		encoding = None
+		vary = self._compression is not None and self._compression.applies(contentType, size)
+		if vary and 'Range' not in request.headers:
+			encoding = self._compression.choose(
+				request.headers.get('Accept-Encoding'), contentType, size)
+		validators = [("ETag", encodedETag(etag, encoding)), ("Last-Modified", lastModified)]
+		if vary:
+			validators.append(("Vary", "Accept-Encoding"))
+		if notModified(request.headers, etag, modified):
+			self._writeHead(304, validators, keepAlive)
+			await self._writer.drain()
+			return keepAlive
+		if checksum is not None:
+			validators.append(("X-Checksum-SHA256", checksum))
+		if encoding is not None:
+			return await self._sendEncoded(
+				request, fileObj, encoding, contentType, etag, validators, keepAlive)
+
+		ranges = None
+		if 'Range' in request.headers and ifRangeMatches(request.headers, etag, lastModified):
+			ranges = parseRange(request.headers['Range'], size, self.maxRanges)
+			if ranges is not None and len(ranges) == 0:
+				self._writeHead(416, [
+					("Content-Range", "bytes */%s" % size),
+					("Content-Length", 0)
+				], keepAlive)
+				await self._writer.drain()
+				return keepAlive
+
+		try:
+			if ranges is None:
+				f = await self._run(fileObj.openR)
+				headers = [
+					("Content-Type", contentType),
+					("Content-Length", size)
+				]
+			elif len(ranges) == 1:
+				start, end = ranges[0]
+				f = RangeReader(
+					await self._run(fileObj.openR, start, end - start + 1), end - start + 1)
+				headers = [
+					("Content-Type", contentType),
+					("Content-Range", "bytes %s-%s/%s" % (start, end, size)),
+					("Content-Length", f.length)
+				]
+			else:
+				f = MultiRangeReader(fileObj, ranges, contentType, size)
+				headers = [
+					("Content-Type", "multipart/byteranges; boundary=%s" % f.boundary),
+					("Content-Length", f.length)
+				]
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			return await self._sendError(500, "Backend error", keepAlive)
+
+		try:
+			self.log_message("Sending %s - %s", fileObj.id, fileObj.name)
+			self._writeHead(206 if ranges is not None else 200,
+				headers + [("Accept-Ranges", "bytes")] + validators, keepAlive)
+			if request.method == 'GET':
+				await self._copy(f)
+			await self._writer.drain()
+		finally:
+			await self._run(f.close)
+		return keepAlive
+
+	async def _sendEncoded(self, request, fileObj, encoding, contentType, etag, validators,
+			keepAlive):
+		try:
+			f, length = await self._run(self._compression.open, fileObj, etag, encoding)
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			return await self._sendError(500, "Backend error", keepAlive)
+		try:
+			headers = [("Content-Type", contentType), ("Content-Encoding", encoding)]
+			if length is not None:
+				headers.append(("Content-Length", length))
+			elif request.version == 'HTTP/1.1':
+				headers.append(("Transfer-Encoding", "chunked"))
+				f = ChunkedReader(f)
+			else:
+				keepAlive = False
+			self.log_message("Sending %s - %s (%s)", fileObj.id, fileObj.name, encoding)
+			self._writeHead(200, headers + validators, keepAlive)
+			if request.method == 'GET':
+				await self._copy(f)
+			await self._writer.drain()
+		finally:
+			await self._run(f.close)
+		return keepAlive
+
+	def _metadata(self, fileObj):
+		metadata = fileObj.metadata()
+		return (metadata.size, metadata.lastModified, fileObj.etag(), fileObj.checksum(),
+			metadata.contentType)
+
+	async def _copy(self, source):
+		"""Writes source to the connection, with sendfile if possible
+		"""
+		if isinstance(source, PartsReader):
+			parts = source.parts()
+			while True:
+				part = await self._run(next, parts, None)
+				if part is None:
+					return
+				if isinstance(part, bytes):
+					self._writer.write(part)
+				else:
+					await self._copy(part)
+					if part.remaining > 0:
+						raise EOFError("File is shorter than announced")
+		if isinstance(source, RangeReader):
+			f, count = source.file, source.remaining
+		else:
+			f, count = source, None
+		try:
+			f.fileno()
+			hasFileno = True
+		except (AttributeError, OSError):
+			hasFileno = False
+		if hasFileno:
+			await self._writer.drain()
+			sent = await self._loop.sendfile(self._writer.transport, f, f.tell(), count)
+			metrics.httpSentBytes.inc(n=sent)
+			if isinstance(source, RangeReader):
+				source.remaining -= sent
+			return
+		while True:
+			buf = await self._run(source.read, self.buffer_size)
+			if not buf:
+				return
+			self._writer.write(buf)
+			metrics.httpSentBytes.inc(n=len(buf))
+			await self._writer.drain()
+
+	async def _sendArchive(self, request, keepAlive):
+		try:
+			length = int(request.headers['Content-Length'])
+		except (KeyError, TypeError, ValueError):
+			return await self._sendError(411, "Content-Length required", False)
+		if length > self.maxArchiveRequest:
+			return await self._sendError(413, "Request body too large", False)
+		try:
+			ids = parseIdList(await self._reader.readexactly(length))
+		except asyncio.IncompleteReadError:
+			return False
+		except ValueError:
+			return await self._sendError(400, "Expected a JSON list of file ids", keepAlive)
+		try:
+			archive = TarArchive(await self._run(archiveMembers, self._bucket, ids))
+		except KeyError as e:
+			return await self._sendError(
+				404, "File %s not found or not readable" % e.args[0], keepAlive)
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			return await self._sendError(500, "Backend error", keepAlive)
+		try:
+			self.log_message("Sending archive of %s files", len(ids))
+			self._writeHead(200, [
+				("Content-Type", "application/x-tar"),
+				("Content-Length", archive.length)
+			], keepAlive)
+			await self._copy(archive)
+			await self._writer.drain()
+		finally:
+			await self._run(archive.close)
+		return keepAlive
+
+	async def _commitLocal(self, request, keepAlive):
+		"""See vycodi.httpserver.HTTPRequestHandler.do_commitLocal
+		"""
+		if (request.headers.get('Content-Length', '0') != '0' or
+				'Transfer-Encoding' in request.headers):
+			keepAlive = False
+		try:
+			fileObj = self._bucket[localCommitFileId(request.path)]
+			if not fileObj.writable():
+				return await self._sendError(403, "File not writable", keepAlive)
+		except (KeyError, ValueError):
+			return await self._sendError(404, "Nothing matches the given URI", keepAlive)
+		try:
+			await self._run(fileObj.recomputeChecksum)
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			return await self._sendError(500, "Backend error", keepAlive)
+		self.log_message("Replaced locally %s", fileObj.id)
+		self._writeHead(200, [("Content-Type", "text/plain"), ("Content-Length", 0)], keepAlive)
+		await self._writer.drain()
+		return keepAlive
+
+	async def _receiveFile(self, request, keepAlive):
+		chunked = 'chunked' in request.headers.get('Transfer-Encoding', '').lower()
+		contentLength = None
+		if not chunked:
+			try:
+				contentLength = int(request.headers['Content-Length'])
+			except (KeyError, TypeError, ValueError):
+				return await self._sendError(
+					411, "Content-Length or chunked Transfer-Encoding required", False)
+
+		try:
+			bodyDecoder = decoder(request.headers.get('Content-Encoding'))
+		except ValueError:
+			return await self._sendError(415, "Unsupported Content-Encoding", False)
+
+		try:
+			fileObj = self._fileObj(request)
+			if not fileObj.writable():
+				return await self._sendError(403, "File not writable", False)
+		except (KeyError, ValueError, UnknownPathException):
+			return await self._sendError(404, "Nothing matches the given URI", False)
+
+		try:
+			self.log_message("Starting upload of %s - %s", fileObj.id, fileObj.name)
+			f = await self._run(fileObj.openW, contentLength)
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			return await self._sendError(500, "Backend error", False)
+
+		try:
+			checksum = hashlib.sha256()
+			async for chunk in self._readBody(chunked, contentLength):
+				metrics.httpReceivedBytes.inc(n=len(chunk))
+				if bodyDecoder is not None:
+					chunk = await self._run(bodyDecoder.decompress, chunk)
+				await self._run(self._write, f, checksum, chunk)
+			if bodyDecoder is not None:
+				await self._run(self._write, f, checksum, bodyDecoder.flush())
+			await self._run(f.close)
+			await self._run(fileObj.setChecksum, checksum.hexdigest())
+		except BackendError as e:
+			await self._abortQuietly(f)
+			self.log_error("BackendError: %s", str(e))
+			return await self._sendError(500, "Backend error", False)
+		except (ValueError, EOFError, asyncio.IncompleteReadError, ConnectionError) as e:
+			# The previous content of the file is kept
+			await self._abortQuietly(f)
+			self.log_error("Malformed request body: %s", str(e))
+			return await self._sendError(400, "Malformed request body", False)
+		except asyncio.CancelledError:
+			await asyncio.shield(self._abortQuietly(f))
+			raise
+		self.log_message("Finished upload of %s", fileObj.id)
+		self._writeHead(200, [("Content-Type", "text/plain"), ("Content-Length", 0)], keepAlive)
+		await self._writer.drain()
+		return keepAlive
+
+	def _write(self, f, checksum, chunk):
+		checksum.update(chunk)
+		f.write(chunk)
+
+	async def _abortQuietly(self, f):
+		try:
+			await self._run(f.abort)
+		except Exception as e:
+			self.log_error("Aborting upload failed: %s", str(e))
+
+	async def _readBody(self, chunked, contentLength):
+		if not chunked:
+			async for chunk in self._readLength(contentLength):
+				yield chunk
+			return
+		while True:
+			line = await self._reader.readline()
+			if not line:
+				raise EOFError("Connection closed before end of body")
+			chunkSize = int(line.split(b';', 1)[0].strip(), 16)
+			if chunkSize == 0:
+				# Skip trailers
+				while (await self._reader.readline()) not in (b'\r\n', b'\n', b''):
+					pass
+				return
+			async for chunk in self._readLength(chunkSize):
+				yield chunk
+			await self._reader.readline()
+
+	async def _readLength(self, length):
+		while length > 0:
+			chunk = await self._reader.read(min(length, self.buffer_size))
+			if not chunk:
+				raise EOFError("Connection closed before end of body")
+			length -= len(chunk)
+			yield chunk
+
+	def log_message(self, format, *args):
+		self._logger.info("%s - - %s" % (self._peer[0] if self._peer else '-', format % args))
+
+	def log_error(self, format, *args):
+		self._logger.error("%s - - %s" % (self._peer[0] if self._peer else '-', format % args))
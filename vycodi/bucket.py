@@ -1,6 +1,10 @@
 from vycodi.utils import loadJSONData, storeJSONData
+from threading import Lock
+from uuid import uuid4
+import hashlib
 import logging
 import mimetypes
+import time
 import os
 
 validFileTypes = ('r', 'w', 'l')
@@ -12,12 +16,16 @@ class File(object):
 	name is the name of the file, typically the last path component
 	type is 'r' (readable, i.e. servable file), 'w' (writable, to be
 		uploaded), 'l' (locked, readable after upload)
+	The SHA-256 checksum of the content is recorded when the file is
+	uploaded, see setChecksum.
 	"""
 	def __init__(self, id, name, type, bucket=None):
 		self.id = id
 		self.name = name
 		self._type = type
 		self.bucket = bucket
+		self._checksum = None
+		self._checksumETag = None
 
 	@property
 	def id(self):
@@ -49,15 +57,20 @@ class File(object):
 	def writeLock(self):
 		self.bucket.writeLockFile(self)
 
-	def openR(self):
-		return self.bucket.backend.openR(self)
+	def openR(self, offset=0, length=None):
+		return self.bucket.backend.openR(self, offset=offset, length=length)
 
 	def openW(self, contentLength=None):
-		return self.bucket.backend.openR(self, contentLength=contentLength)
+		return self.bucket.backend.openW(self, contentLength=contentLength)
 
 	def genReadURL(self):
 		return self.bucket.backend.genReadURL(self)
 
+	def metadata(self):
+		"""Returns the (cached) FileMetadata of the file's content
+		"""
+		return self.bucket.backend.metadata(self)
+
 	def size(self):
 		return self.bucket.backend.size(self)
 
@@ -67,18 +80,95 @@ class File(object):
 	def lastModified(self):
 		return self.bucket.backend.lastModified(self)
 
+	def etag(self):
+		"""Returns the entity tag of the file, the quoted checksum if it is
+		valid, else the backend's entity tag
+		"""
+		etag = self.bucket.backend.etag(self)
+		if self._checksum is not None and self._checksumETag == etag:
+			return '"%s"' % self._checksum
+		return etag
+
+	def checksum(self):
+		"""Returns the hex SHA-256 digest of the file's content or None
+		The checksum recorded by setChecksum is invalid once the file has
+		been modified by other means, i.e. the backend's entity tag changed.
+		An invalid checksum is dropped and unpublished.
+		"""
+		checksum = self._validChecksum()
+		if checksum is None and self._checksum is not None:
+			self.setChecksum(None)
+		return checksum
+
+	def setChecksum(self, checksum):
+		"""Records checksum (hex SHA-256 digest) as the checksum of the
+		file's current content and publishes it, None clears the checksum
+		"""
+		self._checksum = checksum
+		self._checksumETag = None
+		if checksum is not None:
+			self._checksumETag = self.bucket.backend.etag(self)
+		self.bucket.updateFile(self, 'checksum')
+
+	def recomputeChecksum(self):
+		"""Hashes the file's content and records the checksum, for content
+		written by other means than openW (e.g. renamed into place)
+		"""
+		self.bucket.backend.invalidate(self)
+		etag = self.bucket.backend.etag(self)
+		checksum = hashlib.sha256()
+		f = self.openR()
+		try:
+			while True:
+				chunk = f.read(1 << 20)
+				if not chunk:
+					break
+				checksum.update(chunk)
+		finally:
+			f.close()
+		self.bucket.backend.invalidate(self)
+		self.setChecksum(checksum.hexdigest())
+		if self._checksumETag != etag:
+			# Modified while hashing
+			self.setChecksum(None)
+
+	def _validChecksum(self):
+		if self._checksum is None or self.bucket is None:
+			return self._checksum
+		try:
+			if self._checksumETag == self.bucket.backend.etag(self):
+				return self._checksum
+		except BackendError:
+			pass
+		return None
+
+	def _exportChecksum(self, fileDict):
+		if self._checksum is not None:
+			fileDict["checksum"] = self._checksum
+			fileDict["checksumETag"] = self._checksumETag
+		return fileDict
+
+	def _loadChecksum(self, fileDict):
+		self._checksum = fileDict.get("checksum")
+		self._checksumETag = fileDict.get("checksumETag")
+		return self
+
 	def export(self):
-		return {
+		return self._exportChecksum({
 			"id": self.id,
 			"name": self.name,
 			"type": self._type
-		}
+		})
 
 	def exportRedis(self):
+		"""The checksum is always exported (empty if there is none), so
+		that a stale checksum is overwritten
+		"""
 		return {
 			"id": self.id,
 			"name": self.name,
-			"type": self._type
+			"type": self._type,
+			"checksum": self._validChecksum() or ""
 		}
 
 	@classmethod
@@ -88,7 +178,7 @@ class File(object):
 			fileDict["name"],
 			fileDict["type"],
 			bucket
-		)
+		)._loadChecksum(fileDict)
 
 
 class FileBucket(object):
@@ -121,6 +211,7 @@ class FileBucket(object):
 			key = int(key)
 		file = self._files[key]
 		self._unregisterFile(file)
+		self.backend.invalidate(file)
 		file.bucket = None
 		del self._files[key]
 
@@ -141,6 +232,7 @@ class FileBucket(object):
 			l.acquire()
 			self._redis.hmset(self.keyBase + str(f.id), f.exportRedis())
 			self._redis.sadd(self.keyBase + str(f.id) + ":hosts", self.host.id)
+			self._registerPath(f)
 			l.release()
 		self._registered = True
 
@@ -150,8 +242,17 @@ class FileBucket(object):
 		l.acquire()
 		self._redis.hmset(self.keyBase + str(file.id), file.exportRedis())
 		self._redis.sadd(self.keyBase + str(file.id) + ":hosts", self.host.id)
+		self._registerPath(file)
 		l.release()
 
+	def _registerPath(self, file):
+		"""Publishes the local path of the file, if the backend has one
+		Used by workers on the same machine to access the file directly
+		"""
+		path = self.backend.localPath(file)
+		if path is not None:
+			self._redis.hset(self.keyBase + str(file.id) + ':paths', self.host.id, path)
+
 	def unregister(self):
 		for f in self._files.values():
 			# TODO LOCK
@@ -160,6 +261,7 @@ class FileBucket(object):
 			l = self._redis.lock(self.keyBase + str(f.id) + ':lock', timeout=0.5, sleep=0.1)
 			l.acquire()
 			self._redis.srem(self.keyBase + str(f.id) + ":hosts", self.host.id)
+			self._redis.hdel(self.keyBase + str(f.id) + ":paths", self.host.id)
 			if self._redis.scard(self.keyBase + str(f.id) + ":hosts") < 1:
 				self._redis.delete(self.keyBase + str(f.id), self.keyBase + str(f.id) + ':hosts')
 			l.release()
@@ -172,6 +274,7 @@ class FileBucket(object):
 		l = self._redis.lock(self.keyBase + str(file.id) + ':lock', timeout=0.5, sleep=0.1)
 		l.acquire()
 		self._redis.srem(self.keyBase + str(file.id) + ":hosts", self.host.id)
+		self._redis.hdel(self.keyBase + str(file.id) + ":paths", self.host.id)
 		if self._redis.scard(self.keyBase + str(file.id) + ":hosts") < 1:
 			self._redis.delete(self.keyBase + str(file.id), self.keyBase + str(file.id) + ':hosts')
 		l.release()
@@ -186,8 +289,10 @@ class FileBucket(object):
 		else:
 			data = dict()
 			for arg in args:
-				data = fileExp[arg]
-		self._redis.hmset(self.keyBase + file.id, data)
+				if arg in fileExp:
+					data[arg] = fileExp[arg]
+		if len(data) != 0:
+			self._redis.hmset(self.keyBase + str(file.id), data)
 
 	def writeLockFile(self, file):
 		if file.id in self._writeLocks:
@@ -232,6 +337,7 @@ class JSONFileBucket(FileBucket):
 				l.acquire()
 				self._redis.hmset(self.keyBase + str(fObj.id), fObj.exportRedis())
 				self._redis.sadd(self.keyBase + str(fObj.id) + ":hosts", self.host.id)
+				self._registerPath(fObj)
 				l.release()
 
 	def exportJSON(self, f):
@@ -298,26 +404,151 @@ class BackendError(Exception):
 	pass
 
 
+class FileMetadata(object):
+	"""Metadata of a file's content, as read by Backend.stat
+	lastModified is a unix timestamp, etag the quoted entity tag, by
+	default derived from lastModified and size
+	"""
+	__slots__ = ('size', 'contentType', 'lastModified', 'etag')
+
+	def __init__(self, size, contentType, lastModified, etag=None):
+		self.size = size
+		self.contentType = contentType
+		self.lastModified = lastModified
+		if etag is None:
+			etag = '"%x-%x"' % (int(lastModified * 1000000), size)
+		self.etag = etag
+
+
+class MetadataCache(object):
+	"""Caches the FileMetadata of files by id for ttl seconds
+	Metadata read while a file was invalidated is not stored, so that it
+	can't outlive the invalidation.
+	"""
+	def __init__(self, ttl):
+		self.ttl = ttl
+		self._entries = dict()
+		self._generation = 0
+		self._lock = Lock()
+
+	def get(self, file, stat):
+		"""Returns the cached metadata of file or stat(file)
+		"""
+		now = time.monotonic()
+		with self._lock:
+			entry = self._entries.get(file.id)
+			generation = self._generation
+		if entry is not None and entry[0] > now:
+			return entry[1]
+		metadata = stat(file)
+		if self.ttl > 0:
+			with self._lock:
+				if self._generation == generation:
+					self._entries[file.id] = (now + self.ttl, metadata)
+		return metadata
+
+	def invalidate(self, file):
+		with self._lock:
+			self._generation += 1
+			self._entries.pop(file.id, None)
+
+
+class InvalidatingWriter(object):
+	"""Wraps the writable file object f returned by Backend.openW, the
+	cached metadata of file is invalidated when it is closed or aborted
+	"""
+	def __init__(self, backend, file, f):
+		self._backend = backend
+		self._file = file
+		self._f = f
+
+	def write(self, data):
+		return self._f.write(data)
+
+	def close(self):
+		try:
+			self._f.close()
+		finally:
+			self._backend.invalidate(self._file)
+
+	def abort(self):
+		try:
+			self._f.abort()
+		finally:
+			self._backend.invalidate(self._file)
+
+	def __getattr__(self, name):
+		return getattr(self._f, name)
+
+
 class Backend(object):
+	"""Storage of the content of files
+	The metadata of files (size, contentType, lastModified, etag) is read
+	with one call of stat and cached for metadataTTL seconds, or until the
+	file object returned by openW is closed. External modifications of
+	files are noticed after at most metadataTTL seconds.
+	"""
 	fileClass = File
 
-	def openR(self, file):
+	def __init__(self, metadataTTL=2.0):
+		self._metadataCache = MetadataCache(metadataTTL)
+
+	def openR(self, file, offset=0, length=None):
+		"""Returns a readable file object positioned at offset of the file
+		At least length bytes (default all until the end) are readable,
+		reading may return more
+		"""
 		pass
 
 	def openW(self, file, contentLength=None):
+		"""Returns a writable file object replacing the file's content
+		The content is replaced when the file object is closed, abort
+		discards the data written and leaves the content untouched.
+		Implementations wrap it with _invalidatingWriter
+		"""
 		pass
 
+	def _invalidatingWriter(self, file, f):
+		self.invalidate(file)
+		return InvalidatingWriter(self, file, f)
+
 	def genReadURL(self, file):
 		pass
 
+	def localPath(self, file):
+		"""Return the path of the file on the local file system or None
+		"""
+		return None
+
+	def stat(self, file):
+		"""Reads the FileMetadata of the file (uncached)
+		Raises BackendError if the file can't be accessed
+		"""
+		raise NotImplementedError()
+
+	def metadata(self, file):
+		"""Returns the (cached) FileMetadata of the file
+		"""
+		return self._metadataCache.get(file, self.stat)
+
+	def invalidate(self, file):
+		"""Drops the cached metadata of the file
+		"""
+		self._metadataCache.invalidate(file)
+
 	def size(self, file):
-		pass
+		return self.metadata(file).size
 
 	def contentType(self, file):
-		return "application/octet-stream"
+		return self.metadata(file).contentType
 
 	def lastModified(self, file):
-		pass
+		return self.metadata(file).lastModified
+
+	def etag(self, file):
+		"""Returns the (quoted) entity tag of the file's content
+		"""
+		return self.metadata(file).etag
 
 	@classmethod
 	def fromConfig(cls, config):
@@ -325,7 +556,7 @@ class Backend(object):
 
 	@classmethod
 	def fromBackendConfig(cls, config):
-		return cls()
+		return cls(metadataTTL=float(config.get('metadataTTL', 2.0)))
 
 
 class FileSystemFile(File):
@@ -337,12 +568,12 @@ class FileSystemFile(File):
 		self.path = path
 
 	def export(self):
-		return {
+		return self._exportChecksum({
 			"id": self.id,
 			"name": self.name,
 			"path": self.path,
 			"type": self._type
-		}
+		})
 
 	@classmethod
 	def fromDict(cls, fileDict, bucket=None):
@@ -352,14 +583,55 @@ class FileSystemFile(File):
 			fileDict["path"],
 			fileDict["type"],
 			bucket=bucket
-		)
+		)._loadChecksum(fileDict)
+
+
+class FileSystemWriter(object):
+	"""Writes to a temporary file next to path, which replaces path when
+	the writer is closed
+	"""
+	def __init__(self, path):
+		self.path = path
+		self._tmpPath = '%s.%s.part' % (path, uuid4().hex)
+		try:
+			self._f = open(self._tmpPath, 'wb')
+		except IOError as e:
+			raise BackendError(str(e))
+
+	def write(self, data):
+		try:
+			return self._f.write(data)
+		except IOError as e:
+			raise BackendError(str(e))
+
+	def close(self):
+		if self._f.closed:
+			return
+		try:
+			self._f.close()
+			os.replace(self._tmpPath, self.path)
+		except IOError as e:
+			self._unlinkTmp()
+			raise BackendError(str(e))
+
+	def abort(self):
+		if self._f.closed:
+			return
+		self._f.close()
+		self._unlinkTmp()
+
+	def _unlinkTmp(self):
+		try:
+			os.unlink(self._tmpPath)
+		except OSError:
+			pass
 
 
 class FileSystemBackend(Backend):
 	fileClass = FileSystemFile
 
-	def __init__(self):
-		super(FileSystemBackend, self).__init__()
+	def __init__(self, metadataTTL=2.0):
+		super(FileSystemBackend, self).__init__(metadataTTL=metadataTTL)
 		if not mimetypes.inited:
 			mimetypes.init()
 		self.extensions_map = mimetypes.types_map.copy()
@@ -370,30 +642,41 @@ class FileSystemBackend(Backend):
 			'.h': 'text/plain',
 		})
 
-	def openR(self, file):
+	def openR(self, file, offset=0, length=None):
 		try:
-			return open(file.path, 'rb')
+			f = open(file.path, 'rb')
 		except IOError as e:
 			raise BackendError(str(e))
+		if offset != 0:
+			try:
+				f.seek(offset)
+			except IOError as e:
+				f.close()
+				raise BackendError(str(e))
+		return f
 
 	def openW(self, file, contentLength=None):
-		try:
-			return open(file.path, 'wb')
-		except IOError as e:
-			raise BackendError(str(e))
+		return self._invalidatingWriter(file, FileSystemWriter(file.path))
 
 	def genReadURL(self, file):
 		return None
 
-	def size(self, file):
-		return os.path.getsize(file.path)
+	def localPath(self, file):
+		return file.path
 
-	def contentType(self, file):
+	def stat(self, file):
+		try:
+			st = os.stat(file.path)
+		except OSError as e:
+			raise BackendError(str(e))
+		return FileMetadata(st.st_size, self.guessType(file.path), st.st_mtime)
+
+	def guessType(self, path):
 		"""Copy of the SimpleHTTPServer.guess_type method
 		Return value is usable for a MIME Content-Type header.
 		"""
 
-		base, ext = os.path.splitext(file.path)
+		base, ext = os.path.splitext(path)
 		if ext in self.extensions_map:
 			return self.extensions_map[ext]
 		ext = ext.lower()
@@ -401,6 +684,3 @@ class FileSystemBackend(Backend):
 			return self.extensions_map[ext]
 		else:
 			return self.extensions_map['']
-
-	def lastModified(self, file):
-		return os.stat(file.path).st_mtime
@@ -1,7 +1,8 @@
 import argh
-from vycodi.utils import loadJSONConfig
+from vycodi.utils import loadJSONConfig, redisFromConfig
+from vycodi.queue import TaskLoader
 from vycodi.host import HostDaemon
-from vycodi.worker import WorkerDaemon
+from vycodi.worker import WorkerDaemon, WorkerRPCClient
 
 
 @argh.named("start")
@@ -51,9 +52,46 @@ def statusWorker(configFile):
 	else:
 		print("Worker daemon not running")
 
+@argh.named("profile")
+@argh.arg('--processors', nargs='*')
+def profileWorker(configFile, fraction, processors=None):
+	config = loadJSONConfig(configFile)
+	client = WorkerRPCClient.fromConfig(config)
+	if client is None:
+		print("Worker daemon not running")
+		return
+	client.setProfiling(float(fraction), processors=processors or None)
+	print("Profiling %s of tasks" % fraction)
+
+
+@argh.named("dump-profiles")
+def dumpProfilesWorker(configFile, reset=False):
+	config = loadJSONConfig(configFile)
+	client = WorkerRPCClient.fromConfig(config)
+	if client is None:
+		print("Worker daemon not running")
+		return
+	for path in client.dumpProfiles(reset=reset):
+		print(path)
+
+
+@argh.named("cancel")
+@argh.arg('tasks', nargs='*')
+@argh.arg('--batches', nargs='*')
+def cancelTasks(configFile, tasks, batches=None):
+	config = loadJSONConfig(configFile)
+	loader = TaskLoader(redisFromConfig(config))
+	cancelled = loader.cancelTasks(*tasks)
+	for batch in batches or []:
+		loader.cancelBatch(batch)
+	print("Cancelled %s tasks and %s batches" % (cancelled, len(batches or [])))
+
 parser = argh.ArghParser()
 parser.add_commands((startHost, stopHost, statusHost), namespace="host")
-parser.add_commands((startWorker, stopWorker, statusWorker), namespace="worker")
+parser.add_commands(
+	(startWorker, stopWorker, statusWorker, profileWorker, dumpProfilesWorker),
+	namespace="worker")
+parser.add_commands((cancelTasks,), namespace="task")
 
 
 def main():
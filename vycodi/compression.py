@@ -0,0 +1,296 @@
+from os.path import join, exists
+from fnmatch import fnmatch
+from uuid import uuid4
+from hashlib import sha1
+import zlib
+import glob
+import os
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+class GzipCodec(object):
+	name = 'gzip'
+
+	def compressor(self, level=None):
+		return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 31)
+
+	def decompressor(self):
+		return zlib.decompressobj(31)
+
+
+class ZstdCodec(object):
+	name = 'zstd'
+
+	def compressor(self, level=None):
+		return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+	def decompressor(self):
+		return zstandard.ZstdDecompressor().decompressobj()
+
+
+codecs = {'gzip': GzipCodec()}
+if zstandard is not None:
+	codecs['zstd'] = ZstdCodec()
+
+# Content codings in order of preference
+preferredEncodings = tuple(e for e in ('zstd', 'gzip') if e in codecs)
+
+
+def acceptEncoding():
+	"""Returns the value of an Accept-Encoding header listing the
+	available content codings
+	"""
+	return ", ".join(preferredEncodings)
+
+
+def parseAcceptEncoding(header):
+	"""Returns a dict mapping the content codings of an Accept-Encoding
+	header to their q values
+	"""
+	accepted = dict()
+	for item in header.split(','):
+		coding, _, params = item.partition(';')
+		coding = coding.strip().lower()
+		if coding == '':
+			continue
+		q = 1.0
+		for param in params.split(';'):
+			name, _, value = param.partition('=')
+			if name.strip().lower() == 'q':
+				try:
+					q = float(value)
+				except ValueError:
+					q = 0.0
+		accepted[coding] = q
+	return accepted
+
+
+def encodedETag(etag, encoding):
+	"""Returns the entity tag of the representation of the file with etag
+	compressed with encoding
+	"""
+	if encoding is None:
+		return etag
+	return etag[:-1] + '-' + encoding + '"'
+
+
+def identityETag(etag):
+	"""Reverses encodedETag, returns other entity tags unchanged
+	"""
+	for encoding in codecs:
+		suffix = '-' + encoding + '"'
+		if etag.endswith(suffix):
+			return etag[:-len(suffix)] + '"'
+	return etag
+
+
+class Decoder(object):
+	"""Decompresses data compressed with encoding chunk by chunk
+	Raises ValueError for corrupt data
+	"""
+	def __init__(self, encoding):
+		try:
+			self._decompressor = codecs[encoding].decompressor()
+		except KeyError:
+			raise ValueError("Unsupported content coding '{}'".format(encoding))
+
+	def decompress(self, data):
+		try:
+			return self._decompressor.decompress(data)
+		except Exception as e:
+			raise ValueError(str(e))
+
+	def flush(self):
+		try:
+			return self._decompressor.flush()
+		except Exception as e:
+			raise ValueError(str(e))
+
+
+def decoder(encoding):
+	"""Returns a Decoder for the value of a Content-Encoding header, None
+	if the content is not encoded
+	Raises ValueError if encoding is not supported
+	"""
+	if encoding is None:
+		return None
+	encoding = encoding.strip().lower()
+	if encoding in ('', 'identity'):
+		return None
+	return Decoder(encoding)
+
+
+def decodeChunks(chunks, encoding):
+	"""Yields the decompressed data of the iterable chunks
+	"""
+	d = decoder(encoding)
+	if d is None:
+		for chunk in chunks:
+			yield chunk
+		return
+	for chunk in chunks:
+		data = d.decompress(chunk)
+		if data:
+			yield data
+	data = d.flush()
+	if data:
+		yield data
+
+
+def encodeChunks(chunks, encoding, level=None):
+	"""Yields the data of the iterable chunks compressed with encoding
+	"""
+	compressor = codecs[encoding].compressor(level)
+	for chunk in chunks:
+		data = compressor.compress(chunk)
+		if data:
+			yield data
+	yield compressor.flush()
+
+
+class CompressingReader(object):
+	"""Reads the contents of the file object file compressed with encoding
+	read returns compressed blocks of any size, b'' at the end.
+	If teePath is set, the compressed data is also written to teePath,
+	which is created once all data has been read.
+	"""
+	def __init__(self, file, encoding, level=None, teePath=None, chunkSize=1 << 20):
+		self.file = file
+		self._compressor = codecs[encoding].compressor(level)
+		self._chunkSize = chunkSize
+		self._done = False
+		self._teePath = teePath
+		self._tee = None
+		if teePath is not None:
+			self._teeTmpPath = '%s.%s.part' % (teePath, uuid4().hex)
+			self._tee = open(self._teeTmpPath, 'wb')
+
+	def read(self, n=-1):
+		while not self._done:
+			chunk = self.file.read(self._chunkSize)
+			if chunk:
+				data = self._compressor.compress(chunk)
+			else:
+				data = self._compressor.flush()
+				self._done = True
+			if self._tee is not None:
+				self._tee.write(data)
+				if self._done:
+					self._tee.close()
+					self._tee = None
+					os.rename(self._teeTmpPath, self._teePath)
+			if data:
+				return data
+		return b''
+
+	def close(self):
+		if self._tee is not None:
+			self._tee.close()
+			self._tee = None
+			os.unlink(self._teeTmpPath)
+		self.file.close()
+
+
+class VariantStore(object):
+	"""Stores compressed variants of files in directory
+	Variants are named after the file id, the file's entity tag and the
+	encoding. Variants of older versions of a file are removed when a
+	variant of the current version is stored.
+	"""
+	def __init__(self, directory):
+		self._directory = directory
+		if not exists(directory):
+			os.makedirs(directory, exist_ok=True)
+
+	def path(self, fileObj, etag, encoding):
+		return join(self._directory, '%s.%s.%s' % (
+			fileObj.id, sha1(etag.encode('utf-8')).hexdigest()[:16], encoding))
+
+	def open(self, fileObj, etag, encoding, level=None):
+		"""Returns (file object, length) of the variant, length is None if
+		the variant is created while reading the returned file object
+		"""
+		path = self.path(fileObj, etag, encoding)
+		try:
+			f = open(path, 'rb')
+			return f, os.fstat(f.fileno()).st_size
+		except FileNotFoundError:
+			pass
+		for stale in glob.glob(join(self._directory, '%s.*.%s' % (fileObj.id, encoding))):
+			if stale != path and not stale.endswith('.part'):
+				try:
+					os.unlink(stale)
+				except OSError:
+					pass
+		return CompressingReader(fileObj.openR(), encoding, level=level, teePath=path), None
+
+
+class CompressionRules(object):
+	"""Decides which responses of a host are compressed
+	Files whose content type matches one of contentTypes (fnmatch patterns
+	like 'text/*') and which are at least minSize bytes large are
+	compressed with the first of encodings accepted by the client. If
+	variants (a VariantStore) is set, compressed variants are stored and
+	reused by later requests, instead of compressing on every request.
+	"""
+	defaultContentTypes = (
+		'text/*', 'application/json', 'application/xml', 'application/javascript',
+		'application/x-ndjson', 'image/svg+xml'
+	)
+
+	def __init__(self, contentTypes=None, minSize=1024, encodings=None, level=None,
+			variants=None):
+		self.contentTypes = tuple(contentTypes or self.defaultContentTypes)
+		self.minSize = minSize
+		self.encodings = tuple(e for e in (encodings or preferredEncodings) if e in codecs)
+		self.level = level
+		self.variants = variants
+
+	def applies(self, contentType, size):
+		"""Returns whether files of contentType and size are compressed for
+		clients accepting one of the encodings
+		"""
+		if size < self.minSize:
+			return False
+		contentType = contentType.split(';', 1)[0].strip().lower()
+		return any(fnmatch(contentType, pattern) for pattern in self.contentTypes)
+
+	def choose(self, acceptEncodingHeader, contentType, size):
+		"""Returns the encoding to compress the file with or None
+		"""
+		if acceptEncodingHeader is None or not self.applies(contentType, size):
+			return None
+		accepted = parseAcceptEncoding(acceptEncodingHeader)
+		for encoding in self.encodings:
+			if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+				return encoding
+		return None
+
+	def open(self, fileObj, etag, encoding):
+		"""Returns (file object, length) of the file compressed with
+		encoding, length is None if it is not known in advance
+		"""
+		if self.variants is not None:
+			return self.variants.open(fileObj, etag, encoding, level=self.level)
+		return CompressingReader(fileObj.openR(), encoding, level=self.level), None
+
+	@classmethod
+	def fromConfig(cls, config, runDir=None):
+		"""Creates rules from the compression section of the host config
+		Keys are contentTypes, minSize, encodings, level and storeVariants.
+		If storeVariants is set, variants are stored in runDir/variants.
+		"""
+		variants = None
+		if config.get('storeVariants', False):
+			variants = VariantStore(join(runDir, 'variants'))
+		return cls(
+			contentTypes=config.get('contentTypes', None),
+			minSize=int(config.get('minSize', 1024)),
+			encodings=config.get('encodings', None),
+			level=config.get('level', None),
+			variants=variants
+		)
@@ -20,7 +20,10 @@ class Purger(object):
 
 class Heartbeat(Thread):
 	def __init__(self, redis, key, ttl, interval,
-			prefix="", postfix="", value=None, setKey=None, purger=None):
+			prefix="", postfix="", value=None, setKey=None, purger=None, onBeat=None):
+		"""onBeat is called after every heartbeat, e.g. to refresh further
+		keys
+		"""
 		super(Heartbeat, self).__init__()
 		self._logger = logging.getLogger(
 			"%s.%s[%s][%s%s%s]" % (__name__, self.__class__.__name__, self.name,
@@ -35,6 +38,7 @@ class Heartbeat(Thread):
 		self.value = value
 		self.setKey = setKey
 		self.purger = purger
+		self.onBeat = onBeat
 
 	def run(self):
 		self._logger.debug(
@@ -65,6 +69,8 @@ class Heartbeat(Thread):
 			if not r and self.purger is not None:
 				self._logger.warn("Detected zombie")
 				self.purger.zombie(self.prefix, self.key, self.postfix, self)
+			if self.onBeat is not None:
+				self.onBeat()
 
 			if maxCounter is not None:
 				counter += 1
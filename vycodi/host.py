@@ -1,7 +1,10 @@
 from vycodi.bucket import FileBucket, FileSystemFile, JSONFileBucket, validFileTypes
-from vycodi.httpserver import Server as HTTPServer
+from vycodi import httpserver, asynchttpserver
+from vycodi.compression import CompressionRules
 from vycodi.daemon import Daemon
-from vycodi.utils import redisFromConfig, ensureJSONData, storeJSONData, loadJSONData
+from vycodi.utils import redisFromConfig, ensureJSONData, storeJSONData, loadJSONData, machineId, \
+	metricsAddressFromConfig
+from vycodi.metrics import MetricsServer
 from vycodi.jsonrpc import RPCClient, Server as RPCServer, Dispatcher, JSONRPCDispatchException
 from vycodi.heartbeat import Heartbeat, Purger
 from os.path import join, abspath, exists, dirname
@@ -12,17 +15,24 @@ import logging
 
 
 class HostDaemon(Daemon):
-	def __init__(self, host, *args, **kwargs):
+	def __init__(self, host, *args, metricsAddress=None, **kwargs):
 		super(HostDaemon, self).__init__(*args, **kwargs)
 		self.host = host
+		self._metricsAddress = metricsAddress
+		self._metricsServer = None
 
 	def run(self, *args, **kwargs):
+		if self._metricsAddress is not None:
+			self._metricsServer = MetricsServer(self._metricsAddress)
+			self._metricsServer.start()
 		self.host.start()
 		self.wait()
 
 	def shutdown(self):
 		self.host.shutdown()
 		self.host.join()
+		if self._metricsServer is not None:
+			self._metricsServer.shutdown()
 
 	@classmethod
 	def fromConfig(cls, config, *args, redis=None, **kwargs):
@@ -30,21 +40,43 @@ class HostDaemon(Daemon):
 		if not exists(runDir):
 			mkdir(runDir)
 		host = Host.fromConfig(config, redis=redis)
-		return cls(host, *args, runDir=runDir, **kwargs)
+		return cls(host, *args, runDir=runDir,
+			metricsAddress=metricsAddressFromConfig(config), **kwargs)
 
 
 class Host(Purger):
 	"""Host for files
 	"""
-	def __init__(self, address, redis, id=None, bucket=None, rpcAddress=None):
+	serverEngines = {
+		'threaded': httpserver.Server,
+		'asyncio': asynchttpserver.Server
+	}
+
+	def __init__(self, address, redis, id=None, bucket=None, rpcAddress=None, machine=None,
+			serverEngine='threaded', serverOptions=None, compression=None):
 		"""Init
 		address must be a two element tuple address = (bindAddress, bindPort)
 		If id is not set (is None), the next available host id is fetched
 		bucket may be a FileBucket object, file or file path (which is then loaded),
 		or an IOBase instance
+		machine identifies the machine the host runs on, defaults to machineId()
+		serverEngine is the name of the HTTP server engine, see serverEngines
+		serverOptions are passed to the server engine as keyword arguments,
+		both engines accept maxConcurrency, backlog and keepAliveTimeout
+		(default 5 s)
+		compression may be a vycodi.compression.CompressionRules object, which
+		enables the compression of responses
 		"""
 		self._redis = redis
+		self._machine = machine or machineId()
 		self._address = address
+		try:
+			self._serverClass = self.serverEngines[serverEngine]
+		except KeyError:
+			raise ValueError("Unknown serverEngine '{}'".format(serverEngine))
+		self._serverOptions = dict(serverOptions or {})
+		if compression is not None:
+			self._serverOptions['compression'] = compression
 		self._server = None
 		self._rpcAddress = rpcAddress
 		self._rpcServer = None
@@ -69,7 +101,7 @@ class Host(Purger):
 	def start(self):
 		self._logger.info("Starting...")
 		if self._server is None:
-			self._server = HTTPServer(self._address, self.bucket)
+			self._server = self._serverClass(self._address, self.bucket, **self._serverOptions)
 		if self._rpcAddress is not None:
 			if self._rpcServer is None:
 				self._rpcServer = HostRPCServer(self._rpcAddress, self)
@@ -132,13 +164,21 @@ class Host(Purger):
 
 		bucket = JSONFileBucket(redis, None, bucketFile, backend=backend)
 
+		compression = None
+		if 'compression' in config:
+			compression = CompressionRules.fromConfig(config['compression'], runDir=runDir)
+
 		hostId = None
 		try:
 			hostId = loadJSONData(join(runDir, 'data.json'))['hostId']
 		except FileNotFoundError:
 			pass
 
-		host = cls(address, redis, id=hostId, bucket=bucket, rpcAddress=rpcSock)
+		host = cls(address, redis, id=hostId, bucket=bucket, rpcAddress=rpcSock,
+			machine=config.get('machineId', None),
+			serverEngine=config.get('httpServer', 'threaded'),
+			serverOptions=config.get('httpServerOptions', None),
+			compression=compression)
 
 		if hostId is None:
 			storeJSONData(join(runDir, 'data.json'), {'hostId': host.id})
@@ -149,7 +189,8 @@ class Host(Purger):
 		self._redis.hmset('vycodi:host:' + str(self.id), {
 			'id': self.id,
 			'address': self._address[0],
-			'port': self._address[1]
+			'port': self._address[1],
+			'machine': self._machine
 		})
 		self._redis.sadd('vycodi:hosts', self.id)
 		self.bucket.register()
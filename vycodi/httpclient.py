@@ -1,7 +1,19 @@
 import requests
-from vycodi.utils import decodeRedis
-from os.path import abspath
-from io import IOBase
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from vycodi.utils import decodeRedis, linkFile, machineId, loadJSONData, storeJSONData
+from vycodi import metrics, compression
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, BoundedSemaphore
+from queue import Queue, Full
+from os.path import abspath, join, exists
+from uuid import uuid4
+import os
+import logging
+import time
+import shutil
+import tarfile
+import hashlib
+from io import IOBase, RawIOBase, BufferedReader, BufferedWriter
 
 
 class FileLoaderException(Exception):
@@ -36,13 +48,41 @@ class PathNotSet(FileLoaderException):
 		super(PathNotSet, self).__init__("PathNotSet")
 
 
+class ChecksumMismatch(FileLoaderException):
+	"""Raised if the content of a downloaded file doesn't match its
+	checksum
+	"""
+	def __init__(self, id):
+		super(ChecksumMismatch, self).__init__("ChecksumMismatch, id = " + str(id))
+		self.id = id
+
+
+class TransferFailed(FileLoaderException):
+	"""Raised by FileLoader.downloadMany and uploadMany after all
+	transfers have finished, errors is a list of (file id, exception)
+	"""
+	def __init__(self, errors):
+		super(TransferFailed, self).__init__(
+			"TransferFailed, " + "; ".join(
+				"id = %s: %s: %s" % (id, e.__class__.__name__, e) for id, e in errors
+			)
+		)
+		self.errors = errors
+
+
 class File(object):
-	def __init__(self, id, name, type, path=None, loader=None):
+	"""File known to the system
+	checksum is the hex SHA-256 digest of the file's content published by
+	its host or None. It may be outdated, it's only used to look up cached
+	copies, which are confirmed by the host.
+	"""
+	def __init__(self, id, name, type, path=None, loader=None, checksum=None):
 		self.id = id
 		self.name = name
 		self.type = type
 		self.path = path
 		self.loader = loader
+		self.checksum = checksum
 
 	def download(self, file=None):
 		if self.loader is None:
@@ -55,10 +95,13 @@ class File(object):
 		self.loader.download(self.id, self.path)
 
 	def upload(self, file=None):
+		"""Uploads the file from file (a path, a file object or an iterable
+		of bytes), defaults to the file's path
+		"""
 		if self.loader is None:
 			raise LoaderNotSet()
 		if file is not None:
-			if isinstance(file, IOBase):
+			if not isinstance(file, str):
 				self.loader.upload(self.id, file)
 				return
 			self.path = file
@@ -69,27 +112,373 @@ class File(object):
 			raise PathNotSet()
 		return open(self.path, *args, **kwargs)
 
+	def openDownload(self):
+		"""Returns a readable binary stream of the file's contents,
+		read directly from the host
+		"""
+		if self.loader is None:
+			raise LoaderNotSet()
+		return self.loader.openDownload(self.id)
+
+	def openUpload(self):
+		"""Returns a writable binary stream, data written is uploaded to
+		the host while writing. The upload is completed by closing the
+		stream
+		"""
+		if self.loader is None:
+			raise LoaderNotSet()
+		return self.loader.openUpload(self.id)
+
 
 class FileLoader(object):
-	def __init__(self, redis, pool=None):
+	"""Loads file data from redis and transfers files from / to hosts
+	concurrency is the maximum number of concurrent transfers of
+	downloadMany and uploadMany, hostConcurrency the maximum number of
+	concurrent transfers per host. Both limits are shared by all calls,
+	e.g. by all tasks of a worker.
+	If localTransfer is set, files of hosts running on the same machine
+	(with the same machine id) are accessed directly on the file system:
+	downloads are reflinked or copied and uploads are renamed into place,
+	after which the host is notified to recompute the file's metadata.
+	Transfers fall back to HTTP if that is not possible.
+	If cacheDir is set, downloads to paths are cached there. Files with a
+	checksum are cached by checksum, files with the same content share
+	one entry. Others are cached by id. Cached copies are revalidated with
+	a conditional request on later downloads.
+	If uploadEncoding is set, uploads are compressed with this content
+	coding (see vycodi.compression).
+	"""
+	archiveMinFiles = 4
+	archiveMaxFiles = 1000
+
+	def __init__(self, redis, pool=None, concurrency=4, hostConcurrency=2,
+			localTransfer=False, machine=None, cacheDir=None, uploadEncoding=None):
 		self._redis = redis
 		self._pool = pool or ClientPool()
+		self._concurrency = concurrency
+		self._hostConcurrency = hostConcurrency
+		self._hostSemaphores = dict()
+		self._lock = Lock()
+		self._executor = None
+		self._localTransfer = localTransfer
+		self._machine = machine or machineId()
+		self._cacheDir = cacheDir
+		self._uploadEncoding = uploadEncoding
+		self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
 
 	def __getitem__(self, key):
 		return self.getFile(key)
 
 	def download(self, id, outF):
 		f = self.getFile(id, fObj=outF)
+		if isinstance(outF, str) and self._downloadLocal(id, outF):
+			return f
 		s = self._pool[self._getServerAddress(id)]
-		s.download(id, outF)
+		self._download(s, id, outF, checksum=f.checksum or None)
 		return f
 
 	def upload(self, id, inF):
 		f = self.getFile(id, fObj=inF)
+		if isinstance(inF, str) and self._uploadLocal(f, inF):
+			return f
 		s = self._pool[self._getServerAddress(id)]
-		s.upload(id, inF)
+		s.upload(id, inF, encoding=self._uploadEncoding)
 		return f
 
+	def openDownload(self, id):
+		localPath = self._localPath(id)
+		if localPath is not None:
+			try:
+				return open(localPath, 'rb')
+			except (IOError, OSError):
+				pass
+		s = self._pool[self._getServerAddress(id)]
+		return s.openDownload(id)
+
+	def openUpload(self, id):
+		s = self._pool[self._getServerAddress(id)]
+		return s.openUpload(id)
+
+	def downloadMany(self, files):
+		"""Downloads all files concurrently
+		files is an iterable of File objects, each is downloaded to its path
+		If at least archiveMinFiles files are downloaded from a host and no
+		download cache is used, they are downloaded in tar archives of at
+		most archiveMaxFiles files, see Client.downloadArchive
+		Raises TransferFailed after all transfers have finished if any
+		transfer failed
+		"""
+		self._transferMany(files,
+			lambda s, f: self._download(s, f.id, f.path, checksum=f.checksum or None),
+			local=lambda f, localFile: linkFile(localFile[1], f.path, hardLink=False),
+			histogram=metrics.downloadSeconds,
+			transferBatch=self._downloadArchive if self._cacheDir is None else None)
+
+	def uploadMany(self, files):
+		"""Uploads all files concurrently
+		files is an iterable of File objects, each is uploaded from its path
+		Raises TransferFailed after all transfers have finished if any
+		transfer failed
+		"""
+		self._transferMany(files,
+			lambda s, f: s.upload(f.id, f.path, encoding=self._uploadEncoding),
+			local=lambda f, localFile: self._renameLocal(f, f.path, localFile),
+			histogram=metrics.uploadSeconds)
+
+	def afterFork(self):
+		"""Drops all state shared with the parent process, to be called in
+		a forked child process
+		"""
+		self._pool = ClientPool()
+		self._hostSemaphores = dict()
+		self._lock = Lock()
+		self._executor = None
+
+	def shutdown(self):
+		with self._lock:
+			if self._executor is not None:
+				self._executor.shutdown()
+				self._executor = None
+
+	def _transferMany(self, files, transfer, local=None, histogram=None, transferBatch=None):
+		"""Transfers files concurrently with transfer(client, file)
+		If transferBatch is set, files of hosts with at least
+		archiveMinFiles files are transferred in batches with
+		transferBatch(client, files)
+		Files whose host can't be resolved up front are resolved again in
+		their transfer, failures are reported in TransferFailed
+		"""
+		executor = self._getExecutor()
+		futures = []
+		remote = []
+		for f in files:
+			if f.path is None:
+				raise PathNotSet()
+			localFile = self._localFile(f.id)
+			if localFile is not None:
+				futures.append(([f], executor.submit(
+					self._transferLocal, localFile, f, local, transfer, histogram)))
+			else:
+				remote.append(f)
+		byHost = dict()
+		addresses = self._getServerAddresses([f.id for f in remote])
+		for f in remote:
+			if f.id in addresses:
+				byHost.setdefault(addresses[f.id], []).append(f)
+			else:
+				futures.append(([f], executor.submit(
+					self._transferResolved, f, transfer, histogram)))
+
+		# Submit round-robin across hosts, so that transfers waiting for
+		# a host's semaphore do not hold up transfers from other hosts
+		queues = []
+		for address, hostFiles in byHost.items():
+			if transferBatch is not None and len(hostFiles) >= self.archiveMinFiles:
+				queues.append((address, self._batches(hostFiles)))
+			else:
+				queues.append((address, list(hostFiles)))
+		while len(queues) > 0:
+			for address, items in queues:
+				item = items.pop(0)
+				if isinstance(item, list):
+					futures.append((item, executor.submit(
+						self._transferLimited, address, item, transferBatch, histogram)))
+				else:
+					futures.append(([item], executor.submit(
+						self._transferLimited, address, item, transfer, histogram)))
+			queues = [q for q in queues if len(q[1]) > 0]
+
+		errors = []
+		for transferred, future in futures:
+			try:
+				future.result()
+			except TransferFailed as e:
+				errors.extend(e.errors)
+			except Exception as e:
+				errors.extend((f.id, e) for f in transferred)
+		if len(errors) != 0:
+			raise TransferFailed(errors)
+
+	def _batches(self, files):
+		"""Splits files into at most hostConcurrency batches of at least
+		archiveMinFiles and at most archiveMaxFiles files
+		"""
+		size = -(-len(files) // self._hostConcurrency)
+		size = min(max(size, self.archiveMinFiles), self.archiveMaxFiles)
+		return [files[i:i + size] for i in range(0, len(files), size)]
+
+	def _downloadArchive(self, client, files):
+		paths = dict()
+		duplicates = []
+		for f in files:
+			if f.id in paths:
+				duplicates.append(f)
+			else:
+				paths[f.id] = f.path
+		try:
+			client.downloadArchive(paths)
+		except Exception:
+			# e.g. the host doesn't support archives or a file is missing,
+			# download one by one to retry and report errors per file
+			errors = []
+			for id, path in paths.items():
+				try:
+					client.download(id, path)
+				except Exception as e:
+					errors.append((id, e))
+			if len(errors) != 0:
+				raise TransferFailed(errors)
+		for f in duplicates:
+			shutil.copyfile(paths[f.id], f.path)
+
+	def _transferLimited(self, address, f, transfer, histogram=None):
+		with self._hostSemaphore(address):
+			start = time.perf_counter()
+			transfer(self._pool[address], f)
+			if histogram is not None:
+				histogram.observe(time.perf_counter() - start)
+
+	def _transferLocal(self, localFile, f, local, transfer, histogram=None):
+		try:
+			start = time.perf_counter()
+			local(f, localFile)
+			if histogram is not None:
+				histogram.observe(time.perf_counter() - start)
+		except (IOError, OSError):
+			self._transferResolved(f, transfer, histogram)
+
+	def _transferResolved(self, f, transfer, histogram=None):
+		self._transferLimited(self._getServerAddress(f.id), f, transfer, histogram)
+
+	def _download(self, client, id, outF, checksum=None):
+		if self._cacheDir is None or not isinstance(outF, str):
+			client.download(id, outF)
+			return
+		if checksum is not None:
+			self._downloadByChecksum(client, id, outF, checksum)
+			return
+		cachePath = join(self._cacheDir, str(id))
+		validators = None
+		if exists(cachePath):
+			try:
+				validators = loadJSONData(cachePath + '.json')
+			except (IOError, ValueError):
+				pass
+		partPath = '%s.%s.part' % (cachePath, uuid4().hex)
+		try:
+			validators = client.download(id, partPath, validators=validators)
+			if validators is not None:
+				os.rename(partPath, cachePath)
+				storeJSONData(cachePath + '.json', validators)
+		finally:
+			if exists(partPath):
+				os.unlink(partPath)
+		# Processors may modify their inFiles, don't share data with the cache
+		linkFile(cachePath, outF, hardLink=False)
+
+	def _downloadByChecksum(self, client, id, outF, checksum):
+		"""Downloads the file id to the path outF through the cache entry of
+		checksum (as published in redis)
+		A cached copy is only used if the host confirms the checksum, i.e.
+		answers a request with If-None-Match: "<checksum>" with 304.
+		Otherwise the file is downloaded and cached under the checksum sent
+		by the host, if any.
+		"""
+		cachePath = join(self._cacheDir, 'sha256-' + checksum)
+		validators = None
+		if exists(cachePath):
+			validators = {'etag': '"%s"' % checksum}
+		partPath = join(self._cacheDir, '%s.part' % uuid4().hex)
+		try:
+			validators = client.download(id, partPath, validators=validators)
+			if validators is not None:
+				if validators['checksum'] is None:
+					linkFile(partPath, outF, hardLink=False)
+					return
+				cachePath = join(self._cacheDir, 'sha256-' + validators['checksum'])
+				os.rename(partPath, cachePath)
+		finally:
+			if exists(partPath):
+				os.unlink(partPath)
+		linkFile(cachePath, outF, hardLink=False)
+
+	def _downloadLocal(self, id, path):
+		localPath = self._localPath(id)
+		if localPath is None:
+			return False
+		try:
+			# Processors may modify their inFiles, never share data with
+			# the host's file
+			linkFile(localPath, path, hardLink=False)
+			return True
+		except (IOError, OSError):
+			return False
+
+	def _uploadLocal(self, f, path):
+		localFile = self._localFile(f.id)
+		if localFile is None:
+			return False
+		try:
+			self._renameLocal(f, path, localFile)
+			return True
+		except (IOError, OSError):
+			return False
+
+	def _renameLocal(self, f, path, localFile):
+		"""Renames path into the place of the file f on the host localFile
+		(host id, path) and notifies the host
+		Raises IOError if f isn't writable, the upload then falls back to
+		HTTP, which reports the error
+		"""
+		hostId, localPath = localFile
+		if f.type != 'w':
+			raise IOError("File %s is not writable" % f.id)
+		os.rename(path, localPath)
+		try:
+			self._pool[self._getHostAddress(hostId)].commitLocal(f.id)
+		except Exception as e:
+			# The file is in place, the host notices the change when its
+			# cached metadata expires
+			self._logger.warning("Notifying host %s of file %s failed: %s", hostId, f.id, e)
+
+	def _localPath(self, id):
+		"""Returns the path of the file on a host running on this machine,
+		or None
+		"""
+		localFile = self._localFile(id)
+		if localFile is None:
+			return None
+		return localFile[1]
+
+	def _localFile(self, id):
+		"""Returns (host id, path) of the file on a host running on this
+		machine, or None
+		"""
+		if not self._localTransfer:
+			return None
+		paths = self._redis.hgetall('vycodi:file:' + str(id) + ':paths')
+		for hostId, path in paths.items():
+			hostId = decodeRedis(hostId)
+			hostMachine = self._redis.hget('vycodi:host:' + hostId, 'machine')
+			if decodeRedis(hostMachine) == self._machine:
+				return hostId, decodeRedis(path)
+		return None
+
+	def _hostSemaphore(self, address):
+		with self._lock:
+			try:
+				return self._hostSemaphores[address]
+			except KeyError:
+				semaphore = BoundedSemaphore(self._hostConcurrency)
+				self._hostSemaphores[address] = semaphore
+				return semaphore
+
+	def _getExecutor(self):
+		with self._lock:
+			if self._executor is None:
+				self._executor = ThreadPoolExecutor(self._concurrency)
+			return self._executor
+
 	def getFile(self, id, fObj=None):
 		"""Gets file data from redis server
 		id is file id, must be str(.) compatible
@@ -100,7 +489,8 @@ class FileLoader(object):
 		fDict = decodeRedis(self._redis.hgetall('vycodi:file:' + str(id)))
 		if len(fDict) == 0:
 			raise FileNotFound(id)
-		f = File(int(fDict['id']), fDict['name'], fDict['type'], loader=self)
+		f = File(int(fDict['id']), fDict['name'], fDict['type'], loader=self,
+			checksum=fDict.get('checksum') or None)
 		if fObj is not None:
 			if isinstance(fObj, str):
 				f.path = abspath(fObj)
@@ -111,15 +501,48 @@ class FileLoader(object):
 					pass
 		return f
 
+	def _getServerAddresses(self, ids):
+		"""Returns a dict mapping ids to the address of a random host of
+		each file, fetched in two round trips
+		Files without a (registered) host are left out
+		"""
+		if len(ids) == 0:
+			return dict()
+		pipe = self._redis.pipeline(transaction=False)
+		for id in ids:
+			pipe.srandmember('vycodi:file:' + str(id) + ':hosts')
+		hostIds = dict()
+		for id, hostId in zip(ids, pipe.execute()):
+			if hostId is not None:
+				hostIds[id] = hostId.decode('utf-8')
+		uniqueHostIds = list(set(hostIds.values()))
+		pipe = self._redis.pipeline(transaction=False)
+		for hostId in uniqueHostIds:
+			pipe.hgetall('vycodi:host:' + hostId)
+		hostAddresses = dict()
+		for hostId, hostDict in zip(uniqueHostIds, pipe.execute()):
+			if b'address' in hostDict and b'port' in hostDict:
+				hostAddresses[hostId] = (
+					hostDict[b'address'].decode('utf-8'), int(hostDict[b'port']))
+		return dict((id, hostAddresses[hostId]) for id, hostId in hostIds.items()
+			if hostId in hostAddresses)
+
 	def _getServerAddress(self, id):
 		hostId = self._redis.srandmember('vycodi:file:' + str(id) + ':hosts')
 		if hostId is None:
 			raise FileNotAvailable(id)
-		hostId = hostId.decode('utf-8')
+		return self._getHostAddress(hostId.decode('utf-8'))
+
+	def _getHostAddress(self, hostId):
 		hostDict = self._redis.hgetall('vycodi:host:' + hostId)
 		return (hostDict[b'address'].decode('utf-8'), int(hostDict[b'port']))
 
 
+class UploadAborted(FileLoaderException):
+	def __init__(self):
+		super(UploadAborted, self).__init__("UploadAborted")
+
+
 class HTTPClientException(Exception):
 	def __init__(self, retCode, message):
 		super(HTTPClientException, self).__init__()
@@ -130,22 +553,31 @@ class HTTPClientException(Exception):
 class ClientPool(object):
 	def __init__(self):
 		self._clients = dict()
+		self._lock = Lock()
 
 	def __getitem__(self, key):
 		if isinstance(key, tuple):
 			key = key[0] + ':' + str(key[1])
-		if key not in self._clients:
-			self.add(Client(key))
-		return self._clients[key]
+		with self._lock:
+			if key not in self._clients:
+				self._clients[key] = Client(key)
+			return self._clients[key]
 
 	def add(self, client):
 		serverStrAdr = client.serverStrAdr
-		if serverStrAdr in self._clients:
-			del self._clients[serverStrAdr]
-		self._clients[serverStrAdr] = client
+		with self._lock:
+			if serverStrAdr in self._clients:
+				del self._clients[serverStrAdr]
+			self._clients[serverStrAdr] = client
 
 
 class Client(object):
+	"""HTTP client of a host
+	Downloads request the content codings of acceptEncoding and are
+	decompressed while they are written.
+	"""
+	acceptEncoding = compression.acceptEncoding()
+
 	def __init__(self, server):
 		if isinstance(server, tuple):
 			self.serverAdr = server
@@ -160,27 +592,341 @@ class Client(object):
 		self._s = requests.Session()
 		self.baseUrl = 'http://' + self.serverStrAdr + '/'
 
-	def download(self, id, outF):
-		r = self._s.get(self.baseUrl + 'file/' + str(id), stream=True)
-		if not r.status_code == requests.codes.ok:
-			raise HTTPClientException(r.status_code, r.text)
+	def download(self, id, outF, retries=3, validators=None):
+		"""Downloads the file id to outF (a path or a writable file object)
+		validators may be the validators of a cached copy of the file (as
+		returned by this method). If the file is unchanged, nothing is
+		downloaded (and a path outF isn't touched) and None is returned.
+		A path outF is only replaced once the download has succeeded, the
+		content is written to a temporary file next to it meanwhile.
+		Otherwise returns the validators of the downloaded file, a dict with
+		the keys etag, lastModified and checksum.
+		The content is hashed while it is written and compared with the
+		checksum sent by the host, if any. Raises ChecksumMismatch if they
+		differ.
+		If the connection fails, the download is resumed with a Range
+		request, at most retries times. If the file has changed meanwhile,
+		it is downloaded again from the start, which requires outF to be
+		seekable.
+		"""
+		headers = {}
+		if validators is not None:
+			if validators.get('etag') is not None:
+				headers['If-None-Match'] = validators['etag']
+			if validators.get('lastModified') is not None:
+				headers['If-Modified-Since'] = validators['lastModified']
+		r = self._get(id, headers)
+		if r.status_code == requests.codes.not_modified:
+			r.close()
+			return None
 		if isinstance(outF, str):
-			with open(outF, 'wb') as outFO:
-				for chunk in r.iter_content(chunk_size=1 << 20):
-					if chunk:
-						outFO.write(chunk)
-				outFO.flush()
-		else:
-			for chunk in r.iter_content(chunk_size=1 << 20):
-				if chunk:
+			partPath = '%s.%s.part' % (outF, uuid4().hex)
+			try:
+				with open(partPath, 'wb') as outFO:
+					validators = self._download(id, r, outFO, retries)
+				os.replace(partPath, outF)
+				return validators
+			finally:
+				if exists(partPath):
+					os.unlink(partPath)
+		return self._download(id, r, outF, retries)
+
+	def _get(self, id, headers, busyRetries=3):
+		"""Requests the file id, retrying at most busyRetries times while the
+		host answers 503 (all its connections are busy)
+		"""
+		headers = dict(headers)
+		headers.setdefault('Accept-Encoding', self.acceptEncoding)
+		while True:
+			r = self._s.get(self.baseUrl + 'file/' + str(id), stream=True, headers=headers)
+			if r.status_code != requests.codes.service_unavailable or busyRetries <= 0:
+				return r
+			busyRetries -= 1
+			r.close()
+			try:
+				time.sleep(float(r.headers.get('Retry-After', 1)))
+			except ValueError:
+				time.sleep(1)
+
+	def _download(self, id, r, outF, retries):
+		written = 0
+		validators = None
+		hasher = hashlib.sha256()
+		while True:
+			try:
+				if r is None:
+					headers = {'Range': 'bytes=%s-' % written}
+					if validators is not None:
+						headers['If-Range'] = validators['etag'] or validators['lastModified']
+					r = self._get(id, headers)
+				if r.status_code == requests.codes.requested_range_not_satisfiable:
+					# The connection failed after the last byte
+					if r.headers.get('Content-Range') == 'bytes */%s' % written:
+						self._verify(id, hasher, validators['checksum'])
+						return validators
+					raise HTTPClientException(r.status_code, r.text)
+				if r.status_code == requests.codes.ok and written != 0:
+					outF.seek(0)
+					outF.truncate()
+					written = 0
+					hasher = hashlib.sha256()
+				elif r.status_code not in (requests.codes.ok, requests.codes.partial_content):
+					raise HTTPClientException(r.status_code, r.text)
+				if r.status_code == requests.codes.ok or validators is None:
+					validators = {
+						'etag': r.headers.get('ETag'),
+						'lastModified': r.headers.get('Last-Modified'),
+						'checksum': r.headers.get('X-Checksum-SHA256')
+					}
+				for chunk in self._iterContent(r):
 					outF.write(chunk)
-			outF.flush()
-
-	def upload(self, id, inF):
+					hasher.update(chunk)
+					written += len(chunk)
+				outF.flush()
+				self._verify(id, hasher, validators['checksum'])
+				return validators
+			except (requests.exceptions.ConnectionError,
+					requests.exceptions.ChunkedEncodingError):
+				if retries <= 0:
+					raise
+				retries -= 1
+				r = None
+
+	def _verify(self, id, hasher, checksum):
+		if checksum is not None and checksum != hasher.hexdigest():
+			raise ChecksumMismatch(id)
+
+	def downloadArchive(self, paths):
+		"""Downloads the files of paths (a dict mapping file ids to paths)
+		in one tar archive, each file is written to its path while the
+		archive is read
+		Files are verified against the checksums the host stores in the
+		members' extended headers.
+		Raises HTTPClientException if the host doesn't send the archive,
+		e.g. because a file doesn't exist, or the archive lacks a file,
+		ChecksumMismatch if a file doesn't match its checksum
+		"""
+		r = self._s.post(self.baseUrl + 'files', json=list(paths.keys()), stream=True,
+			headers={'Accept-Encoding': self.acceptEncoding})
+		if not r.status_code == requests.codes.ok:
+			raise HTTPClientException(r.status_code, r.text)
+		remaining = dict((str(id), path) for id, path in paths.items())
+		with BufferedReader(DownloadStream(r), buffer_size=1 << 20) as stream:
+			archive = tarfile.open(fileobj=stream, mode='r|')
+			for member in archive:
+				path = remaining.pop(member.name, None)
+				if path is None or not member.isfile():
+					continue
+				memberF = archive.extractfile(member)
+				hasher = hashlib.sha256()
+				with open(path, 'wb') as outF:
+					while True:
+						chunk = memberF.read(1 << 20)
+						if not chunk:
+							break
+						outF.write(chunk)
+						hasher.update(chunk)
+				self._verify(
+					member.name, hasher, member.pax_headers.get('VYCODI.sha256'))
+		if len(remaining) != 0:
+			raise HTTPClientException(
+				None, "Archive lacks files " + ", ".join(sorted(remaining.keys())))
+
+	def _iterContent(self, r):
+		"""Yields the body of the streamed response r, decompressed
+		according to its Content-Encoding
+		"""
+		try:
+			chunks = r.raw.stream(1 << 20, decode_content=False)
+			for chunk in compression.decodeChunks(chunks, r.headers.get('Content-Encoding')):
+				yield chunk
+		except ProtocolError as e:
+			raise requests.exceptions.ChunkedEncodingError(e)
+		except ReadTimeoutError as e:
+			raise requests.exceptions.ConnectionError(e)
+
+	def upload(self, id, inF, encoding=None):
+		"""Uploads inF (a path, a readable file object or an iterable of
+		bytes, e.g. a generator) to the file id
+		Iterables and unseekable file objects (pipes, sockets) are sent as
+		they are read with chunked Transfer-Encoding, their length need not
+		be known in advance. If encoding is set, the body is compressed with
+		this content coding while it is sent.
+		"""
 		if isinstance(inF, str):
 			with open(inF, 'rb') as inFO:
-				r = self._s.post(self.baseUrl + str(id), data=inFO)
+				self._upload(id, inFO, encoding)
 		else:
-			r = self._s.post(self.baseUrl + str(id), data=inF)
+			self._upload(id, inF, encoding)
+
+	def _upload(self, id, inF, encoding):
+		headers = {}
+		if hasattr(inF, 'read') and (encoding is not None or not _seekable(inF)):
+			inF = iterRead(inF)
+		if encoding is not None:
+			if isinstance(inF, bytes):
+				inF = [inF]
+			inF = compression.encodeChunks(inF, encoding)
+			headers['Content-Encoding'] = encoding
+		r = self._s.post(self.baseUrl + 'file/' + str(id), data=inF, headers=headers)
+		if not r.status_code == requests.codes.ok:
+			raise HTTPClientException(r.status_code, r.text)
+
+	def commitLocal(self, id):
+		"""Notifies the host that the file id was replaced on its file
+		system, see FileLoader.upload
+		"""
+		r = self._s.post(self.baseUrl + 'file/' + str(id) + '/local')
+		if not r.status_code == requests.codes.ok:
+			raise HTTPClientException(r.status_code, r.text)
+
+	def openDownload(self, id):
+		r = self._s.get(self.baseUrl + 'file/' + str(id), stream=True,
+			headers={'Accept-Encoding': self.acceptEncoding})
 		if not r.status_code == requests.codes.ok:
 			raise HTTPClientException(r.status_code, r.text)
+		return BufferedReader(DownloadStream(r), buffer_size=1 << 20)
+
+	def openUpload(self, id):
+		return BufferedWriter(
+			UploadStream(self._s, self.baseUrl + 'file/' + str(id)),
+			buffer_size=1 << 20)
+
+
+def _seekable(f):
+	try:
+		return f.seekable()
+	except (AttributeError, ValueError):
+		return False
+
+
+def iterRead(f, chunkSize=1 << 20):
+	"""Yields the contents of the file object f in chunks of at most
+	chunkSize bytes
+	"""
+	while True:
+		chunk = f.read(chunkSize)
+		if not chunk:
+			return
+		yield chunk
+
+
+class DownloadStream(RawIOBase):
+	"""Readable stream of a streamed requests response body
+	"""
+	def __init__(self, response):
+		super(DownloadStream, self).__init__()
+		self._response = response
+		self._decoder = compression.decoder(response.headers.get('Content-Encoding'))
+		self._pending = b''
+		self._offset = 0
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		while self._offset == len(self._pending):
+			data = self._response.raw.read(len(b), decode_content=False)
+			self._offset = 0
+			if self._decoder is None:
+				self._pending = data
+				if not data:
+					return 0
+			elif not data:
+				self._pending = self._decoder.flush()
+				self._decoder = None
+			else:
+				self._pending = self._decoder.decompress(data)
+		n = min(len(b), len(self._pending) - self._offset)
+		b[:n] = memoryview(self._pending)[self._offset:self._offset + n]
+		self._offset += n
+		return n
+
+	def close(self):
+		if not self.closed:
+			self._response.close()
+		super(DownloadStream, self).close()
+
+
+class UploadStream(RawIOBase):
+	"""Writable stream, which uploads all data written as the chunked body
+	of a POST request
+	The request is sent from a separate thread, at most maxPendingChunks
+	chunks are buffered
+	"""
+	def __init__(self, session, url, maxPendingChunks=4):
+		super(UploadStream, self).__init__()
+		self._chunks = Queue(maxPendingChunks)
+		self._response = None
+		self._error = None
+		self._thread = Thread(target=self._post, args=(session, url))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def writable(self):
+		return True
+
+	def write(self, b):
+		if len(b) == 0:
+			return 0
+		chunk = bytes(b)
+		while True:
+			if not self._thread.is_alive():
+				self._raiseForResponse()
+				raise HTTPClientException(None, "Upload request finished prematurely")
+			try:
+				self._chunks.put(chunk, timeout=0.1)
+				return len(chunk)
+			except Full:
+				pass
+
+	def close(self):
+		if self.closed:
+			return
+		super(UploadStream, self).close()
+		self._finish(None)
+		self._raiseForResponse()
+
+	def abort(self):
+		"""Closes the stream without completing the upload
+		The request's connection is closed before the last chunk of the
+		body is sent, the host discards the incomplete body and keeps the
+		previous content of the file.
+		"""
+		if self.closed:
+			return
+		super(UploadStream, self).close()
+		self._finish(self._abortMarker)
+
+	def _finish(self, marker):
+		while self._thread.is_alive():
+			try:
+				self._chunks.put(marker, timeout=0.1)
+				break
+			except Full:
+				pass
+		self._thread.join()
+
+	_abortMarker = object()
+
+	def _iterChunks(self):
+		while True:
+			chunk = self._chunks.get()
+			if chunk is None:
+				return
+			if chunk is self._abortMarker:
+				raise UploadAborted()
+			yield chunk
+
+	def _post(self, session, url):
+		try:
+			self._response = session.post(url, data=self._iterChunks())
+		except Exception as e:
+			self._error = e
+
+	def _raiseForResponse(self):
+		if self._error is not None:
+			raise self._error
+		r = self._response
+		if r is not None and not r.status_code == requests.codes.ok:
+			raise HTTPClientException(r.status_code, r.text)
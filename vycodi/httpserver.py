@@ -1,25 +1,100 @@
 from http.server import HTTPServer, SimpleHTTPRequestHandler
-from socketserver import ThreadingMixIn
-from threading import Thread
+from threading import Thread, Semaphore, Lock
+from concurrent.futures import ThreadPoolExecutor
 from vycodi.bucket import BackendError
+from vycodi.compression import encodedETag, identityETag, decoder, decodeChunks
+from vycodi import metrics
+from uuid import uuid4
+from email.utils import parsedate_to_datetime
 import logging
+import socket
+import time
+import tarfile
+import hashlib
+import json
 
 __version__ = "0.2"
 
 
-class ThreadingServer(ThreadingMixIn, HTTPServer):
-	pass
+class PooledServer(HTTPServer):
+	"""HTTP server handling connections in a pool of maxConcurrency threads
+	At most backlog accepted connections wait for a free thread, connections
+	accepted beyond that are answered with a 503 response right away.
+	backlog is also the listen backlog of the socket.
+	Idle keep-alive connections are closed while connections wait for a
+	thread (see HTTPRequestHandler.handle_one_request).
+	"""
+	rejectResponse = (
+		b"HTTP/1.1 503 Service Unavailable\r\n"
+		b"Content-Length: 0\r\n"
+		b"Retry-After: 1\r\n"
+		b"Connection: close\r\n\r\n"
+	)
+
+	def __init__(self, address, handlerClass, maxConcurrency=64, backlog=64):
+		self.request_queue_size = backlog
+		self._slots = Semaphore(maxConcurrency + backlog)
+		self._executor = ThreadPoolExecutor(maxConcurrency)
+		self._waiting = 0
+		self._waitingLock = Lock()
+		super(PooledServer, self).__init__(address, handlerClass)
+
+	def waiting(self):
+		"""Returns the number of accepted connections waiting for a thread
+		"""
+		return self._waiting
+
+	def process_request(self, request, client_address):
+		if not self._slots.acquire(False):
+			self._reject(request)
+			return
+		with self._waitingLock:
+			self._waiting += 1
+		self._executor.submit(self._processRequest, request, client_address)
+
+	def _processRequest(self, request, client_address):
+		with self._waitingLock:
+			self._waiting -= 1
+		try:
+			self.finish_request(request, client_address)
+		except Exception:
+			self.handle_error(request, client_address)
+		finally:
+			self.shutdown_request(request)
+			self._slots.release()
+
+	def _reject(self, request):
+		metrics.httpRejectedConnections.inc()
+		try:
+			request.sendall(self.rejectResponse)
+		except OSError:
+			pass
+		self.shutdown_request(request)
+
+	def server_close(self):
+		super(PooledServer, self).server_close()
+		self._executor.shutdown(wait=False)
 
 
 class Server(Thread):
-	def __init__(self, address, bucket):
+	"""Serves the files of bucket over HTTP/1.1, connections are handled by
+	at most maxConcurrency threads and kept alive for keepAliveTimeout
+	seconds between requests
+	If compression (vycodi.compression.CompressionRules) is set, responses
+	are compressed according to it
+	"""
+	def __init__(self, address, bucket, maxConcurrency=64, backlog=64, keepAliveTimeout=5.0,
+			compression=None):
 		super(Server, self).__init__()
 
 		class Handler(HTTPRequestHandler):
 			pass
 
 		Handler.bucket = bucket
-		self._server = ThreadingServer(address, Handler)
+		Handler.keepAliveTimeout = keepAliveTimeout
+		Handler.compression = compression
+		self._server = PooledServer(
+			address, Handler, maxConcurrency=maxConcurrency, backlog=backlog)
 		self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
 
 	def run(self):
@@ -29,6 +104,7 @@ class Server(Thread):
 	def shutdown(self):
 		self._logger.info("Shutting down...")
 		self._server.shutdown()
+		self._server.server_close()
 
 
 class HTTPRequestHandler(SimpleHTTPRequestHandler):
@@ -45,14 +121,116 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
 	"""
 
 	server_version = "vycodiHTTP/" + str(__version__)
+	protocol_version = "HTTP/1.1"
+	# Headers and body are written separately, which stalls on persistent
+	# connections with Nagle's algorithm
+	disable_nagle_algorithm = True
+	keepAliveTimeout = 5.0
+	idleCheckInterval = 0.05
+	transferTimeout = None
 	error_content_type = "text/plain"
 	error_message_format = "[%(code)d] %(message)s - %(explain)s"
 	buffer_size = 1024 * 1024
+	use_sendfile = True
+	maxRanges = 100
+	maxArchiveRequest = 1 << 20
+	compression = None
 
 	def __init__(self, *args, **kwargs):
 		self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
 		super(HTTPRequestHandler, self).__init__(*args, **kwargs)
 
+	def setup(self):
+		super(HTTPRequestHandler, self).setup()
+		self._requestsHandled = 0
+		metrics.httpActiveConnections.inc()
+
+	def handle_one_request(self):
+		if not self._awaitRequest():
+			self.close_connection = True
+			return
+		super(HTTPRequestHandler, self).handle_one_request()
+		self._requestsHandled += 1
+
+	def _awaitRequest(self):
+		"""Waits for the next request for at most keepAliveTimeout seconds
+		Returns False if the connection is to be closed: the client closed
+		it, it timed out or it's an idle keep-alive connection while other
+		connections wait for a thread of the server's pool
+		"""
+		try:
+			# Non-blocking, the request may already be buffered
+			self.connection.settimeout(0.0)
+			if self.rfile.peek(1):
+				return True
+			deadline = time.monotonic() + self.keepAliveTimeout
+			while True:
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					return False
+				waiting = getattr(self.server, 'waiting', None)
+				if self._requestsHandled > 0 and waiting is not None and waiting() > 0:
+					return False
+				# Peek at the socket directly, a timeout would make rfile
+				# unusable
+				self.connection.settimeout(min(remaining, self.idleCheckInterval))
+				try:
+					return len(self.connection.recv(1, socket.MSG_PEEK)) != 0
+				except socket.timeout:
+					pass
+		except (ConnectionResetError, BrokenPipeError):
+			return False
+
+	def parse_request(self):
+		self.connection.settimeout(self.transferTimeout)
+		return super(HTTPRequestHandler, self).parse_request()
+
+	def finish(self):
+		try:
+			super(HTTPRequestHandler, self).finish()
+		finally:
+			metrics.httpActiveConnections.dec()
+
+	def copyfile(self, source, outputfile):
+		"""Copies source to outputfile
+		Files with a file descriptor (files of the FileSystemBackend) are
+		sent with sendfile, without copying the data through Python
+		"""
+		if isinstance(source, PartsReader):
+			for part in source.parts():
+				if isinstance(part, bytes):
+					outputfile.write(part)
+				else:
+					self.copyfile(part, outputfile)
+					if part.remaining > 0:
+						raise EOFError("File is shorter than announced")
+			return
+		if isinstance(source, RangeReader):
+			f, count = source.file, source.remaining
+		else:
+			f, count = source, None
+		if self.use_sendfile and self._hasFileno(f):
+			outputfile.flush()
+			offset = f.tell()
+			sent = self.connection.sendfile(f, offset=offset, count=count)
+			metrics.httpSentBytes.inc(n=sent)
+			if isinstance(source, RangeReader):
+				source.remaining -= sent
+			return
+		while True:
+			buf = source.read(self.buffer_size)
+			if not buf:
+				break
+			outputfile.write(buf)
+			metrics.httpSentBytes.inc(n=len(buf))
+
+	def _hasFileno(self, f):
+		try:
+			f.fileno()
+			return True
+		except (AttributeError, OSError):
+			return False
+
 	def do_GET(self):
 		"""Serve a GET request."""
 		f = self.send_head()
@@ -70,15 +248,81 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
 
 	def do_POST(self):
 		"""Serve a POST request."""
-		r = self.do_upload()
+		if self.path.split('?', 1)[0].rstrip('/') == '/files':
+			f = self.send_archive()
+			if f:
+				try:
+					self.copyfile(f, self.wfile)
+				except EOFError as e:
+					self.log_error("Archive truncated: %s", str(e))
+					self.close_connection = True
+				finally:
+					f.close()
+			return
+		if localCommitFileId(self.path) is not None:
+			r = self.do_commitLocal()
+		else:
+			r = self.do_upload()
 		if r:
 			self.send_response(200)
 			self.send_header("Content-Type", "text/plain")
 			self.send_header("Content-Length", 0)
 			self.end_headers()
 
+	def send_archive(self):
+		"""Sends the headers of a tar archive of the files whose ids are
+		listed in the JSON request body, returns the archive (see send_head)
+		Members are named after the file ids.
+		"""
+		try:
+			length = int(self.headers['Content-Length'])
+		except (TypeError, ValueError):
+			self.send_error(411)
+			return None
+		if length > self.maxArchiveRequest:
+			self.send_error(413)
+			return None
+		try:
+			ids = parseIdList(self.rfile.read(length))
+		except ValueError:
+			self.send_error(400, explain="Expected a JSON list of file ids")
+			return None
+		try:
+			archive = TarArchive(archiveMembers(self.bucket, ids))
+		except KeyError as e:
+			self.send_error(404, explain="File %s not found or not readable" % e.args[0])
+			return None
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			self.send_error(500, explain="Backend error")
+			return None
+		self.log_message("Sending archive of %s files", len(ids))
+		self.send_response(200)
+		self.send_header("Content-Type", "application/x-tar")
+		self.send_header("Content-Length", archive.length)
+		self.end_headers()
+		return archive
+
 	def do_upload(self):
-		contentLength = int(self.headers['Content-Length'])
+		"""Receives the body of an upload
+		The content of the file is only replaced if the whole body is
+		received, a body ending prematurely (e.g. an aborted UploadStream)
+		leaves the file untouched.
+		"""
+		chunked = 'chunked' in self.headers.get('Transfer-Encoding', '').lower()
+		contentLength = None
+		if not chunked:
+			try:
+				contentLength = int(self.headers['Content-Length'])
+			except (TypeError, ValueError):
+				self.send_error(411, explain="Content-Length or chunked Transfer-Encoding required")
+				return False
+		encoding = self.headers.get('Content-Encoding')
+		try:
+			decoder(encoding)
+		except ValueError:
+			self.send_error(415, explain="Unsupported Content-Encoding")
+			return False
 
 		try:
 			fileId = self._extractFileId()
@@ -86,32 +330,112 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
 			if not fileObj.writable():
 				self.send_error(403, explain="File not writable")
 				return False
-		except (KeyError | UnknownPathException):
+		except (KeyError, ValueError, UnknownPathException):
 			self.send_error(404)
 			return False
 
 		try:
 			self.log_message("Starting upload of %s - %s", fileId, fileObj.name)
 			f = fileObj.openW(contentLength=contentLength)
-			while contentLength > 0:
-				if contentLength < self.buffer_size:
-					chunk = self.rfile.read(contentLength)
-				else:
-					chunk = self.rfile.read(self.buffer_size)
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			self.send_error(500, explain="Backend error")
+			return False
+
+		try:
+			if chunked:
+				chunks = self._readChunked()
+			else:
+				chunks = self._readLength(contentLength)
+			checksum = hashlib.sha256()
+			for chunk in decodeChunks(self._countReceived(chunks), encoding):
+				checksum.update(chunk)
 				f.write(chunk)
-				contentLength -= len(chunk)
+			f.close()
+			fileObj.setChecksum(checksum.hexdigest())
 			self.log_message("Finished upload of %s", fileId)
 			return True
 		except BackendError as e:
-			try:
-				f.close()
-			except:
-				pass
+			self._abortQuietly(f)
+			self.log_error("BackendError: %s", str(e))
+			self._sendErrorQuietly(500, "Backend error")
+			return False
+		except (ValueError, EOFError, OSError) as e:
+			# The previous content of the file is kept
+			self._abortQuietly(f)
+			self.log_error("Malformed request body: %s", str(e))
+			self._sendErrorQuietly(400, "Malformed request body")
+			return False
+
+	def _abortQuietly(self, f):
+		try:
+			f.abort()
+		except Exception as e:
+			self.log_error("Aborting upload failed: %s", str(e))
+
+	def _sendErrorQuietly(self, code, explain):
+		"""Sends an error response, unless the client has disconnected
+		"""
+		self.close_connection = True
+		try:
+			self.send_error(code, explain=explain)
+		except (BrokenPipeError, ConnectionResetError):
+			pass
+
+	def do_commitLocal(self):
+		"""Handles the notification that the file was replaced on the host's
+		file system by a worker on the same machine (see FileLoader.upload)
+		The file's cached metadata is dropped and its checksum recomputed.
+		"""
+		if self.headers.get('Content-Length', '0') != '0' or 'Transfer-Encoding' in self.headers:
+			self.close_connection = True
+		try:
+			fileObj = self.bucket[localCommitFileId(self.path)]
+			if not fileObj.writable():
+				self.send_error(403, explain="File not writable")
+				return False
+		except (KeyError, ValueError):
+			self.send_error(404)
+			return False
+		try:
+			fileObj.recomputeChecksum()
+		except BackendError as e:
 			self.log_error("BackendError: %s", str(e))
 			self.send_error(500, explain="Backend error")
 			return False
-		finally:
-			f.close()
+		self.log_message("Replaced locally %s", fileObj.id)
+		return True
+
+	def _countReceived(self, chunks):
+		for chunk in chunks:
+			metrics.httpReceivedBytes.inc(n=len(chunk))
+			yield chunk
+
+	def _readLength(self, contentLength):
+		while contentLength > 0:
+			chunk = self.rfile.read(min(contentLength, self.buffer_size))
+			if not chunk:
+				raise EOFError("Connection closed before end of body")
+			contentLength -= len(chunk)
+			yield chunk
+
+	def _readChunked(self):
+		"""Yields the decoded body of a request with chunked
+		Transfer-Encoding
+		"""
+		while True:
+			line = self.rfile.readline(65537)
+			if not line:
+				raise EOFError("Connection closed before end of body")
+			chunkSize = int(line.split(b';', 1)[0].strip(), 16)
+			if chunkSize == 0:
+				# Skip trailers
+				while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+					pass
+				return
+			for chunk in self._readLength(chunkSize):
+				yield chunk
+			self.rfile.readline(65537)
 
 	def send_head(self):
 		"""Common code for GET and HEAD commands.
@@ -130,30 +454,121 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
 			if not fileObj.readable():
 				self.send_error(403, explain="File not readable")
 				return None
-		except (KeyError | UnknownPathException):
+		except (KeyError, ValueError, UnknownPathException):
 			self.send_error(404)
 			return None
 		url = fileObj.genReadURL()
 		if url is not None:
 			self.send_response(302)
 			self.send_header("Location", url)
+			self.send_header("Content-Length", 0)
+			self.end_headers()
 			return None
 		try:
-			f = fileObj.openR()
+			metadata = fileObj.metadata()
+			size = metadata.size
+			modified = metadata.lastModified
+			lastModified = self.date_time_string(modified)
+			etag = fileObj.etag()
+			checksum = fileObj.checksum()
+			contentType = metadata.contentType
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			self.send_error(500, explain="Backend error")
+			return None
+		encoding = None
+		vary = self.compression is not None and self.compression.applies(contentType, size)
+		if vary and 'Range' not in self.headers:
+			encoding = self.compression.choose(
+				self.headers.get('Accept-Encoding'), contentType, size)
+		if notModified(self.headers, etag, modified):
+			self.send_response(304)
+			self.send_header("ETag", encodedETag(etag, encoding))
+			self.send_header("Last-Modified", lastModified)
+			if vary:
+				self.send_header("Vary", "Accept-Encoding")
+			self.end_headers()
+			return None
+		if encoding is not None:
+			return self._sendEncoded(fileObj, encoding, contentType, etag, lastModified, checksum)
+		ranges = None
+		if 'Range' in self.headers and ifRangeMatches(self.headers, etag, lastModified):
+			ranges = parseRange(self.headers['Range'], size, self.maxRanges)
+			if ranges is not None and len(ranges) == 0:
+				self.send_response(416)
+				self.send_header("Content-Range", "bytes */%s" % size)
+				self.send_header("Content-Length", 0)
+				self.end_headers()
+				return None
+		try:
+			if ranges is None:
+				f = fileObj.openR()
+			elif len(ranges) == 1:
+				start, end = ranges[0]
+				f = RangeReader(fileObj.openR(offset=start, length=end - start + 1), end - start + 1)
+			else:
+				f = MultiRangeReader(fileObj, ranges, contentType, size)
 		except BackendError as e:
-			try:
-				f.close()
-			except:
-				pass
 			self.log_error("BackendError: %s", str(e))
 			self.send_error(500, explain="Backend error")
 			return None
 		try:
 			self.log_message("Sending headers for %s - %s", fileId, fileObj.name)
+			if ranges is None:
+				self.send_response(200)
+				self.send_header("Content-Type", contentType)
+				self.send_header("Content-Length", size)
+			elif len(ranges) == 1:
+				self.send_response(206)
+				self.send_header("Content-Type", contentType)
+				self.send_header("Content-Range", "bytes %s-%s/%s" % (ranges[0][0], ranges[0][1], size))
+				self.send_header("Content-Length", f.length)
+			else:
+				self.send_response(206)
+				self.send_header(
+					"Content-Type", "multipart/byteranges; boundary=%s" % f.boundary)
+				self.send_header("Content-Length", f.length)
+			self.send_header("Accept-Ranges", "bytes")
+			self.send_header("ETag", etag)
+			self.send_header("Last-Modified", lastModified)
+			if checksum is not None:
+				self.send_header("X-Checksum-SHA256", checksum)
+			if vary:
+				self.send_header("Vary", "Accept-Encoding")
+			self.end_headers()
+			return f
+		except:
+			f.close()
+			raise
+
+	def _sendEncoded(self, fileObj, encoding, contentType, etag, lastModified, checksum=None):
+		"""Sends the headers of the file compressed with encoding, returns
+		the file object of the body (see send_head)
+		checksum is the checksum of the uncompressed content
+		"""
+		try:
+			f, length = self.compression.open(fileObj, etag, encoding)
+		except BackendError as e:
+			self.log_error("BackendError: %s", str(e))
+			self.send_error(500, explain="Backend error")
+			return None
+		try:
+			self.log_message("Sending headers for %s - %s (%s)", fileObj.id, fileObj.name, encoding)
 			self.send_response(200)
-			self.send_header("Content-Type", fileObj.contentType())
-			self.send_header("Content-Length", fileObj.size())
-			self.send_header("Last-Modified", self.date_time_string(fileObj.lastModified()))
+			self.send_header("Content-Type", contentType)
+			self.send_header("Content-Encoding", encoding)
+			if length is not None:
+				self.send_header("Content-Length", length)
+			elif self.request_version == 'HTTP/1.1':
+				self.send_header("Transfer-Encoding", "chunked")
+				f = ChunkedReader(f)
+			else:
+				self.close_connection = True
+			self.send_header("ETag", encodedETag(etag, encoding))
+			self.send_header("Last-Modified", lastModified)
+			if checksum is not None:
+				self.send_header("X-Checksum-SHA256", checksum)
+			self.send_header("Vary", "Accept-Encoding")
 			self.end_headers()
 			return f
 		except:
@@ -182,3 +597,248 @@ class HTTPRequestHandler(SimpleHTTPRequestHandler):
 
 class UnknownPathException(Exception):
 	pass
+
+
+def localCommitFileId(path):
+	"""Returns the file id of a /file/<id>/local path (see
+	HTTPRequestHandler.do_commitLocal) or None
+	"""
+	path = path.split('?', 1)[0].strip('/')
+	if path.startswith('file/') and path.endswith('/local'):
+		return path[5:-6]
+	return None
+
+
+def notModified(headers, etag, modified):
+	"""Returns whether the request's If-None-Match or, if not present,
+	If-Modified-Since header matches the file with etag, last modified at
+	modified (unix time)
+	"""
+	ifNoneMatch = headers.get('If-None-Match')
+	if ifNoneMatch is not None:
+		# Entity tags of compressed representations match, as the clients
+		# store the decompressed data
+		tags = [identityETag(t.strip()) for t in ifNoneMatch.split(',')]
+		return '*' in tags or etag in tags or 'W/' + etag in tags
+	ifModifiedSince = headers.get('If-Modified-Since')
+	if ifModifiedSince is not None:
+		try:
+			since = parsedate_to_datetime(ifModifiedSince).timestamp()
+		except (TypeError, ValueError, IndexError):
+			return False
+		return int(modified) <= since
+	return False
+
+
+def ifRangeMatches(headers, etag, lastModified):
+	"""Returns whether the ranges of the request apply, i.e. there is no
+	If-Range header or its validator (entity tag or date) matches the file's
+	"""
+	validator = headers.get('If-Range')
+	return validator is None or identityETag(validator.strip()) in (etag, lastModified)
+
+
+def parseRange(header, size, maxRanges=100):
+	"""Parses the value of a Range header
+	Returns a list of satisfiable (start, end) tuples (end inclusive), which
+	is empty if no range is satisfiable, or None if the header is invalid or
+	not supported (and should be ignored)
+	"""
+	unit, _, specs = header.partition('=')
+	if unit.strip().lower() != 'bytes':
+		return None
+	specs = specs.split(',')
+	if len(specs) > maxRanges:
+		return None
+	ranges = []
+	for spec in specs:
+		start, sep, end = spec.strip().partition('-')
+		if not sep:
+			return None
+		try:
+			if start == '':
+				suffixLength = int(end)
+				if suffixLength > 0 and size > 0:
+					ranges.append((max(size - suffixLength, 0), size - 1))
+			else:
+				start = int(start)
+				end = int(end) if end != '' else None
+				if end is not None and end < start:
+					return None
+				if end is None:
+					end = size - 1
+				if start < size:
+					ranges.append((start, min(end, size - 1)))
+		except ValueError:
+			return None
+	return ranges
+
+
+class RangeReader(object):
+	"""Reads at most length bytes from the file object file
+	"""
+	def __init__(self, file, length):
+		self.length = length
+		self.file = file
+		self.remaining = length
+
+	def read(self, n=-1):
+		if self.remaining <= 0:
+			return b''
+		if n < 0 or n > self.remaining:
+			n = self.remaining
+		data = self.file.read(n)
+		self.remaining -= len(data)
+		return data
+
+	def close(self):
+		self.file.close()
+
+
+class ChunkedReader(object):
+	"""Reads the contents of the file object file with chunked
+	Transfer-Encoding
+	"""
+	def __init__(self, file):
+		self.file = file
+		self._done = False
+
+	def read(self, n=-1):
+		if self._done:
+			return b''
+		data = self.file.read(n)
+		if not data:
+			self._done = True
+			return b'0\r\n\r\n'
+		return b'%x\r\n' % len(data) + data + b'\r\n'
+
+	def close(self):
+		self.file.close()
+
+
+class PartsReader(object):
+	"""Reads a body made of parts, bytes or ranges of files
+	Subclasses set _parts to a list of bytes and (fileObj, offset, length)
+	tuples and length to the total length. Ranges are opened one after
+	another.
+	"""
+	def __init__(self):
+		self._parts = []
+		self.length = 0
+		self._current = None
+		self._iter = self.parts()
+		self._reading = None
+
+	def _addBytes(self, data):
+		self._parts.append(data)
+		self.length += len(data)
+
+	def _addRange(self, fileObj, offset, length):
+		self._parts.append((fileObj, offset, length))
+		self.length += length
+
+	def parts(self):
+		"""Yields the parts of the body, bytes or RangeReaders, which are
+		closed when the next part is requested
+		"""
+		for part in self._parts:
+			if isinstance(part, bytes):
+				yield part
+				continue
+			fileObj, offset, length = part
+			self._current = RangeReader(fileObj.openR(offset=offset, length=length), length)
+			try:
+				yield self._current
+			finally:
+				self._current.close()
+				self._current = None
+
+	def read(self, n=-1):
+		while True:
+			if self._reading is not None:
+				data = self._reading.read(n)
+				if data:
+					return data
+				if self._reading.remaining > 0:
+					raise EOFError("File is shorter than announced")
+				self._reading = None
+			part = next(self._iter, None)
+			if part is None:
+				return b''
+			if isinstance(part, bytes):
+				return part
+			self._reading = part
+
+	def close(self):
+		self._iter.close()
+
+
+class MultiRangeReader(PartsReader):
+	"""Reads the multipart/byteranges body of the ranges of fileObj
+	"""
+	def __init__(self, fileObj, ranges, contentType, size):
+		super(MultiRangeReader, self).__init__()
+		self.boundary = uuid4().hex
+		for start, end in ranges:
+			self._addBytes((
+				"\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %s-%s/%s\r\n\r\n"
+				% (self.boundary, contentType, start, end, size)
+			).encode('latin-1'))
+			self._addRange(fileObj, start, end - start + 1)
+		self._addBytes(("\r\n--%s--\r\n" % self.boundary).encode('latin-1'))
+
+
+class TarArchive(PartsReader):
+	"""Reads a tar archive of files, members is a list of
+	(name, fileObj, size, modified, checksum) tuples
+	The checksum of a member, if not None, is stored in the extended
+	header field checksumPaxHeader.
+	"""
+	checksumPaxHeader = 'VYCODI.sha256'
+
+	def __init__(self, members):
+		super(TarArchive, self).__init__()
+		for name, fileObj, size, modified, checksum in members:
+			info = tarfile.TarInfo(name)
+			info.size = size
+			info.mtime = int(modified)
+			info.mode = 0o644
+			if checksum is None:
+				self._addBytes(info.tobuf(format=tarfile.GNU_FORMAT))
+			else:
+				info.pax_headers = {self.checksumPaxHeader: checksum}
+				self._addBytes(info.tobuf(format=tarfile.PAX_FORMAT))
+			self._addRange(fileObj, 0, size)
+			if size % tarfile.BLOCKSIZE != 0:
+				self._addBytes(b'\0' * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+		self._addBytes(b'\0' * (2 * tarfile.BLOCKSIZE))
+
+
+def archiveMembers(bucket, ids):
+	"""Returns the members of a TarArchive of the files ids of bucket,
+	named after their ids
+	Raises KeyError with the id of the first file which doesn't exist or
+	isn't readable, BackendError if a file's metadata can't be read
+	"""
+	members = []
+	for id in ids:
+		try:
+			fileObj = bucket[str(id)]
+		except (KeyError, ValueError):
+			raise KeyError(id)
+		if not fileObj.readable():
+			raise KeyError(id)
+		metadata = fileObj.metadata()
+		members.append((
+			str(id), fileObj, metadata.size, metadata.lastModified, fileObj.checksum()))
+	return members
+
+
+def parseIdList(body):
+	"""Parses the JSON list of file ids of an archive request
+	Raises ValueError if body is not a JSON list of ids
+	"""
+	ids = json.loads(body.decode('utf-8'))
+	if not isinstance(ids, list) or not all(isinstance(id, (int, str)) for id in ids):
+		raise ValueError("Expected a JSON list of file ids")
+	return ids
@@ -0,0 +1,324 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock, local
+import weakref
+import logging
+import time
+
+
+class Registry(object):
+	def __init__(self):
+		self._metrics = []
+		self._lock = Lock()
+
+	def register(self, metric):
+		with self._lock:
+			self._metrics.append(metric)
+		return metric
+
+	def render(self):
+		with self._lock:
+			metrics = list(self._metrics)
+		lines = []
+		for metric in metrics:
+			lines.append("# HELP %s %s" % (metric.name, metric.help))
+			lines.append("# TYPE %s %s" % (metric.name, metric.type))
+			lines.extend(metric.render())
+		return "\n".join(lines) + "\n"
+
+
+defaultRegistry = Registry()
+
+
+def _labelStr(names, values, extra=None):
+	pairs = list(zip(names, values))
+	if extra is not None:
+		pairs.append(extra)
+	if len(pairs) == 0:
+		return ""
+	return "{" + ",".join(
+		'%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+		for k, v in pairs
+	) + "}"
+
+
+def _fmt(value):
+	if isinstance(value, float):
+		if value == float('inf'):
+			return "+Inf"
+		return repr(value)
+	return str(value)
+
+
+class _Sentinel(object):
+	pass
+
+
+class ThreadShardedMetric(object):
+	"""Base class of metrics whose values are kept in per thread shards
+	A shard is a dict mapping label values to the metric's value, updating
+	it takes no lock. Shards are aggregated on scrape, shards of finished
+	threads are folded into a shared total.
+	"""
+	type = 'untyped'
+
+	def __init__(self, name, help, labels=(), registry=defaultRegistry):
+		self.name = name
+		self.help = help
+		self.labels = tuple(labels)
+		self._local = local()
+		self._shards = set()
+		self._retired = dict()
+		self._lock = Lock()
+		if registry is not None:
+			registry.register(self)
+
+	def _shard(self):
+		try:
+			return self._local.shard
+		except AttributeError:
+			pass
+		shard = _Shard()
+		sentinel = _Sentinel()
+		self._local.shard = shard
+		self._local.sentinel = sentinel
+		with self._lock:
+			self._shards.add(shard)
+		# sentinel is only referenced by the thread local, which is cleared
+		# when the thread finishes
+		weakref.finalize(sentinel, self._retire, shard)
+		return shard
+
+	def _retire(self, shard):
+		with self._lock:
+			self._shards.discard(shard)
+			for key, value in list(shard.items()):
+				self._retired[key] = self._merge(self._retired.get(key), value)
+
+	def _collect(self):
+		with self._lock:
+			shards = list(self._shards)
+			totals = dict(self._retired)
+		for shard in shards:
+			for key, value in list(shard.items()):
+				totals[key] = self._merge(totals.get(key), value)
+		return totals
+
+	def _merge(self, a, b):
+		raise NotImplementedError()
+
+	def threadValue(self, *labelValues):
+		"""Returns the value of the current thread's shard
+		"""
+		return self._shard().get(labelValues, 0)
+
+
+class _Shard(dict):
+	__hash__ = object.__hash__
+	__eq__ = object.__eq__
+
+
+class Counter(ThreadShardedMetric):
+	type = 'counter'
+
+	def inc(self, *labelValues, n=1):
+		shard = self._shard()
+		shard[labelValues] = shard.get(labelValues, 0) + n
+
+	def _merge(self, a, b):
+		return (a or 0) + b
+
+	def render(self):
+		return [
+			"%s%s %s" % (self.name, _labelStr(self.labels, key), _fmt(value))
+			for key, value in sorted(self._collect().items())
+		]
+
+
+class Histogram(ThreadShardedMetric):
+	type = 'histogram'
+	defaultBuckets = (
+		0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+		1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 1000.0
+	)
+
+	def __init__(self, name, help, labels=(), buckets=None, registry=defaultRegistry):
+		super(Histogram, self).__init__(name, help, labels=labels, registry=registry)
+		self.buckets = tuple(buckets or self.defaultBuckets)
+
+	def observe(self, value, *labelValues):
+		shard = self._shard()
+		try:
+			counts = shard[labelValues]
+		except KeyError:
+			# bucket counts, followed by sum and count
+			counts = [0] * (len(self.buckets) + 2)
+			shard[labelValues] = counts
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				counts[i] += 1
+				break
+		counts[-2] += value
+		counts[-1] += 1
+
+	def time(self, *labelValues):
+		"""Context manager observing the duration of its block
+		"""
+		return _Timer(self, labelValues)
+
+	def _merge(self, a, b):
+		if a is None:
+			return list(b)
+		return [x + y for x, y in zip(a, b)]
+
+	def render(self):
+		lines = []
+		for key, counts in sorted(self._collect().items()):
+			cumulative = 0
+			for bound, count in zip(self.buckets, counts):
+				cumulative += count
+				lines.append("%s_bucket%s %s" % (
+					self.name, _labelStr(self.labels, key, ('le', _fmt(float(bound)))), cumulative))
+			lines.append("%s_bucket%s %s" % (
+				self.name, _labelStr(self.labels, key, ('le', '+Inf')), counts[-1]))
+			lines.append("%s_sum%s %s" % (self.name, _labelStr(self.labels, key), _fmt(counts[-2])))
+			lines.append("%s_count%s %s" % (self.name, _labelStr(self.labels, key), counts[-1]))
+		return lines
+
+
+class _Timer(object):
+	def __init__(self, histogram, labelValues):
+		self._histogram = histogram
+		self._labelValues = labelValues
+
+	def __enter__(self):
+		self._start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self._histogram.observe(time.perf_counter() - self._start, *self._labelValues)
+		return False
+
+
+class Gauge(object):
+	"""Gauge set directly or evaluated on scrape by calling function
+	"""
+	type = 'gauge'
+
+	def __init__(self, name, help, function=None, registry=defaultRegistry):
+		self.name = name
+		self.help = help
+		self.labels = ()
+		self._value = 0
+		self._function = function
+		self._lock = Lock()
+		if registry is not None:
+			registry.register(self)
+
+	def setFunction(self, function):
+		self._function = function
+
+	def inc(self, n=1):
+		with self._lock:
+			self._value += n
+
+	def dec(self, n=1):
+		with self._lock:
+			self._value -= n
+
+	def set(self, value):
+		self._value = value
+
+	def value(self):
+		if self._function is not None:
+			return self._function()
+		return self._value
+
+	def render(self):
+		return ["%s %s" % (self.name, _fmt(self.value()))]
+
+
+def countingConnectionClass(counter):
+	"""Returns a redis connection class, which increments counter for each
+	round trip (each command or pipeline sent)
+	"""
+	from redis.connection import Connection
+
+	class CountingConnection(Connection):
+		def send_packed_command(self, *args, **kwargs):
+			counter.inc()
+			return super(CountingConnection, self).send_packed_command(*args, **kwargs)
+
+	return CountingConnection
+
+
+# Worker metrics
+tasksProcessed = Counter(
+	'vycodi_tasks_processed_total', "Tasks processed successfully", ('processor',))
+tasksFailed = Counter(
+	'vycodi_tasks_failed_total', "Tasks failed", ('processor', 'type'))
+reservationSeconds = Histogram(
+	'vycodi_reservation_seconds', "Duration of successful task reservations")
+downloadSeconds = Histogram(
+	'vycodi_download_seconds', "Duration of file downloads by workers")
+uploadSeconds = Histogram(
+	'vycodi_upload_seconds', "Duration of file uploads by workers")
+poolUtilization = Gauge(
+	'vycodi_pool_utilization', "Fraction of worker threads processing a task")
+redisRoundTrips = Counter(
+	'vycodi_redis_round_trips_total', "Round trips to the redis server")
+taskRedisRoundTrips = Histogram(
+	'vycodi_task_redis_round_trips', "Redis round trips of a worker thread per task",
+	buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+# Host metrics
+httpSentBytes = Counter(
+	'vycodi_http_sent_bytes_total', "File bytes sent by the host")
+httpReceivedBytes = Counter(
+	'vycodi_http_received_bytes_total', "File bytes received by the host")
+httpActiveConnections = Gauge(
+	'vycodi_http_active_connections', "Open connections of the host")
+httpRejectedConnections = Counter(
+	'vycodi_http_rejected_connections_total', "Connections rejected with 503 by the host")
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split('?', 1)[0] != '/metrics':
+			self.send_error(404)
+			return
+		body = self.registry.render().encode('utf-8')
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", len(body))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+class MetricsServer(Thread):
+	"""Serves the metrics of registry at /metrics
+	"""
+	def __init__(self, address, registry=defaultRegistry):
+		super(MetricsServer, self).__init__()
+
+		class Handler(MetricsRequestHandler):
+			pass
+
+		Handler.registry = registry
+		self._server = ThreadingServer(address, Handler)
+		self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+
+	def run(self):
+		self._logger.info("Starting...")
+		self._server.serve_forever()
+
+	def shutdown(self):
+		self._logger.info("Shutting down...")
+		self._server.shutdown()
@@ -1,17 +1,36 @@
-from vycodi.queue import Failure, Task
+from vycodi.queue import Failure, Task, QueueTimeout
+from vycodi.httpclient import TransferFailed
+from vycodi.utils import processRSS
+from vycodi import metrics
 from os.path import join
 from importlib import import_module
+import multiprocessing
 import pkg_resources
 import logging
+import time
+from types import GeneratorType
 from time import sleep
 
 
 class ProcessingException(Exception):
+	failureType = 'ProcessingException'
+
 	def __init__(self, *args, requeue=True, **kwargs):
 		super(ProcessingException, self).__init__(*args, **kwargs)
 		self.requeue = requeue
 
 
+class TransferException(ProcessingException):
+	failureType = 'TransferFailed'
+
+
+class TaskCancelled(ProcessingException):
+	failureType = 'Cancelled'
+
+	def __init__(self, *args, **kwargs):
+		super(TaskCancelled, self).__init__(*args, requeue=False, **kwargs)
+
+
 class ProcessingManager(object):
 	def __init__(self, worker, logger=None):
 		self._worker = worker
@@ -22,57 +41,316 @@ class ProcessingManager(object):
 		else:
 			self._logger = logger
 		self._processors = {}
+		self._child = None
 
 	def processTaskReservation(self, reservation):
+		roundTrips = metrics.redisRoundTrips.threadValue()
+		self._processTaskReservation(reservation)
+		metrics.taskRedisRoundTrips.observe(
+			metrics.redisRoundTrips.threadValue() - roundTrips)
+
+	def _processTaskReservation(self, reservation):
+		if self._policy.isolateTask(reservation.task):
+			self._processIsolated(reservation)
+			return
+		proc = self._initProcessor(reservation)
+		if proc is None:
+			return
+		if isinstance(proc, BatchProcessor):
+			self._processBatch(proc, reservation)
+		else:
+			self._processTask(proc, reservation)
+
+	def _initProcessor(self, reservation):
+		"""Returns the processor instance for the reservation's task
+		If initialisation fails, the reservation is checked in as failed and
+		None is returned
+		"""
 		task = reservation.task
 		try:
 			proc = self._processorLoader.init(task.processor, cache=self._processors)
+			self._worker.processorWarmed(task.processor)
+			return proc
 		except ImportError as e:
 			self._logger.warn(
 				"Couldn't import processor '%s' for task '%s': %s"
 				% (task.processor, task.id, e))
-			failure = Failure('UnknownProcessor', message=str(e))
-			task.addFailure(failure)
-			reservation.checkinFailed(failure)
+			self._checkinFailure(reservation, Failure('UnknownProcessor', message=str(e)))
 		except ProcessingException as e:
 			self._logger.warn(
 				"ProcessingException during intialisation for task '%s': %s: %s"
 				% (task.id, e.__class__.__name__, e))
-			failure = Failure('ProcessingException', message="%s: %s" % (e.__class__.__name__, e))
-			task.addFailure(failure)
-			reservation.checkinFailed(failure, requeue=e.requeue)
+			failure = Failure(e.failureType, message="%s: %s" % (e.__class__.__name__, e))
+			self._checkinFailure(reservation, failure, requeue=e.requeue)
 		except Exception as e:
 			self._logger.error(
 				"Exception during intialisation for task '%s': %s: %s"
 				% (task.id, e.__class__.__name__, e), exc_info=True)
 			failure = Failure('InitException', message="%s: %s" % (e.__class__.__name__, e))
-			task.addFailure(failure)
-			reservation.checkinFailed(failure)
+			self._checkinFailure(reservation, failure)
+		self._worker.cleanupTaskDir(task)
+		return None
 
+	def _processTask(self, proc, reservation):
+		task = reservation.task
+		task.stamp('started')
 		try:
-			proc.processTask(task)
-		except ProcessingException as e:
+			self._worker.profiler.run(task.processor, proc.processTask, task)
+		except Exception as e:
+			task.stamp('finished')
+			self._checkinException(reservation, e)
+		else:
+			task.stamp('finished')
+			self._checkinSuccess(reservation)
+
+		self._worker.cleanupTaskDir(task)
+
+	def _processIsolated(self, reservation):
+		"""Runs the task in this manager's child process, which is killed if
+		the task exceeds its timeout
+		"""
+		task = reservation.task
+		if self._child is None:
+			self._child = ProcessorChild(self._worker, logger=self._logger)
+		task.stamp('started')
+		result = self._child.processTask(task, timeout=self._policy.getTaskTimeout(task))
+		task.stamp('finished')
+		if result is None:
+			self._checkinSuccess(reservation)
+			return
+		failureType, message, requeue = result
+		self._logger.warn(
+			"%s during isolated execution of task '%s': %s"
+			% (failureType, task.id, message))
+		self._checkinFailure(reservation, Failure(failureType, message=message), requeue=requeue)
+
+	def shutdown(self):
+		if self._child is not None:
+			self._child.shutdown()
+			self._child = None
+
+	def _processBatch(self, proc, reservation):
+		"""Collects reservations of further tasks for the same processor from
+		the same queue, until proc.batchSize tasks are reserved or
+		proc.batchTimeout has passed, and processes them as one batch
+		The processor's sub-queue is popped blocking, see Queue.reserveTask
+		"""
+		reservations = [reservation]
+		deadline = time.perf_counter() + proc.batchTimeout
+		while len(reservations) < proc.batchSize:
+			remaining = deadline - time.perf_counter()
+			if remaining <= 0:
+				break
+			try:
+				reservations.append(reservation.queue.reserveTask(
+					self._worker, timeout=remaining, processor=reservation.task.processor))
+			except QueueTimeout:
+				break
+
+		tasks = [r.task for r in reservations]
+		for task in tasks:
+			task.stamp('started')
+		try:
+			results = self._worker.profiler.run(reservation.task.processor, proc.processBatch, tasks)
+		except Exception as e:
+			for task in tasks:
+				task.stamp('finished')
+			for r in reservations:
+				self._checkinException(r, e)
+		else:
+			for task in tasks:
+				task.stamp('finished')
+			for r, result in zip(reservations, results):
+				if isinstance(result, Exception):
+					self._checkinException(r, result)
+				else:
+					self._checkinSuccess(r)
+
+		for task in tasks:
+			self._worker.cleanupTaskDir(task)
+
+	def _checkinSuccess(self, reservation):
+		task = reservation.task
+		self._logger.info(
+			"Successfully processed task '%s' from queue '%s', processor '%s'"
+			% (task.id, task.queue, task.processor))
+		reservation.checkinFinished()
+		metrics.tasksProcessed.inc(task.processor)
+
+	def _checkinFailure(self, reservation, failure, requeue=True):
+		task = reservation.task
+		task.addFailure(failure)
+		reservation.checkinFailed(failure, requeue=requeue)
+		metrics.tasksFailed.inc(task.processor, failure.type)
+
+	def _checkinException(self, reservation, e):
+		task = reservation.task
+		if isinstance(e, ProcessingException):
 			self._logger.warn(
 				"ProcessingException during execution of task '%s': %s: %s"
 				% (task.id, e.__class__.__name__, e))
-			failure = Failure('ProcessingException', message="%s: %s" % (e.__class__.__name__, e))
-			task.addFailure(failure)
-			reservation.checkinFailed(failure, requeue=e.requeue)
-		except Exception as e:
+			failure = Failure(e.failureType, message="%s: %s" % (e.__class__.__name__, e))
+			self._checkinFailure(reservation, failure, requeue=e.requeue)
+		else:
 			self._logger.error(
 				"Exception during execution of task '%s': %s: %s"
-				% (task.id, e.__class__.__name__, e), exc_info=True)
+				% (task.id, e.__class__.__name__, e), exc_info=e)
 			failure = Failure('Exception', message="%s: %s" % (e.__class__.__name__, e))
-			task.addFailure(failure)
-			reservation.checkinFailed(failure)
+			self._checkinFailure(reservation, failure)
+
+
+class ProcessorChild(object):
+	"""Reusable child process executing tasks for a ProcessingManager
+	The child is forked from the worker process on first use. A child
+	exceeding the timeout of a task is killed, a new one is started for
+	the next task. Children are also replaced when the worker's policy
+	demands it (policy.recycleChild). Children of cancelled tasks are
+	killed as well, cancellation is checked every cancelCheckInterval
+	seconds.
+	"""
+	cancelCheckInterval = 1.0
+
+	def __init__(self, worker, logger=None):
+		self._worker = worker
+		self._policy = worker.policy
+		self._tasksProcessed = 0
+		if logger is None:
+			self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
 		else:
+			self._logger = logger
+		self._process = None
+		self._conn = None
+
+	def processTask(self, task, timeout=None):
+		"""Runs the task in the child process
+		Lifecycle stamps recorded by the child (e.g. downloaded, computed)
+		are merged into task
+		Returns None on success, otherwise a tuple
+		(failureType, message, requeue)
+		"""
+		if self._process is None:
+			self._start()
+		self._conn.send(task.id)
+		state = self._await(task, timeout)
+		if state == 'timeout':
+			self._logger.warn(
+				"Task '%s' exceeded its timeout of %s s, killing child process"
+				% (task.id, timeout))
+			self._kill()
+			self._cleanupTaskDir(task)
+			return ('Timeout', "Task exceeded timeout of %s s" % timeout, True)
+		if state == 'cancelled':
+			self._logger.info("Task '%s' has been cancelled, killing child process" % task.id)
+			self._kill()
+			self._cleanupTaskDir(task)
+			return (TaskCancelled.failureType, "Task has been cancelled", False)
+		try:
+			result, stamps = self._conn.recv()
+		except EOFError:
+			exitCode = self._process.exitcode
+			self._kill()
+			self._cleanupTaskDir(task)
+			return ('ChildDied', "Child process died, exit code %s" % exitCode, True)
+		for name, t in stamps.items():
+			task.stamp(name, t)
+		self._tasksProcessed += 1
+		if self._policy.recycleChild(task, self._tasksProcessed, processRSS(self._process.pid)):
 			self._logger.info(
-				"Successfully processed task '%s' from queue '%s', processor '%s'"
-				% (task.id, task.queue, task.processor))
-			reservation.checkinFinished()
+				"Recycling child process after %s tasks" % self._tasksProcessed)
+			self.shutdown()
+		return result
 
+	def _await(self, task, timeout):
+		"""Waits for the child's answer for at most timeout seconds
+		Returns 'done', 'timeout' or 'cancelled'
+		"""
+		deadline = None if timeout is None else time.perf_counter() + timeout
+		while True:
+			wait = self.cancelCheckInterval
+			if deadline is not None:
+				wait = min(wait, deadline - time.perf_counter())
+				if wait <= 0:
+					return 'timeout'
+			if self._conn.poll(wait):
+				return 'done'
+			if task.cancelled():
+				return 'cancelled'
+
+	def shutdown(self, timeout=5):
+		if self._process is None:
+			return
+		self._conn.close()
+		self._process.join(timeout)
+		self._kill()
+
+	def _start(self):
+		ctx = multiprocessing.get_context('fork')
+		parentConn, childConn = ctx.Pipe()
+		self._process = ctx.Process(target=self._run, args=(parentConn, childConn))
+		self._process.daemon = True
+		self._process.start()
+		childConn.close()
+		self._conn = parentConn
+
+	def _kill(self):
+		if self._process.is_alive():
+			self._process.kill()
+		self._process.join()
+		self._conn.close()
+		self._process = None
+		self._conn = None
+		self._tasksProcessed = 0
+
+	def _cleanupTaskDir(self, task):
+		# The killed child could not clean up the task's run dir
+		self._worker.crtTaskDir(task)
 		self._worker.cleanupTaskDir(task)
 
+	def _run(self, parentConn, conn):
+		"""Main loop of the child process
+		"""
+		parentConn.close()
+		self._worker.fileLoader.afterFork()
+		processors = {}
+		while True:
+			try:
+				taskId = conn.recv()
+			except EOFError:
+				return
+			task = self._worker.taskLoader[taskId]
+			stamps = dict(task.stamps)
+			result = self._runTask(task, processors)
+			# The stamps recorded here are sent to the parent, which
+			# records the task's latencies at check-in
+			conn.send((result, dict(
+				(name, t) for name, t in task.stamps.items() if stamps.get(name) != t)))
+
+	def _runTask(self, task, processors):
+		try:
+			proc = self._worker.processorLoader.init(task.processor, cache=processors)
+		except ImportError as e:
+			return ('UnknownProcessor', str(e), True)
+		except ProcessingException as e:
+			return (e.failureType, "%s: %s" % (e.__class__.__name__, e), e.requeue)
+		except Exception as e:
+			self._logger.error(
+				"Exception during intialisation for task '%s': %s: %s"
+				% (task.id, e.__class__.__name__, e), exc_info=True)
+			return ('InitException', "%s: %s" % (e.__class__.__name__, e), True)
+
+		try:
+			proc.processTask(task)
+		except ProcessingException as e:
+			return (e.failureType, "%s: %s" % (e.__class__.__name__, e), e.requeue)
+		except Exception as e:
+			self._logger.error(
+				"Exception during execution of task '%s': %s: %s"
+				% (task.id, e.__class__.__name__, e), exc_info=True)
+			return ('Exception', "%s: %s" % (e.__class__.__name__, e), True)
+		finally:
+			self._worker.cleanupTaskDir(task)
+		return None
+
 
 class ClassWrapper(object):
 	def __init__(self, name, cl):
@@ -138,6 +416,13 @@ class Processor(object):
 	def perform(self, *args, **kwargs):
 		pass
 
+	def checkCancelled(self, task):
+		"""Raises TaskCancelled if the task has been cancelled, long running
+		processors should call this from time to time
+		"""
+		if task.cancelled():
+			raise TaskCancelled("Task '%s' has been cancelled" % task.id)
+
 	@classmethod
 	def enqueue(cls, queue, *args, **kwargs):
 		try:
@@ -166,6 +451,7 @@ class FileProcessor(Processor):
 			outFiles=outFiles,
 			**task.payload['kwargs']
 		)
+		task.stamp('computed')
 		self._uploadFiles(outFiles)
 
 	def _prepareFiles(self, task):
@@ -174,9 +460,13 @@ class FileProcessor(Processor):
 		inFiles = []
 		for fileId in task.inFiles:
 			file = fileLoader[fileId]
-			filePath = join(task.runDir, file.name)
-			file.download(file=filePath)
+			file.path = join(task.runDir, file.name)
 			inFiles.append(file)
+		try:
+			fileLoader.downloadMany(inFiles)
+		except TransferFailed as e:
+			raise TransferException(str(e))
+		task.stamp('downloaded')
 		outFiles = []
 		for fileId in task.outFiles:
 			file = fileLoader[fileId]
@@ -185,8 +475,10 @@ class FileProcessor(Processor):
 		return inFiles, outFiles
 
 	def _uploadFiles(self, outFiles):
-		for file in outFiles:
-			file.upload()
+		try:
+			self._worker.fileLoader.uploadMany(outFiles)
+		except TransferFailed as e:
+			raise TransferException(str(e))
 
 	def perform(self, *args, inFiles=None, outFiles=None, **kwargs):
 		pass
@@ -211,6 +503,113 @@ class FileProcessor(Processor):
 		return task
 
 
+class StreamingFileProcessor(FileProcessor):
+	"""FileProcessor which does not stage files in the task run dir
+	perform receives readable binary streams for all inFiles and
+	writable binary streams for all outFiles. Input streams are read
+	directly from the hosts, data written to output streams is uploaded
+	while writing, so transfers overlap with processing.
+	Each stream has a file attribute referencing the File object.
+	"""
+	def processTask(self, task):
+		inFiles, outFiles = self._openStreams(task)
+		try:
+			self.perform(
+				*task.payload['args'],
+				inFiles=inFiles,
+				outFiles=outFiles,
+				**task.payload['kwargs']
+			)
+		except:
+			self._closeStreams(inFiles)
+			self._abortUploads(outFiles)
+			raise
+		self._closeStreams(inFiles)
+		self._finishUploads(outFiles)
+
+	def _openStreams(self, task):
+		fileLoader = self._worker.fileLoader
+		inFiles = []
+		outFiles = []
+		try:
+			for fileId in task.inFiles:
+				file = fileLoader[fileId]
+				stream = file.openDownload()
+				stream.file = file
+				inFiles.append(stream)
+			for fileId in task.outFiles:
+				file = fileLoader[fileId]
+				stream = file.openUpload()
+				stream.file = file
+				outFiles.append(stream)
+		except Exception as e:
+			self._closeStreams(inFiles)
+			self._abortUploads(outFiles)
+			raise TransferException("%s: %s" % (e.__class__.__name__, e))
+		return inFiles, outFiles
+
+	def _closeStreams(self, streams):
+		for stream in streams:
+			try:
+				stream.close()
+			except Exception:
+				pass
+
+	def _abortUploads(self, streams):
+		for stream in streams:
+			try:
+				stream.raw.abort()
+			except Exception:
+				pass
+
+	def _finishUploads(self, outFiles):
+		errors = []
+		for stream in outFiles:
+			try:
+				stream.close()
+			except Exception as e:
+				errors.append((stream.file.id, e))
+		if len(errors) != 0:
+			raise TransferException(str(TransferFailed(errors)))
+
+
+class BatchProcessor(Processor):
+	"""Processor receiving many tasks in one performBatch call
+	Reservations of up to batchSize tasks for the processor are collected
+	for at most batchTimeout seconds
+	"""
+	batchSize = 16
+	batchTimeout = 0.05
+
+	def processTask(self, task):
+		result = self.processBatch([task])[0]
+		if isinstance(result, Exception):
+			raise result
+
+	def processBatch(self, tasks):
+		"""Returns a list with one entry per task, an Exception instance for
+		failed tasks
+		"""
+		results = self.performBatch([task.payload for task in tasks])
+		if results is None:
+			results = [None] * len(tasks)
+		elif len(results) != len(tasks):
+			raise ProcessingException(
+				"performBatch returned %s results for %s tasks" % (len(results), len(tasks)))
+		for task, result in zip(tasks, results):
+			if result is not None and not isinstance(result, Exception):
+				task.result = result
+		return results
+
+	def performBatch(self, payloads):
+		"""payloads is a list of dicts with the keys 'args' and 'kwargs'
+		Return None or a list with one entry per payload: None, a result
+		(stored as the task's result) or an Exception instance, which fails
+		the task
+		"""
+		pass
+
+
 class ResultProcessor(Processor):
 	def __init__(self, worker):
 		self._worker = worker
@@ -220,9 +619,18 @@ class ResultProcessor(Processor):
 			*task.payload['args'],
 			**task.payload['kwargs']
 		)
+		if isinstance(result, GeneratorType):
+			parts = 0
+			for part in result:
+				task.addPartialResult(part)
+				parts += 1
+			result = {'parts': parts}
 		task.result = result
 
 	def perform(self, *args, **kwargs):
+		"""Returns the result dict or a generator, whose items are
+		appended to the task's stream as partial results
+		"""
 		pass
 
 	@classmethod
@@ -234,3 +642,14 @@ class ResultProcessor(Processor):
 			sleep(0.01)
 			result = loader.loadResult(task)
 		return result
+
+	@classmethod
+	def stream(cls, queue, *args, **kwargs):
+		"""Enqueues a task and yields its partial results as they arrive
+		"""
+		task = cls.enqueue(queue, *args, **kwargs)
+		for entry in task.iterStream():
+			if entry['type'] == 'result':
+				yield entry['result']
+			elif entry['type'] == 'end' and entry['status'] == 'failed':
+				raise ProcessingException("Task '%s' failed" % task.id)
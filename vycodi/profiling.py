@@ -0,0 +1,83 @@
+from os.path import join
+from threading import Lock
+import cProfile
+import pstats
+import random
+import logging
+
+
+class ProcessorProfiler(object):
+	"""Profiles a fraction of the tasks of processors with cProfile
+	Profiles are aggregated per processor and written to outDir by dump()
+	as profile.<processor>.pstats, readable with the pstats module.
+	Only one task is profiled at a time, tasks started meanwhile are not
+	sampled. If processors is set, only tasks of these processors are
+	sampled.
+	"""
+	def __init__(self, outDir, fraction=0.0, processors=None):
+		self._outDir = outDir
+		self._fraction = fraction
+		self._processors = processors
+		self._stats = dict()
+		self._lock = Lock()
+		self._profilingLock = Lock()
+		self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+
+	@property
+	def fraction(self):
+		return self._fraction
+
+	def configure(self, fraction, processors=None):
+		self._logger.info(
+			"Profiling %s of tasks of processors %s"
+			% (fraction, processors if processors is not None else "(all)"))
+		self._processors = processors
+		self._fraction = fraction
+
+	def run(self, processor, fn, *args, **kwargs):
+		"""Calls fn, profiling the call if it is sampled
+		"""
+		if not self._sample(processor):
+			return fn(*args, **kwargs)
+		if not self._profilingLock.acquire(False):
+			return fn(*args, **kwargs)
+		try:
+			profile = cProfile.Profile()
+			profile.enable()
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				profile.disable()
+				self._add(processor, profile)
+		finally:
+			self._profilingLock.release()
+
+	def dump(self):
+		"""Writes the aggregated profiles to the out dir
+		Returns the list of written files
+		"""
+		paths = []
+		with self._lock:
+			for processor, stats in self._stats.items():
+				path = join(self._outDir, 'profile.%s.pstats' % processor)
+				stats.dump_stats(path)
+				paths.append(path)
+		return paths
+
+	def reset(self):
+		with self._lock:
+			self._stats = dict()
+
+	def _sample(self, processor):
+		if self._fraction <= 0:
+			return False
+		if self._processors is not None and processor not in self._processors:
+			return False
+		return random.random() < self._fraction
+
+	def _add(self, processor, profile):
+		with self._lock:
+			try:
+				self._stats[processor].add(profile)
+			except KeyError:
+				self._stats[processor] = pstats.Stats(profile)
@@ -1,5 +1,7 @@
 from vycodi.utils import decodeRedis, loadJSONField, storeJSONField, dumpJSON, loadJSON
 from vycodi.httpclient import File
+from vycodi.stats import LatencyHistograms, lifecycleStamps, lifecycleLatencies
+from vycodi import metrics
 from queue import Empty
 import time
 
@@ -10,50 +12,343 @@ class QueueTimeout(Empty):
 
 
 class Queue(object):
+	"""Queue of tasks
+	Tasks of a processor are listed in the queue's sub-queue of the
+	processor (see _listKey), tasks without processor in the queue's list.
+	"""
 	_queuesCache = {}
+	processorsTTL = 5.0
+	# claim(id) claims the task id popped into the working list KEYS[#KEYS]
+	# for the worker ARGV[1]. Tasks already claimed (listed more than once)
+	# are dropped from the working list, revoked tasks are moved to the
+	# cancelled list ARGV[2] and collected in cancelled (their dependents are
+	# failed by _resolveCancelled). Returns 1 if the task was claimed.
+	_claimLua = """
+		local cancelled = {}
+		local function claim(id)
+			local working = KEYS[#KEYS]
+			local key = 'vycodi:task:' .. id
+			if redis.call('HSETNX', key, 'claimed', ARGV[1]) == 0 then
+				redis.call('LREM', working, 1, id)
+				return 0
+			end
+			local revoked = redis.call('SISMEMBER', 'vycodi:tasks:revoked', id) == 1
+			if not revoked then
+				local batch = redis.call('HGET', key, 'batch')
+				revoked = batch and redis.call('SISMEMBER', 'vycodi:batches:revoked', batch) == 1
+			end
+			if revoked then
+				redis.call('HSET', key, 'claimed', 'cancelled')
+				redis.call('SREM', 'vycodi:tasks:revoked', id)
+				redis.call('LREM', working, 1, id)
+				redis.call('LPUSH', ARGV[2], id)
+				table.insert(cancelled, id)
+				return -1
+			end
+			return 1
+		end
+	"""
+	# Dependencies: a waiting task's hash counts its unfinished parents in
+	# 'pending', parents list waiting tasks in task:<id>:children. Check-in
+	# of a parent sets its 'done' field and decrements the children.
+	_deferScript = """
+		for i = 2, #ARGV do
+			local done = redis.call('HGET', 'vycodi:task:' .. ARGV[i], 'done')
+			if done and done ~= 'finished' then
+				return -1
+			end
+		end
+		local pending = 0
+		for i = 2, #ARGV do
+			if not redis.call('HGET', 'vycodi:task:' .. ARGV[i], 'done') then
+				redis.call('RPUSH', 'vycodi:task:' .. ARGV[i] .. ':children', ARGV[1])
+				pending = pending + 1
+			end
+		end
+		redis.call('HSET', KEYS[1], 'pending', pending)
+		return pending
+	"""
+	_resolveScript = """
+		if redis.call('HSETNX', KEYS[1], 'done', ARGV[1]) == 0 then
+			return {}
+		end
+		local children = redis.call('LRANGE', KEYS[2], 0, -1)
+		local resolved = {}
+		for _, id in ipairs(children) do
+			local key = 'vycodi:task:' .. id
+			if not redis.call('HGET', key, 'done') then
+				if ARGV[1] ~= 'finished' or redis.call('HINCRBY', key, 'pending', -1) == 0 then
+					table.insert(resolved, id)
+				end
+			end
+		end
+		return resolved
+	"""
+	_claimScript = _claimLua + """
+		return claim(ARGV[3])
+	"""
+	_popFirstScript = _claimLua + """
+		for i = 1, #KEYS - 1 do
+			while true do
+				local id = redis.call('RPOPLPUSH', KEYS[i], KEYS[#KEYS])
+				if not id then
+					break
+				end
+				if claim(id) == 1 then
+					table.insert(cancelled, 1, id)
+					return cancelled
+				end
+			end
+		end
+		table.insert(cancelled, 1, '')
+		return cancelled
+	"""
 
 	def __init__(self, id, redis, taskLoader=None):
 			self.id = id
 			self._redis = redis
+			self.stats = LatencyHistograms(redis)
+			self._popFirst = redis.register_script(self._popFirstScript)
+			self._claim = redis.register_script(self._claimScript)
+			self._defer = redis.register_script(self._deferScript)
+			self._resolve = redis.register_script(self._resolveScript)
+			self._processors = []
+			self._processorsFetched = None
 			if taskLoader is None:
 				self._taskLoader = TaskLoader(redis)
 			else:
 				self._taskLoader = taskLoader
 
-	def reserveTask(self, worker, timeout=0):
+	def reserveTask(self, worker, timeout=0, processor=None):
 		"""Fetches and reserves the next queue in the task for the
 		passed in worker
-		timeout value resembles socket.socket.settimeout()
+		If processor is set, the task is fetched from the processor's
+		sub-queue
+		timeout value resembles socket.socket.settimeout(), fractional
+		timeouts require Redis 6 or later
 		Returns a TaskReservation object
 		"""
-		if timeout is 0:
-			taskId = self._redis.rpoplpush(
-				'vycodi:queue:' + str(self.id),
-				'vycodi:queue:' + str(self.id) + ':working'
-			)
-		else:
-			if timeout is None:
-				timeout = 0
-			if not (isinstance(timeout, int)
-					or (isinstance(timeout, float) and timeout.is_integer())):
-				raise TypeError('timeout must be an integer value')
-			taskId = self._redis.brpoplpush(
-				'vycodi:queue:' + str(self.id),
-				'vycodi:queue:' + str(self.id) + ':working',
-				timeout=timeout
-			)
-		if taskId is None:
+		deadline = None
+		if timeout is not None and timeout != 0:
+			deadline = time.perf_counter() + timeout
+		while True:
+			if timeout == 0:
+				taskId = self._redis.rpoplpush(
+					self._listKey(processor),
+					'vycodi:queue:' + str(self.id) + ':working'
+				)
+			else:
+				remaining = 0
+				if deadline is not None:
+					remaining = deadline - time.perf_counter()
+					if remaining <= 0:
+						raise QueueTimeout()
+				taskId = self._redis.brpoplpush(
+					self._listKey(processor),
+					'vycodi:queue:' + str(self.id) + ':working',
+					timeout=remaining
+				)
+			if taskId is None:
+				raise QueueTimeout()
+			if self._claimTask(taskId, worker):
+				return self._reserve(taskId, worker)
+
+	def reserveRoutedTask(self, worker, processors, hostId=None):
+		"""Fetches and reserves the next task from the first non-empty
+		sub-queue of processors (None stands for tasks without processor),
+		checking all sub-queues and claiming the task in one round trip
+		If hostId is set, only tasks whose inFiles are hosted on the host
+		hostId are fetched
+		Raises QueueTimeout if no such task is queued
+		Returns a TaskReservation object
+		"""
+		keys = [self._listKey(p, hostId) for p in processors]
+		if len(keys) == 0:
+			raise QueueTimeout()
+		keys.append('vycodi:queue:' + str(self.id) + ':working')
+		popped = self._popFirst(keys=keys, args=[worker.id, self._cancelledKey()])
+		self._resolveCancelled(popped[1:])
+		taskId = popped[0]
+		if len(taskId) == 0:
 			raise QueueTimeout()
+		return self._reserve(taskId, worker)
+
+	def reserveLocalTask(self, worker, hostId, processor=None):
+		"""Fetches and reserves the next task whose inFiles are hosted on the
+		host hostId
+		Raises QueueTimeout if no such task is queued
+		Returns a TaskReservation object
+		"""
+		return self.reserveRoutedTask(worker, [processor], hostId=hostId)
+
+	def processors(self):
+		"""Returns the names of the processors with a sub-queue, refreshed
+		at most every processorsTTL seconds
+		"""
+		now = time.monotonic()
+		if self._processorsFetched is None or now - self._processorsFetched > self.processorsTTL:
+			self._processors = sorted(decodeRedis(list(
+				self._redis.smembers('vycodi:queue:' + str(self.id) + ':processors'))))
+			self._processorsFetched = now
+		return self._processors
+
+	def _listKey(self, processor=None, hostId=None):
+		key = 'vycodi:queue:' + str(self.id)
+		if processor is not None:
+			key += ':processor:' + str(processor)
+		if hostId is not None:
+			key += ':host:' + str(hostId)
+		return key
+
+	def _claimTask(self, taskId, worker):
+		"""Tasks may be listed in the queue and in host lists, only the first
+		reservation claims the task. Revoked tasks are not claimed but moved
+		to the queue's cancelled list
+		"""
+		claimed = self._claim(
+			keys=['vycodi:queue:' + str(self.id) + ':working'],
+			args=[worker.id, self._cancelledKey(), taskId])
+		if claimed == -1:
+			self._resolveCancelled([taskId])
+		return claimed == 1
+
+	def _resolveCancelled(self, taskIds):
+		"""Marks the tasks taskIds skipped on reservation as done (status
+		cancelled), ends their streams and fails the tasks waiting for them
+		"""
+		for taskId in decodeRedis(list(taskIds)):
+			task = self._taskLoader[taskId]
+			pipe = self._redis.pipeline(transaction=False)
+			self._taskLoader.endStream(task, 'cancelled', pipe=pipe)
+			self.resolveDependents(task, 'cancelled', pipe)
+			self.dependentsResolved('cancelled', pipe.execute()[-1])
+
+	def _cancelledKey(self):
+		return 'vycodi:queue:' + str(self.id) + ':cancelled'
+
+	def _reserve(self, taskId, worker):
 		task = self._taskLoader[taskId]
+		task.stamp('reserved')
 		task.worker = worker.id
 		self._redis.lpush('vycodi:worker:' + str(worker.id) + ':working', task.id)
 		reservation = TaskReservation(self, task, worker)
 		return reservation
 
-	def enqueue(self, task):
+	def enqueue(self, task, after=None):
+		"""Enqueues the task
+		If after (tasks or task ids) is set, the task waits until all of them
+		have finished and is enqueued by the check-in of the last one. It
+		fails if any of them fails.
+		"""
 		task.queue = self.id
+		if after:
+			self._taskLoader.registerTask(task)
+			pending = self._defer(
+				keys=['vycodi:task:' + str(task.id)],
+				args=[task.id] + [t.id if isinstance(t, Task) else t for t in after])
+			if pending == -1:
+				self._failDependents([task.id])
+				return
+			if pending != 0:
+				return
+		task.stamp('enqueued')
 		self._taskLoader.registerTask(task)
-		self._redis.lpush('vycodi:queue:' + str(self.id), task.id)
+		hostIds = self._preferredHosts(task)
+		pipe = self._redis.pipeline(transaction=False)
+		pipe.hdel('vycodi:task:' + str(task.id), 'claimed')
+		# Requeued tasks start over, drop the stamps of earlier attempts
+		self._taskLoader.clearStamps(task, pipe=pipe, keep=('enqueued',))
+		self._taskLoader.storeStamps(task, pipe=pipe, names=('enqueued',))
+		if task.processor is not None:
+			pipe.sadd('vycodi:queue:' + str(self.id) + ':processors', task.processor)
+		pipe.lpush(self._listKey(task.processor), task.id)
+		for hostId in hostIds:
+			pipe.lpush(self._listKey(task.processor, hostId), task.id)
+		pipe.execute()
+
+	def enqueueGroup(self, tasks, then=None):
+		"""Enqueues the tasks (fan-out) and the task then (fan-in), which is
+		enqueued once all tasks have finished
+		"""
+		for task in tasks:
+			self.enqueue(task)
+		if then is not None:
+			self.enqueue(then, after=tasks)
+
+	def resolveDependents(self, task, status, pipe):
+		"""Adds the command marking the task as done (status finished,
+		failed or cancelled) to pipe, its result are the ids of the resolved children
+		(see dependentsResolved)
+		"""
+		self._resolve(
+			keys=['vycodi:task:' + str(task.id), 'vycodi:task:' + str(task.id) + ':children'],
+			args=[status], client=pipe)
+
+	def dependentsResolved(self, status, taskIds):
+		"""Enqueues the waiting tasks taskIds whose parents all finished or
+		fails them if a parent failed or was cancelled
+		"""
+		taskIds = decodeRedis(list(taskIds))
+		if status != 'finished':
+			self._failDependents(taskIds)
+			return
+		for taskId in taskIds:
+			task = self._taskLoader[taskId]
+			Queue.get(task.queue, self._redis, taskLoader=self._taskLoader).enqueue(task)
+
+	def _failDependents(self, taskIds):
+		"""Fails the waiting tasks taskIds and, transitively, their waiting
+		children
+		"""
+		while len(taskIds) != 0:
+			task = self._taskLoader[taskIds.pop()]
+			task.addFailure(Failure('ParentFailed', message="A task it depends on failed"))
+			Queue.get(task.queue, self._redis, taskLoader=self._taskLoader).addTaskToFailed(task)
+			pipe = self._redis.pipeline(transaction=False)
+			self._taskLoader.endStream(task, 'failed', pipe=pipe)
+			pipe.srem(TaskLoader.revokedKey, task.id)
+			self.resolveDependents(task, 'failed', pipe)
+			taskIds.extend(decodeRedis(list(pipe.execute()[-1])))
+
+	def _preferredHosts(self, task):
+		"""Returns the ids of the hosts hosting most of the task's inFiles,
+		of which only those with co-located workers (see
+		Worker._advertiseLocalHosts)
+		Only such workers pop the host lists, lists of other hosts would
+		grow forever
+		"""
+		if len(task.inFiles) == 0:
+			return []
+		pipe = self._redis.pipeline(transaction=False)
+		for fileId in task.inFiles:
+			pipe.smembers('vycodi:file:' + str(fileId) + ':hosts')
+		counts = dict()
+		for hostIds in pipe.execute():
+			for hostId in hostIds:
+				counts[hostId] = counts.get(hostId, 0) + 1
+		if len(counts) == 0:
+			return []
+		maxCount = max(counts.values())
+		hostIds = [decodeRedis(h) for h, c in counts.items() if c == maxCount]
+		pipe = self._redis.pipeline(transaction=False)
+		for hostId in hostIds:
+			pipe.exists('vycodi:host:' + hostId + ':localWorkers')
+		return [hostId for hostId, local in zip(hostIds, pipe.execute()) if local]
+
+	def handBack(self, task, workerId):
+		"""Atomically moves the task reserved by the worker workerId from
+		the working lists back to the front of the queue (the sub-queue
+		of the task's processor)
+		The task keeps its enqueued stamp, the stamps of the handed back
+		attempt are dropped
+		"""
+		pipe = self._redis.pipeline()
+		pipe.lrem('vycodi:queue:' + str(self.id) + ':working', -1, task.id)
+		pipe.lrem('vycodi:worker:' + str(workerId) + ':working', -1, task.id)
+		pipe.hdel('vycodi:task:' + str(task.id), 'claimed')
+		self._taskLoader.clearStamps(task, pipe=pipe, keep=('enqueued',))
+		pipe.rpush(self._listKey(task.processor), task.id)
+		pipe.execute()
 
 	def removeTaskFromWorking(self, task):
 		self._redis.lrem('vycodi:queue:' + str(self.id) + ':working', -1, task.id)
@@ -75,7 +370,7 @@ class Queue(object):
 		return queues
 
 	@classmethod
-	def get(cls, queueId, redis):
+	def get(cls, queueId, redis, taskLoader=None):
 		try:
 			specCache = cls._queuesCache[redis]
 		except KeyError:
@@ -85,17 +380,30 @@ class Queue(object):
 			return specCache[queueId]
 		except KeyError:
 			redis.sadd('vycodi:queues', queueId)
-			queue = Queue(queueId, redis)
+			queue = Queue(queueId, redis, taskLoader=taskLoader)
 			specCache[queueId] = queue
 			return queue
 
 
 class QueueWatcher(object):
-	def __init__(self, redis, worker, queues=[], taskLoader=None):
+	"""Reserves tasks from a set of queues for a worker
+	localHosts are the ids of hosts co-located with the worker, tasks whose
+	inFiles are hosted there are preferred. Other tasks are only reserved
+	after no local task could be found for localityWait seconds.
+	If processors is set, only tasks of these processors are reserved,
+	otherwise tasks of any processor. Sub-queues of processors warm in the
+	worker (worker.warmProcessors) are polled first.
+	"""
+	def __init__(self, redis, worker, queues=[], taskLoader=None,
+			localHosts=[], localityWait=1.0, processors=None):
 		self._worker = worker
 		self._redis = redis
 		self._queues = []
 		self._taskLoader = taskLoader
+		self._localHosts = list(localHosts)
+		self._localityWait = localityWait
+		self._processors = list(processors) if processors is not None else None
+		self._shouldStop = False
 		for queue in queues:
 			if not isinstance(queue, Queue):
 				queue = Queue.get(queue, self._redis, taskLoader=self._taskLoader)
@@ -106,27 +414,70 @@ class QueueWatcher(object):
 			queue = Queue.get(queue, self._redis, taskLoader=self._taskLoader)
 		self._queues.append(queue)
 
-	def reserveTask(self, timeout=None, wait=0.1):
-		if timeout is not None:
-			start = time.perf_counter()
+	def signalStopIntent(self):
+		"""Makes all current and future reserveTask calls raise QueueTimeout
+		"""
+		self._shouldStop = True
+
+	def resume(self):
+		self._shouldStop = False
+
+	def reserveTask(self, timeout=None, wait=0.1, processors=None):
+		"""Reserves a task, retrying every wait seconds for at most timeout
+		seconds (default forever)
+		If processors is set, only tasks of these processors are reserved
+		"""
+		start = time.perf_counter()
 		while True:
+			if self._shouldStop:
+				raise QueueTimeout()
+			elapsed = time.perf_counter() - start
+			timedOut = timeout is not None and elapsed > timeout
+			remote = len(self._localHosts) == 0 or elapsed >= self._localityWait or timedOut
 			try:
-				return self._fetchFromQueues(self._worker)
+				fetchStart = time.perf_counter()
+				reservation = self._fetchFromQueues(
+					self._worker, remote=remote, processors=processors)
+				metrics.reservationSeconds.observe(time.perf_counter() - fetchStart)
+				return reservation
 			except QueueTimeout:
-				if timeout is not None and time.perf_counter() > start + timeout:
+				if timedOut:
 					raise
 				time.sleep(wait)
 
-	def _fetchFromQueues(self, worker):
+	def _fetchFromQueues(self, worker, remote=True, processors=None):
 		"""Tries to reserve a task from any queue (in self._queues)
+		Tasks local to any of self._localHosts are tried first, other
+		tasks only if remote is True
 		"""
-		for queue in self._queues:
-			try:
-				return queue.reserveTask(self._worker)
-			except QueueTimeout:
-				pass
+		routes = [(queue, self._routes(queue, processors)) for queue in self._queues]
+		for queue, processors in routes:
+			for hostId in self._localHosts:
+				try:
+					return queue.reserveRoutedTask(self._worker, processors, hostId=hostId)
+				except QueueTimeout:
+					pass
+		if remote:
+			for queue, processors in routes:
+				try:
+					return queue.reserveRoutedTask(self._worker, processors)
+				except QueueTimeout:
+					pass
 		raise QueueTimeout()
 
+	def _routes(self, queue, processors=None):
+		"""Returns the processors whose sub-queues of queue are polled, warm
+		processors first, None stands for tasks without processor
+		"""
+		if processors is not None:
+			return processors
+		if self._processors is not None:
+			processors = self._processors
+		else:
+			processors = queue.processors() + [None]
+		warm = self._worker.warmProcessors
+		return [p for p in processors if p in warm] + [p for p in processors if p not in warm]
+
 
 class TaskReservation(object):
 	def __init__(self, queue, task, worker):
@@ -138,6 +489,7 @@ class TaskReservation(object):
 	def checkinFinished(self):
 		if not self.worker.isAlive():
 			return
+		self._recordLifecycle('finished')
 		if self._policy.storeFinishedTask(self.task):
 			self.queue.addTaskToFinished(self.task)
 		self.queue.removeTaskFromWorking(self.task)
@@ -146,7 +498,9 @@ class TaskReservation(object):
 	def checkinFailed(self, failure, requeue=True):
 		if not self.worker.isAlive():
 			return
-		if requeue and self._policy.requeueAfterFailure(self.task, failure):
+		requeue = requeue and self._policy.requeueAfterFailure(self.task, failure)
+		self._recordLifecycle('requeued' if requeue else 'failed')
+		if requeue:
 			self._requeue()
 		else:
 			if self._policy.storeFailedTask(self.task, failure):
@@ -154,6 +508,28 @@ class TaskReservation(object):
 		self.queue.removeTaskFromWorking(self.task)
 		self.queue.removeTaskFromWorkerWorking(self.task)
 
+	def _recordLifecycle(self, status):
+		"""Stores the task's timestamps, records its latencies in the
+		queue's and processor's histograms and ends the task's stream with
+		status, in one round trip
+		Tasks waiting for this task are enqueued or failed afterwards
+		"""
+		task = self.task
+		task.stamp('checkedIn')
+		pipe = self.queue._redis.pipeline(transaction=False)
+		task._loader.storeStamps(task, pipe=pipe)
+		now = task.stamps['checkedIn']
+		for (kind, metric), seconds in lifecycleLatencies(task.stamps).items():
+			id = self.queue.id if kind == 'queue' else task.processor
+			self.queue.stats.record(pipe, kind, id, metric, seconds, now=now)
+		task._loader.endStream(task, status, pipe=pipe)
+		if status == 'requeued':
+			pipe.execute()
+			return
+		pipe.srem(TaskLoader.revokedKey, task.id)
+		self.queue.resolveDependents(task, status, pipe)
+		self.queue.dependentsResolved(status, pipe.execute()[-1])
+
 	def _requeue(self):
 		self.task.worker = None
 		# TODO # CRASH
@@ -184,9 +560,26 @@ class QueueNotSet(QueueException):
 
 class TaskLoader(object):
 	keyBase = 'vycodi:task:'
+	revokedKey = 'vycodi:tasks:revoked'
+	revokedBatchesKey = 'vycodi:batches:revoked'
+	streamMaxLen = 1000
+	revokeChunkSize = 1000
+	# Revokes the tasks ARGV which exist and aren't done, ids are removed
+	# from the set KEYS[1] when the task is skipped or checks in
+	_revokeScript = """
+		local revoked = 0
+		for _, id in ipairs(ARGV) do
+			local key = 'vycodi:task:' .. id
+			if redis.call('EXISTS', key) == 1 and not redis.call('HGET', key, 'done') then
+				revoked = revoked + redis.call('SADD', KEYS[1], id)
+			end
+		end
+		return revoked
+	"""
 
 	def __init__(self, redis):
 		self._redis = redis
+		self._revoke = redis.register_script(self._revokeScript)
 
 	def __getitem__(self, key):
 		if isinstance(key, Task):
@@ -280,6 +673,29 @@ class TaskLoader(object):
 			task = task.id
 		self._redis.hmset(self.keyBase + str(task) + ':result', result)
 
+	def storeStamps(self, task, pipe=None, names=None):
+		"""Stores the lifecycle timestamps of the task, all or only names
+		If pipe is set, the command is added to it instead of executed
+		"""
+		stamps = task.stamps
+		data = dict()
+		for name in (names if names is not None else stamps):
+			if name in stamps:
+				data[name + 'At'] = stamps[name]
+		if len(data) == 0:
+			return
+		(pipe or self._redis).hmset(self.keyBase + str(task.id), data)
+
+	def clearStamps(self, task, pipe=None, keep=()):
+		"""Drops the lifecycle timestamps of the task, except for keep, in
+		the task and in redis
+		If pipe is set, the command is added to it instead of executed
+		"""
+		names = [name for name in lifecycleStamps if name not in keep]
+		for name in names:
+			task.stamps.pop(name, None)
+		(pipe or self._redis).hdel(self.keyBase + str(task.id), *[name + 'At' for name in names])
+
 	def updateTask(self, task, *args):
 		taskExp = task.exportRedis()
 		if len(args) == 0:
@@ -295,24 +711,96 @@ class TaskLoader(object):
 				return
 		self._redis.hmset(self.keyBase + str(task.id), data)
 
+	def cancelTasks(self, *tasks):
+		"""Revokes the tasks: queued tasks are skipped on reservation (and
+		listed in their queue's cancelled list), running tasks report
+		cancelled() as True
+		Tasks which are done or don't exist are ignored. Ids are sent in
+		chunks of revokeChunkSize, each revoked atomically.
+		Returns the number of revoked tasks
+		"""
+		ids = [t.id if isinstance(t, Task) else t for t in tasks]
+		revoked = 0
+		for i in range(0, len(ids), self.revokeChunkSize):
+			revoked += self._revoke(
+				keys=[self.revokedKey], args=ids[i:i + self.revokeChunkSize])
+		return revoked
+
+	def cancelBatch(self, batch):
+		"""Revokes all tasks of the batch, without touching the tasks
+		"""
+		self._redis.sadd(self.revokedBatchesKey, batch)
+
+	def isCancelled(self, task):
+		"""Returns whether the task or its batch has been revoked, in one
+		round trip
+		"""
+		pipe = self._redis.pipeline(transaction=False)
+		pipe.sismember(self.revokedKey, task.id)
+		if task.batch is not None:
+			pipe.sismember(self.revokedBatchesKey, task.batch)
+		return any(pipe.execute())
+
+	def addStreamEntry(self, task, type, data, pipe=None):
+		"""Appends an entry of type (progress, result or end) to the task's
+		stream, which keeps about streamMaxLen entries
+		"""
+		fields = {'type': type}
+		fields.update(data)
+		(pipe or self._redis).xadd(
+			self.keyBase + str(task.id) + ':stream', fields,
+			maxlen=self.streamMaxLen, approximate=True)
+
+	def endStream(self, task, status, pipe=None):
+		"""Appends the end entry to the task's stream, creating the stream
+		if the task reported neither progress nor partial results
+		"""
+		self.addStreamEntry(task, 'end', {'status': status}, pipe=pipe)
+
+	def readStream(self, task, lastId='0', count=None, block=None):
+		"""Returns the entries of the task's stream after lastId as a list of
+		(entryId, entry) tuples
+		block is the number of milliseconds to wait for entries, None
+		doesn't wait
+		"""
+		if isinstance(task, Task):
+			task = task.id
+		response = self._redis.xread(
+			{self.keyBase + str(task) + ':stream': lastId}, count=count, block=block)
+		entries = []
+		for _, streamEntries in response or []:
+			for entryId, fields in streamEntries:
+				entries.append((decodeRedis(entryId), self._loadStreamEntry(decodeRedis(fields))))
+		return entries
+
+	def _loadStreamEntry(self, fields):
+		if 'fraction' in fields:
+			fields['fraction'] = float(fields['fraction'])
+		for key in ('info', 'result'):
+			if key in fields:
+				fields[key] = loadJSON(fields[key])
+		return fields
+
 	def _fetchNextId(self):
 		return self._redis.incr('vycodi:tasks:index')
 
 
 class Task(object):
 	def __init__(self, id=None, queue=None, worker=None, processor=None,
-					payload=None, batch=None, loader=None):
+					payload=None, batch=None, timeout=None, loader=None):
 		self._id = id
 		self._queue = queue
 		self._worker = worker
 		self._batch = batch
 		self._processor = processor
 		self._payload = payload
+		self._timeout = timeout
 		self._loader = loader
 		self.__inFiles = None
 		self.__outFiles = None
 		self.__failures = None
 		self.__result = None
+		self.__stamps = dict()
 		self._registered = False
 
 	def __getattr__(self, key):
@@ -332,6 +820,18 @@ class Task(object):
 		else:
 			super(Task, self).__setattr__(key, value)
 
+	@property
+	def stamps(self):
+		"""Lifecycle timestamps (see vycodi.stats.lifecycleStamps)
+		"""
+		return self.__stamps
+
+	def stamp(self, name, t=None):
+		"""Records the time (default now) of the lifecycle event name
+		Timestamps are stored when the task is enqueued or checked in
+		"""
+		self.__stamps[name] = t if t is not None else time.time()
+
 	def register(self, loader=None):
 		if loader is not None:
 			self._loader = loader
@@ -427,6 +927,61 @@ class Task(object):
 				raise LoaderNotSet()
 		self.__result = result
 
+	def cancel(self):
+		"""See TaskLoader.cancelTasks
+		"""
+		if self._loader is None:
+			raise LoaderNotSet()
+		self._loader.cancelTasks(self)
+
+	def cancelled(self):
+		"""Returns whether the task has been cancelled, processors of long
+		running tasks may poll this
+		"""
+		if self._loader is None:
+			raise LoaderNotSet()
+		return self._loader.isCancelled(self)
+
+	def reportProgress(self, fraction, info=None):
+		"""Appends a progress entry to the task's stream
+		fraction is the completed fraction (0.0 - 1.0), info any JSON
+		encodable value
+		"""
+		data = {'fraction': repr(float(fraction))}
+		if info is not None:
+			data['info'] = dumpJSON(info)
+		self._streamEntry('progress', data)
+
+	def addPartialResult(self, result):
+		"""Appends a partial result (any JSON encodable value) to the task's
+		stream
+		"""
+		self._streamEntry('result', {'result': dumpJSON(result)})
+
+	def readStream(self, lastId='0', count=None, block=None):
+		"""See TaskLoader.readStream
+		"""
+		if self._loader is None:
+			raise LoaderNotSet()
+		return self._loader.readStream(self, lastId=lastId, count=count, block=block)
+
+	def iterStream(self, block=1000):
+		"""Yields the entries of the task's stream until the task has
+		finished or failed (the end entry is yielded last)
+		Entries are awaited for block milliseconds per request, forever
+		"""
+		lastId = '0'
+		while True:
+			for lastId, entry in self.readStream(lastId=lastId, block=block):
+				yield entry
+				if entry['type'] == 'end' and entry['status'] != 'requeued':
+					return
+
+	def _streamEntry(self, type, data):
+		if self._loader is None:
+			raise LoaderNotSet()
+		self._loader.addStreamEntry(self, type, data)
+
 	def enqueue(self, queue=None, loader=None):
 		if loader is not None:
 			self._loader = loader
@@ -473,6 +1028,8 @@ class Task(object):
 			taskDict['processor'] = self._processor
 		if self._batch is not None:
 			taskDict['batch'] = self._batch
+		if self._timeout is not None:
+			taskDict['timeout'] = self._timeout
 		if self._payload is not None:
 			storeJSONField(taskDict, 'payload', self._payload)
 		return taskDict
@@ -480,15 +1037,22 @@ class Task(object):
 	@classmethod
 	def fromRedisDict(cls, taskDict, loader):
 		taskDict = decodeRedis(taskDict)
+		timeout = taskDict.get('timeout', None)
 		task = cls(
 			id=int(taskDict['id']),
 			queue=taskDict['queue'],
 			worker=taskDict.get('worker', None),
 			processor=taskDict.get('processor', None),
 			batch=taskDict.get('batch', None),
+			timeout=float(timeout) if timeout is not None else None,
 			payload=loadJSONField(taskDict, 'payload', default={}),
 			loader=loader
 		)
+		for name in lifecycleStamps:
+			try:
+				task.stamp(name, float(taskDict[name + 'At']))
+			except KeyError:
+				pass
 		task._registered = True
 		return task
 
@@ -2,7 +2,7 @@ import botocore
 from boto3.session import Session
 from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from vycodi.bucket import File
+from vycodi.bucket import File, Backend, BackendError, FileMetadata
 from time import sleep
 
 
@@ -12,12 +12,12 @@ class S3File(File):
 		self.key = key
 
 	def export(self):
-		return {
+		return self._exportChecksum({
 			"id": self.id,
 			"name": self.name,
 			"key": self.key,
 			"type": self._type
-		}
+		})
 
 	@classmethod
 	def fromDict(cls, fileDict, bucket=None):
@@ -27,13 +27,14 @@ class S3File(File):
 			fileDict["key"],
 			fileDict["type"],
 			bucket=bucket
-		)
+		)._loadChecksum(fileDict)
 
 
-class S3Backend(object):
+class S3Backend(Backend):
 	fileClass = S3File
 
-	def __init__(self, keyId, accessKey, region, bucketName):
+	def __init__(self, keyId, accessKey, region, bucketName, metadataTTL=2.0):
+		super(S3Backend, self).__init__(metadataTTL=metadataTTL)
 		self._session = Session(
 			aws_access_key_id=keyId,
 			aws_secret_access_key=accessKey,
@@ -43,17 +44,23 @@ class S3Backend(object):
 		self._bucket = self._s3.Bucket(bucketName)
 		self._crtBucketIfNotExists()
 
-	def openR(self, file):
+	def openR(self, file, offset=0, length=None):
 		fileObject = self._bucket.Object(file.key)
-		return fileObject.get()['Body']
+		if offset == 0 and length is None:
+			return fileObject.get()['Body']
+		if length is None:
+			byteRange = 'bytes=%s-' % offset
+		else:
+			byteRange = 'bytes=%s-%s' % (offset, offset + length - 1)
+		return fileObject.get(Range=byteRange)['Body']
 
 	def openW(self, file, contentLength=None):
 		fileObject = self._bucket.Object(file.key)
-		return S3UploadStream(
+		return self._invalidatingWriter(file, S3UploadStream(
 			self._s3.meta.client,
 			self._bucket,
 			fileObject,
-			contentLength)
+			contentLength))
 
 	def genReadURL(self, file):
 		fileObject = self._bucket.Object(file.key)
@@ -66,17 +73,18 @@ class S3Backend(object):
 			ExpiresIn=300
 		)
 
-	def size(self, file):
-		fileObject = self._bucket.Object(file.key)
-		return fileObject.content_length
-
-	def contentType(self, file):
-		fileObject = self._bucket.Object(file.key)
-		return fileObject.content_type
-
-	def lastModified(self, file):
-		fileObject = self._bucket.Object(file.key)
-		return fileObject.last_modified.timestamp()
+	def stat(self, file):
+		try:
+			response = self._s3.meta.client.head_object(
+				Bucket=self._bucket.name, Key=file.key)
+		except botocore.exceptions.ClientError as e:
+			raise BackendError(str(e))
+		return FileMetadata(
+			response['ContentLength'],
+			response.get('ContentType', 'application/octet-stream'),
+			response['LastModified'].timestamp(),
+			response['ETag']
+		)
 
 	def _crtBucketIfNotExists(self):
 		exists = True
@@ -100,7 +108,8 @@ class S3Backend(object):
 			config['keyId'],
 			config['accessKey'],
 			config['region'],
-			config['bucketName']
+			config['bucketName'],
+			metadataTTL=float(config.get('metadataTTL', 2.0))
 		)
 
 
@@ -111,39 +120,65 @@ class S3UploadStream(object):
 	_maxCachedParts = 3
 
 	def __init__(self, client, bucket, fileObj, contentLength):
+		"""contentLength may be None if the length is not known in advance,
+		the upload switches to a multipart upload once more than
+		_multipartUploadThreshold bytes have been written
+		"""
 		self._client = client
 		self._bucket = bucket
 		self._fileObj = fileObj
-		if contentLength is not None:
-			self._contentLength = contentLength
-			self._useMultipart = contentLength > self._multipartUploadThreshold
-		else:
-			self._useMultipart = True
+		self._contentLength = contentLength
+		self._useMultipart = False
 		self._size = 0
 		self._buffer = BytesIO()
-		if self._useMultipart:
-			self._curPartNumber = 0
-			self._pendingFtrsNum = 0
-			self._uploadFtrs = []
-			response = self._client.create_multipart_upload(
-				Bucket=bucket.name,
-				Key=fileObj.key
-			)
-			self._uploadId = response['UploadId']
+		if contentLength is not None and contentLength > self._multipartUploadThreshold:
+			self._startMultipart()
+
+	def _startMultipart(self):
+		self._useMultipart = True
+		self._curPartNumber = 0
+		self._pendingFtrsNum = 0
+		self._uploadFtrs = []
+		response = self._client.create_multipart_upload(
+			Bucket=self._bucket.name,
+			Key=self._fileObj.key
+		)
+		self._uploadId = response['UploadId']
 
 	def write(self, bytes):
 		self._size += len(bytes)
 		self._buffer.write(bytes)
+		if not self._useMultipart and self._size > self._multipartUploadThreshold:
+			self._startMultipart()
 		if self._useMultipart and self._size >= self._partSize:
 			self._uploadPart()
 
 	def close(self):
 		if self._useMultipart:
+			if self._size > 0:
+				self._uploadPart()
 			self._completeUpload()
 		else:
 			self._buffer.seek(0)
 			self._bucket.put_object(Key=self._fileObj.key, Body=self._buffer)
 
+	def abort(self):
+		"""Discards the data written, a started multipart upload is aborted
+		"""
+		self._buffer = BytesIO()
+		self._size = 0
+		if not self._useMultipart:
+			return
+		for future in self._uploadFtrs:
+			try:
+				future.result()
+			except Exception:
+				pass
+		self._client.abort_multipart_upload(
+			Bucket=self._bucket.name, Key=self._fileObj.key,
+			UploadId=self._uploadId
+		)
+
 	def _uploadPart(self):
 		while self._pendingFtrsNum >= self._maxCachedParts:
 			sleep(0.01)
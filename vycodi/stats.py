@@ -0,0 +1,111 @@
+from vycodi.utils import decodeRedis
+import math
+import time
+
+# Timestamps stamped on tasks during their lifecycle, in order
+lifecycleStamps = (
+	'enqueued', 'reserved', 'started', 'downloaded', 'computed', 'finished', 'checkedIn'
+)
+
+
+class LatencyHistograms(object):
+	"""Rolling latency histograms stored in redis
+	Latencies are counted in logarithmic buckets (bucketsPerOctave buckets
+	per doubling of the latency in milliseconds) in one hash per window of
+	windowSize seconds. Windows expire after keepWindows windows.
+	Recording is one HINCRBY and EXPIRE per histogram, usually sent as part
+	of a pipeline.
+	"""
+	keyBase = 'vycodi:stats:'
+	bucketsPerOctave = 4
+	windowSize = 60
+	keepWindows = 60
+
+	def __init__(self, redis):
+		self._redis = redis
+
+	def record(self, pipe, kind, id, metric, seconds, now=None):
+		"""Adds the commands recording one latency of seconds to pipe
+		kind is e.g. 'queue' or 'processor', id the queue id or processor
+		name and metric the name of the latency
+		"""
+		if seconds is None or seconds < 0:
+			return
+		if now is None:
+			now = time.time()
+		key = self._key(kind, id, metric, self._window(now))
+		pipe.hincrby(key, self.bucket(seconds), 1)
+		pipe.expire(key, self.windowSize * (self.keepWindows + 1))
+
+	def percentiles(self, kind, id, metric, windows=None, ps=(50, 95, 99)):
+		"""Returns a dict mapping 'p<p>' to latencies in seconds, computed
+		over the last windows windows (default all kept windows)
+		Latencies are the upper bounds of the buckets, None if no latencies
+		were recorded
+		"""
+		if windows is None:
+			windows = self.keepWindows
+		current = self._window(time.time())
+		pipe = self._redis.pipeline(transaction=False)
+		for i in range(windows):
+			pipe.hgetall(self._key(kind, id, metric, current - i * self.windowSize))
+		counts = dict()
+		for window in pipe.execute():
+			for bucket, count in decodeRedis(window).items():
+				counts[int(bucket)] = counts.get(int(bucket), 0) + int(count)
+
+		total = sum(counts.values())
+		result = dict()
+		for p in ps:
+			result['p%s' % p] = None
+			if total == 0:
+				continue
+			threshold = total * p / 100.0
+			seen = 0
+			for bucket in sorted(counts):
+				seen += counts[bucket]
+				if seen >= threshold:
+					result['p%s' % p] = self.bucketBound(bucket)
+					break
+		return result
+
+	def bucket(self, seconds):
+		ms = seconds * 1000.0
+		if ms <= 1:
+			return 0
+		return int(math.ceil(math.log(ms, 2) * self.bucketsPerOctave))
+
+	def bucketBound(self, bucket):
+		"""Returns the upper bound of bucket in seconds
+		"""
+		return 2 ** (bucket / float(self.bucketsPerOctave)) / 1000.0
+
+	def _window(self, now):
+		return int(now) - int(now) % self.windowSize
+
+	def _key(self, kind, id, metric, window):
+		return '%s%s:%s:%s:%s' % (self.keyBase, kind, id, metric, window)
+
+
+def lifecycleLatencies(stamps):
+	"""Computes latencies from the lifecycle timestamps of a task
+	Returns a dict of (kind, metric) -> seconds
+	"""
+	def diff(end, *begins):
+		if end not in stamps:
+			return None
+		for begin in begins:
+			if begin in stamps:
+				return stamps[end] - stamps[begin]
+		return None
+
+	latencies = {
+		('queue', 'wait'): diff('reserved', 'enqueued'),
+		('queue', 'total'): diff('checkedIn', 'enqueued'),
+		('processor', 'download'): diff('downloaded', 'started'),
+		('processor', 'compute'): diff('computed', 'downloaded', 'started')
+			if 'computed' in stamps else diff('finished', 'downloaded', 'started'),
+		('processor', 'upload'): diff('finished', 'computed'),
+		('processor', 'processing'): diff('finished', 'started'),
+	}
+	return dict((k, v) for k, v in latencies.items() if v is not None)
@@ -1,8 +1,20 @@
 import json
 from io import IOBase
 from os.path import exists
+from shutil import copyfileobj
+import resource
+import socket
+import os
 import six
 
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# ioctl request number of FICLONE on Linux
+FICLONE = 0x40049409
+
 
 def dumpJSON(data):
 	return json.dumps(data, separators=(',', ':'))
@@ -65,17 +77,21 @@ def ensureJSONData(filePath, default):
 		storeJSONData(filePath, default)
 
 
-def redisFromConfig(config):
+def redisFromConfig(config, connectionClass=None):
 	global StrictRedis
-	host = config.get('dbhost', 'localhost')
-	port = int(config.get('dbport', 6379))
-	db = int(config.get('dbdb', 0))
-	password = config.get('dbpassword', None)
+	kwargs = dict(
+		host=config.get('dbhost', 'localhost'),
+		port=int(config.get('dbport', 6379)),
+		db=int(config.get('dbdb', 0)),
+		password=config.get('dbpassword', None)
+	)
+	if connectionClass is not None:
+		kwargs['connection_class'] = connectionClass
 	try:
-		return StrictRedis(host=host, port=port, db=db, password=password)
+		return StrictRedis(**kwargs)
 	except NameError:
 		from redis import StrictRedis
-		return StrictRedis(host=host, port=port, db=db, password=password)
+		return StrictRedis(**kwargs)
 
 
 def decodeRedis(d, encoding='utf-8', errors='strict'):
@@ -95,3 +111,65 @@ def decodeRedis(d, encoding='utf-8', errors='strict'):
 		return d.decode(encoding=encoding, errors=errors)
 	else:
 		return d
+
+
+def machineId():
+	"""Returns an identifier of the local machine
+	"""
+	for path in ('/etc/machine-id', '/var/lib/dbus/machine-id'):
+		try:
+			with open(path, 'r') as f:
+				mId = f.read().strip()
+		except IOError:
+			continue
+		if mId:
+			return mId
+	return socket.gethostname()
+
+
+def processRSS(pid='self'):
+	"""Returns the resident set size of a process in bytes or None if it
+	can't be determined
+	Falls back to the peak resident set size of the current process, if
+	/proc is not available
+	"""
+	try:
+		with open('/proc/%s/statm' % pid, 'r') as f:
+			return int(f.read().split()[1]) * resource.getpagesize()
+	except (IOError, IndexError, ValueError):
+		if pid == 'self':
+			return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+		return None
+
+
+def linkFile(src, dst, hardLink=True):
+	"""Places a copy of the file src at dst, avoiding copying data
+	Tries a reflink (copy-on-write clone), then a hard link (if hardLink is
+	set) and finally falls back to copying the file
+	Hard-linked files share their data with src, they must not be modified
+	"""
+	with open(src, 'rb') as srcF:
+		if fcntl is not None:
+			try:
+				with open(dst, 'wb') as dstF:
+					fcntl.ioctl(dstF.fileno(), FICLONE, srcF.fileno())
+				return
+			except (IOError, OSError):
+				if exists(dst):
+					os.unlink(dst)
+		if hardLink:
+			try:
+				os.link(src, dst)
+				return
+			except (IOError, OSError):
+				pass
+		with open(dst, 'wb') as dstF:
+			copyfileobj(srcF, dstF, 1 << 20)
+
+
+def metricsAddressFromConfig(config):
+	"""Returns the address of the metrics listener or None if not configured
+	"""
+	if 'metricsPort' not in config:
+		return None
+	return (config.get('metricsAddress', ''), int(config['metricsPort']))
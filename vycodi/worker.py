@@ -1,27 +1,54 @@
 from vycodi.httpclient import FileLoader
 from vycodi.daemon import Daemon
-from vycodi.utils import redisFromConfig, storeJSONData, loadJSONData
+from vycodi.utils import redisFromConfig, storeJSONData, loadJSONData, processRSS, \
+	metricsAddressFromConfig
+from vycodi.metrics import MetricsServer
+from vycodi import metrics
 from vycodi.queue import Queue, QueueWatcher, QueueTimeout, TaskLoader, Task
 from vycodi.processor import ProcessorLoader, ProcessingManager
 from vycodi.heartbeat import Heartbeat, Purger
+from vycodi.profiling import ProcessorProfiler
+from vycodi.jsonrpc import RPCClient, Server as RPCServer, Dispatcher, JSONRPCDispatchException
 from os.path import join, abspath, exists
 from os import mkdir
 from shutil import rmtree, Error
-from threading import Thread
+from threading import Thread, Lock
 import logging
+import time
+import os
+import sys
 
 
 class WorkerDaemon(Daemon):
-	def __init__(self, worker, *args, **kwargs):
+	def __init__(self, worker, *args, metricsAddress=None, **kwargs):
 		super(WorkerDaemon, self).__init__(*args, **kwargs)
 		self.worker = worker
+		self._metricsAddress = metricsAddress
+		self._metricsServer = None
 
 	def run(self, *args, **kwargs):
+		if self._metricsAddress is not None:
+			self._metricsServer = MetricsServer(self._metricsAddress)
+			self._metricsServer.start()
+		self.worker.recycleCallback = self.recycle
 		self.worker.start()
 		self.wait()
 
 	def shutdown(self):
 		self.worker.shutdown()
+		if self._metricsServer is not None:
+			self._metricsServer.shutdown()
+
+	def recycle(self):
+		"""Replaces the (already shut down) worker process by a fresh one
+		running the same command
+		"""
+		self.logger.info("Recycling worker process")
+		try:
+			self._context.pidfile.release()
+		except Exception:
+			pass
+		os.execv(sys.executable, [sys.executable] + sys.argv)
 
 	@classmethod
 	def fromConfig(cls, config, *args, redis=None, **kwargs):
@@ -29,7 +56,8 @@ class WorkerDaemon(Daemon):
 		if not exists(runDir):
 			mkdir(runDir)
 		worker = Worker.fromConfig(config, redis=redis)
-		return cls(worker, *args, runDir=runDir, **kwargs)
+		return cls(worker, *args, runDir=runDir,
+			metricsAddress=metricsAddressFromConfig(config), **kwargs)
 
 
 class WorkerPool(object):
@@ -43,8 +71,17 @@ class WorkerPool(object):
 	def start(self):
 		pass
 
-	def shutdown(self):
-		pass
+	def shutdown(self, timeout=None):
+		"""Stops the pool, waiting at most timeout seconds for tasks in
+		progress to finish
+		Return boolean; whether all tasks finished
+		"""
+		return True
+
+	def utilization(self):
+		"""Return the fraction of the pool's capacity processing tasks
+		"""
+		return 0.0
 
 
 class WorkerThreadPool(WorkerPool):
@@ -59,22 +96,38 @@ class WorkerThreadPool(WorkerPool):
 			self._threads.append(thread)
 			thread.start()
 
-	def shutdown(self):
+	def shutdown(self, timeout=None):
 		for thread in self._threads:
 			thread.signalStopIntent()
+		if timeout is not None:
+			deadline = time.perf_counter() + timeout
 		for thread in self._threads:
-			thread.join()
+			if timeout is None:
+				thread.join()
+			else:
+				thread.join(max(deadline - time.perf_counter(), 0))
+		finished = not any(thread.is_alive() for thread in self._threads)
 		self._threads = []
+		return finished
+
+	def utilization(self):
+		threads = self._threads
+		if len(threads) == 0:
+			return 0.0
+		return sum(1 for thread in threads if thread.busy) / float(len(threads))
 
 
 class WorkerThread(Thread):
 	def __init__(self, worker):
 		super(WorkerThread, self).__init__()
+		# Threads exceeding the drain timeout must not block the exit
+		self.daemon = True
 		self._logger = logging.getLogger(
 			"%s.%s[%s]" % (__name__, self.__class__.__name__, self.name))
 		self._worker = worker
 		self._processingManager = ProcessingManager(worker, logger=self._logger)
 		self._shouldStop = False
+		self.busy = False
 
 	def signalStopIntent(self):
 		self._shouldStop = True
@@ -85,11 +138,18 @@ class WorkerThread(Thread):
 				reservation = self._worker.queueWatcher.reserveTask(timeout=5)
 			except QueueTimeout:
 				continue
+			self.busy = True
+			self._worker.taskReserved(reservation.task)
 			self._processingManager.processTaskReservation(reservation)
+			self.busy = False
+			self._worker.taskProcessed(reservation.task)
+		self._processingManager.shutdown()
 
 
 class Worker(Purger):
-	def __init__(self, redis, runDir, id=None, queues=[], pool=None, policy=None):
+	def __init__(self, redis, runDir, id=None, queues=[], pool=None, policy=None,
+			localHosts=[], machine=None, rpcAddress=None, profileFraction=0.0,
+			processors=None):
 		self._redis = redis
 		self._runDir = runDir
 		self._pool = pool or WorkerThreadPool()
@@ -98,47 +158,165 @@ class Worker(Purger):
 		self.id = id if id is not None else self._fetchNextId()
 		self._registered = False
 		self._taskRunDirs = {}
+		self._tasksProcessed = 0
+		self._tasksInProgress = set()
+		self._recycling = False
+		self._lock = Lock()
+		self.recycleCallback = None
+		self._rpcAddress = rpcAddress
+		self._rpcServer = None
+		self.profiler = ProcessorProfiler(runDir, fraction=profileFraction)
+		self.processors = list(processors) if processors is not None else None
+		self.localHosts = list(localHosts)
+		self.warmProcessors = set()
 		self.taskLoader = TaskLoader(redis)
-		self.queueWatcher = QueueWatcher(redis, self, queues=queues, taskLoader=self.taskLoader)
+		self.queueWatcher = QueueWatcher(
+			redis, self, queues=queues, taskLoader=self.taskLoader,
+			localHosts=localHosts, localityWait=self.policy.getLocalityWait(),
+			processors=self.processors
+		)
 		self.processorLoader = ProcessorLoader(self)
-		self.fileLoader = FileLoader(redis)
-		self.heartbeat = Heartbeat(
-			redis, str(self.id),
-			self.policy.getWorkerTTL(),
-			self.policy.getWorkerHeartbeatInterval(),
-			prefix="vycodi:worker:",
-			setKey="vycodi:workers",
-			purger=self
+		self.fileLoader = FileLoader(
+			redis,
+			concurrency=self.policy.getTransferConcurrency(),
+			hostConcurrency=self.policy.getHostTransferConcurrency(),
+			localTransfer=self.policy.useLocalTransfer(),
+			machine=machine,
+			cacheDir=self._crtCacheDir() if self.policy.useDownloadCache() else None,
+			uploadEncoding=self.policy.getUploadEncoding()
 		)
+		self.heartbeat = None
 
 	def start(self):
 		self._logger.info("Starting...")
 		if not self._pool.isInit:
 			self._pool.initPool(self)
+		self.queueWatcher.resume()
+		# Reservations left by a previous run with the same id, unless
+		# still held by threads exceeding the last drain timeout
+		with self._lock:
+			inProgress = set(self._tasksInProgress)
+		self._handBackReservations(self.id, keep=inProgress)
 		self._pool.start()
+		metrics.poolUtilization.setFunction(self._pool.utilization)
 		self._register()
+		if self._rpcAddress is not None:
+			self._rpcServer = WorkerRPCServer(self._rpcAddress, self)
+			self._rpcServer.start()
+		self.heartbeat = Heartbeat(
+			self._redis, str(self.id),
+			self.policy.getWorkerTTL(),
+			self.policy.getWorkerHeartbeatInterval(),
+			prefix="vycodi:worker:",
+			setKey="vycodi:workers",
+			purger=self,
+			onBeat=self._advertiseLocalHosts
+		)
 		self.heartbeat.start()
 
-	def shutdown(self):
+	def shutdown(self, timeout=None):
+		"""Drains the worker: no more tasks are reserved, tasks in progress
+		may finish and check in for at most timeout seconds (default
+		policy.getDrainTimeout()). Other reservations are handed back to
+		their queues.
+		Tasks still in progress afterwards keep their reservations and may
+		check in later. The worker's registration is left to expire then,
+		after which other workers hand them back (see _purge).
+		"""
 		self._logger.info("Shutting down...")
-		self._unregister()
-		self.heartbeat.signalStopIntent()
-		self._pool.shutdown()
-		if len(self._taskRunDirs) != 0:
+		if timeout is None:
+			timeout = self.policy.getDrainTimeout()
+		self.queueWatcher.signalStopIntent()
+		drained = self._pool.shutdown(timeout=timeout)
+		with self._lock:
+			inProgress = set(self._tasksInProgress)
+		if drained:
+			self._handBackReservations(self.id)
+			self._unregister()
+		else:
+			self._logger.warn(
+				"Tasks %s still in progress after %s s, leaving the registration to expire"
+				% (sorted(inProgress), timeout))
+			self._handBackReservations(self.id, keep=inProgress)
+		if self.heartbeat is not None:
+			self.heartbeat.signalStopIntent()
+		if self._rpcServer is not None:
+			self._rpcServer.shutdown()
+			self._rpcServer = None
+		self.fileLoader.shutdown()
+		leftRunDirs = [taskId for taskId in self._taskRunDirs if taskId not in inProgress]
+		if len(leftRunDirs) != 0:
 			self._logger.warn("Task run dirs left")
-			for taskId in self._taskRunDirs:
+			for taskId in leftRunDirs:
 				self.cleanupTaskDir(taskId)
 
+	def taskReserved(self, task):
+		"""Called by worker threads before processing a task
+		"""
+		with self._lock:
+			self._tasksInProgress.add(task.id)
+
+	def taskProcessed(self, task):
+		"""Called by worker threads after processing a task
+		Recycles the worker if the policy demands it and recycleCallback is
+		set (by WorkerDaemon, which replaces the process). Restarting the
+		threads within the process would not release its memory.
+		"""
+		with self._lock:
+			self._tasksInProgress.discard(task.id)
+			self._tasksProcessed += 1
+			if self._recycling or self.recycleCallback is None:
+				return
+			if not self.policy.recycleWorker(task, self._tasksProcessed, processRSS()):
+				return
+			self._recycling = True
+		self._logger.info(
+			"Recycling after %s tasks, last processor '%s'"
+			% (self._tasksProcessed, task.processor))
+		thread = Thread(target=self.recycle)
+		thread.daemon = True
+		thread.start()
+
+	def recycle(self):
+		"""Drains and shuts down the worker, then replaces it by calling
+		recycleCallback
+		"""
+		self.shutdown()
+		with self._lock:
+			self._tasksProcessed = 0
+			self._recycling = False
+			self.warmProcessors = set()
+		self.recycleCallback()
+
+	def processorWarmed(self, name):
+		"""Called when a processor was initialised by a worker thread
+		Tasks of warm processors are reserved first, they are advertised in
+		the worker's hash
+		"""
+		if name in self.warmProcessors:
+			return
+		self.warmProcessors.add(name)
+		self._redis.hset(
+			'vycodi:worker:' + str(self.id), 'warmProcessors',
+			','.join(sorted(self.warmProcessors)))
+
 	def isAlive(self):
 		return self._redis.exists("vycodi:worker:" + str(self.id))
 
 	def _purge(self, prefix, key, postfix, heartbeat):
-		for taskId in self._redis.lrange("vycodi:worker:" + str(self.id) + "working", 0, -1):
+		self._handBackReservations(key)
+
+	def _handBackReservations(self, workerId, keep=()):
+		"""Returns all tasks reserved by the worker workerId to the front of
+		their queues, except for the tasks with ids in keep
+		"""
+		for taskId in self._redis.lrange("vycodi:worker:" + str(workerId) + ":working", 0, -1):
 			task = self.taskLoader[taskId]
-			queue = Queue.get(task.queue)
-			queue.enqueue(task)
-			queue.removeTaskFromWorking(task)
-			queue.removeTaskFromWorkerWorking(task)
+			if task.id in keep:
+				continue
+			queue = Queue.get(task.queue, self._redis, taskLoader=self.taskLoader)
+			self._logger.info("Handing back task '%s' to queue '%s'" % (task.id, queue.id))
+			queue.handBack(task, workerId)
 
 	def zombie(self, prefix, key, postfix, heartbeat):
 		self._logger.warn("Became zombie, restarting")
@@ -168,32 +346,63 @@ class Worker(Purger):
 				"Error deleting task run dir for task '%s'" % task,
 				exc_info=True)
 
+	def _crtCacheDir(self):
+		path = join(self._runDir, 'cache')
+		if not exists(path):
+			mkdir(path)
+		return path
+
 	def _register(self):
 		self._logger.info("Registering...")
-		self._redis.hmset('vycodi:worker:' + str(self.id), {
-			'id': self.id
-		})
+		data = {'id': self.id}
+		if self.processors is not None:
+			data['processors'] = ','.join(self.processors)
+		if len(self.warmProcessors) != 0:
+			data['warmProcessors'] = ','.join(sorted(self.warmProcessors))
+		self._redis.hmset('vycodi:worker:' + str(self.id), data)
 		self._redis.sadd('vycodi:workers', self.id)
+		self._advertiseLocalHosts()
 		self._registered = True
 
 	def _unregister(self):
 		self._logger.info("Unregistering...")
 		self._redis.srem('vycodi:workers', self.id)
 		self._redis.delete('vycodi:worker:' + str(self.id))
+		for hostId in self.localHosts:
+			self._redis.srem('vycodi:host:' + str(hostId) + ':localWorkers', self.id)
 		self._registered = False
 
+	def _advertiseLocalHosts(self):
+		"""Adds the worker to the localWorkers of its local hosts, which
+		expire with the worker's TTL unless refreshed by the heartbeat
+		Tasks are only listed in the host lists of such hosts, see
+		Queue.enqueue
+		"""
+		if len(self.localHosts) == 0:
+			return
+		pipe = self._redis.pipeline(transaction=False)
+		for hostId in self.localHosts:
+			key = 'vycodi:host:' + str(hostId) + ':localWorkers'
+			pipe.sadd(key, self.id)
+			pipe.expire(key, self.policy.getWorkerTTL())
+		pipe.execute()
+
 	def _fetchNextId(self):
 		return self._redis.incr('vycodi:workers:index')
 
 	@classmethod
 	def fromConfig(cls, config, redis=None):
 		if redis is None:
-			redis = redisFromConfig(config)
+			connectionClass = None
+			if metricsAddressFromConfig(config) is not None:
+				connectionClass = metrics.countingConnectionClass(metrics.redisRoundTrips)
+			redis = redisFromConfig(config, connectionClass=connectionClass)
 		runDir = abspath(config['runDir'])
 		if not exists(runDir):
 			mkdir(runDir)
 
 		queues = config.get('queues', [])
+		localHosts = config.get('localHosts', [])
 
 		workerId = None
 		try:
@@ -201,13 +410,80 @@ class Worker(Purger):
 		except FileNotFoundError:
 			pass
 
-		worker = cls(redis, runDir, id=workerId, queues=queues)
+		policy = DefaultPolicy.fromConfig(config)
+
+		rpcSock = join(runDir, 'rpc.sock')
+
+		worker = cls(redis, runDir, id=workerId, queues=queues, policy=policy,
+			localHosts=localHosts, machine=config.get('machineId', None),
+			rpcAddress=rpcSock, profileFraction=float(config.get('profileFraction', 0.0)),
+			processors=config.get('processors', None))
 
 		if workerId is None:
 			storeJSONData(join(runDir, 'data.json'), {'workerId': worker.id})
 		return worker
 
 
+class WorkerRPCServer(Thread):
+	def __init__(self, address, worker):
+		super(WorkerRPCServer, self).__init__()
+		self._worker = worker
+		self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+		dispatcher = Dispatcher()
+		dispatcher.add_method(self.genSetProfiling())
+		dispatcher.add_method(self.genDumpProfiles())
+		self._server = RPCServer(address, dispatcher)
+
+	def run(self):
+		self._logger.info("Starting...")
+		self._server.serve_forever()
+
+	def genSetProfiling(self):
+		def setProfiling(fraction, processors=None):
+			if not 0 <= fraction <= 1:
+				raise JSONRPCDispatchException(
+					code=101,
+					message="Fraction must be between 0 and 1"
+				)
+			self._worker.profiler.configure(fraction, processors=processors)
+			return fraction
+		return setProfiling
+
+	def genDumpProfiles(self):
+		def dumpProfiles(reset=False):
+			paths = self._worker.profiler.dump()
+			if reset:
+				self._worker.profiler.reset()
+			return paths
+		return dumpProfiles
+
+	def shutdown(self):
+		self._logger.info("Shutting down...")
+		self._server.shutdown()
+
+
+class WorkerRPCClient(RPCClient):
+	def setProfiling(self, fraction, processors=None):
+		with self.sock() as sock:
+			reqId = self._sendRequest(sock, 'setProfiling', [fraction, processors])
+			response = self._recvResponse(sock, reqId)
+			return response['result']
+
+	def dumpProfiles(self, reset=False):
+		with self.sock() as sock:
+			reqId = self._sendRequest(sock, 'dumpProfiles', [reset])
+			response = self._recvResponse(sock, reqId)
+			return response['result']
+
+	@classmethod
+	def fromConfig(cls, config):
+		runDir = abspath(config['runDir'])
+		if not exists(runDir):
+			return None
+
+		return cls(join(runDir, 'rpc.sock'))
+
+
 class Policy(object):
 	"""Describes policy regarding different job-queue system aspects,
 	mostly failure handling and cleanup
@@ -243,8 +519,118 @@ class Policy(object):
 		"""
 		pass
 
+	def getTransferConcurrency(self):
+		"""Return the maximum number of concurrent file transfers of the
+		worker, shared by all tasks it processes
+		"""
+		pass
+
+	def getHostTransferConcurrency(self):
+		"""Return the maximum number of concurrent file transfers of the
+		worker from / to a single host, shared by all tasks it processes
+		"""
+		pass
+
+	def useLocalTransfer(self):
+		"""Return boolean; whether files of hosts on the same machine are to be
+		accessed directly on the file system instead of over HTTP
+		"""
+		pass
+
+	def useDownloadCache(self):
+		"""Return boolean; whether downloaded files are to be cached in the
+		worker's run dir and revalidated with conditional requests
+		"""
+		pass
+
+	def getUploadEncoding(self):
+		"""Return the content coding (e.g. 'gzip') uploads are to be
+		compressed with or None
+		"""
+		pass
+
+	def isolateTask(self, task):
+		"""Return boolean; whether the task is to be executed in a child
+		process of the worker thread, which is killed on timeout
+		"""
+		pass
+
+	def getTaskTimeout(self, task):
+		"""Return the amount of seconds after which an isolated task is
+		killed, or None
+		"""
+		pass
+
+	def recycleWorker(self, task, tasksProcessed, rss):
+		"""Called after a worker processed task, only for workers run by
+		WorkerDaemon, which replaces the worker process when recycling
+		tasksProcessed is the number of tasks processed by the worker, rss
+		the resident set size of the worker process in bytes
+		Return boolean; whether the worker is to be recycled
+		"""
+		pass
+
+	def recycleChild(self, task, tasksProcessed, rss):
+		"""Called after a child process executed the isolated task
+		tasksProcessed is the number of tasks executed by the child, rss
+		the resident set size of the child process in bytes
+		Return boolean; whether the child is to be replaced
+		"""
+		pass
+
+	def getDrainTimeout(self):
+		"""Return the amount of seconds a shutting down worker waits for tasks
+		in progress, before handing them back to their queues
+		"""
+		pass
+
+	def getLocalityWait(self):
+		"""Return the amount of seconds a worker with local hosts waits for
+		a local task before reserving a task with remote inFiles
+		"""
+		pass
+
+	@classmethod
+	def fromConfig(cls, config):
+		return cls.fromPolicyConfig(config.get('policy', {}))
+
+	@classmethod
+	def fromPolicyConfig(cls, config):
+		return cls()
+
 
 class DefaultPolicy(Policy):
+	"""Policy with options set in the "policy" section of the config
+	Options for single processors may be set in processorOptions, a dict
+	mapping processor names to dicts of options, which take precedence
+	over the global options
+	maxTasks and maxRSS (in MiB) are the recycling thresholds of workers
+	(run by WorkerDaemon) and child processes
+	"""
+	def __init__(self, transferConcurrency=4, hostTransferConcurrency=2, localityWait=1.0,
+			localTransfer=False, downloadCache=False, uploadEncoding=None, isolate=False,
+			taskTimeout=None, maxTasks=None, maxRSS=None, drainTimeout=30,
+			processorOptions=None):
+		self._transferConcurrency = transferConcurrency
+		self._hostTransferConcurrency = hostTransferConcurrency
+		self._localityWait = localityWait
+		self._localTransfer = localTransfer
+		self._downloadCache = downloadCache
+		self._uploadEncoding = uploadEncoding
+		self._isolate = isolate
+		self._taskTimeout = taskTimeout
+		self._maxTasks = maxTasks
+		self._maxRSS = maxRSS
+		self._drainTimeout = drainTimeout
+		self._processorOptions = processorOptions or {}
+
+	def _processorOption(self, processor, key, default, convert=None):
+		try:
+			value = self._processorOptions[processor][key]
+		except KeyError:
+			return default
+		return _optional(convert, value) if convert is not None else value
+
 	def requeueAfterFailure(self, task, failure):
 		return len(task.failures) < 5
 
@@ -259,3 +645,70 @@ class DefaultPolicy(Policy):
 
 	def getWorkerHeartbeatInterval(self):
 		return 40
+
+	def getTransferConcurrency(self):
+		return self._transferConcurrency
+
+	def getHostTransferConcurrency(self):
+		return self._hostTransferConcurrency
+
+	def getLocalityWait(self):
+		return self._localityWait
+
+	def getDrainTimeout(self):
+		return self._drainTimeout
+
+	def useLocalTransfer(self):
+		return self._localTransfer
+
+	def useDownloadCache(self):
+		return self._downloadCache
+
+	def getUploadEncoding(self):
+		return self._uploadEncoding
+
+	def isolateTask(self, task):
+		return bool(self._processorOption(task.processor, 'isolate', self._isolate))
+
+	def getTaskTimeout(self, task):
+		if task.timeout is not None:
+			return task.timeout
+		return self._processorOption(task.processor, 'taskTimeout', self._taskTimeout, float)
+
+	def recycleWorker(self, task, tasksProcessed, rss):
+		return self._exceedsThresholds(task, tasksProcessed, rss)
+
+	def recycleChild(self, task, tasksProcessed, rss):
+		return self._exceedsThresholds(task, tasksProcessed, rss)
+
+	def _exceedsThresholds(self, task, tasksProcessed, rss):
+		maxTasks = self._processorOption(task.processor, 'maxTasks', self._maxTasks, int)
+		if maxTasks is not None and tasksProcessed >= maxTasks:
+			return True
+		maxRSS = self._processorOption(task.processor, 'maxRSS', self._maxRSS, float)
+		if maxRSS is not None and rss is not None and rss > maxRSS * (1 << 20):
+			return True
+		return False
+
+	@classmethod
+	def fromPolicyConfig(cls, config):
+		return cls(
+			transferConcurrency=int(config.get('transferConcurrency', 4)),
+			hostTransferConcurrency=int(config.get('hostTransferConcurrency', 2)),
+			localityWait=float(config.get('localityWait', 1.0)),
+			localTransfer=bool(config.get('localTransfer', False)),
+			downloadCache=bool(config.get('downloadCache', False)),
+			uploadEncoding=config.get('uploadEncoding', None),
+			isolate=bool(config.get('isolate', False)),
+			taskTimeout=_optional(float, config.get('taskTimeout', None)),
+			maxTasks=_optional(int, config.get('maxTasks', None)),
+			maxRSS=_optional(float, config.get('maxRSS', None)),
+			drainTimeout=float(config.get('drainTimeout', 30)),
+			processorOptions=config.get('processors', {})
+		)
+
+
+def _optional(convert, value):
+	"""Converts the config value with convert, None stays None
+	"""
+	return None if value is None else convert(value)